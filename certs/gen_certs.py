@@ -1,6 +1,19 @@
+import argparse
+import datetime
+import json
 import subprocess
 import sys
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    from cryptography import x509
+    from cryptography.hazmat.primitives import hashes, serialization
+    from cryptography.hazmat.primitives.asymmetric import ec, rsa
+    from cryptography.x509.oid import ExtendedKeyUsageOID, NameOID
+except ImportError:  # only needed for --bulk (pip install -r certs/requirements.txt)
+    x509 = None
 
 def run_command(cmd):
     """Run a shell command and check for errors."""
@@ -11,7 +24,199 @@ def run_command(cmd):
         print(f"Error running command: {cmd}")
         sys.exit(1)
 
+CLIENT_CNF_TEMPLATE = """
+    [req]
+    distinguished_name = req_distinguished_name
+    req_extensions = v3_req
+    prompt = no
+
+    [req_distinguished_name]
+    CN = {cn}
+
+    [v3_req]
+    basicConstraints = CA:FALSE
+    keyUsage = critical, digitalSignature, keyEncipherment
+    extendedKeyUsage = clientAuth
+"""
+
+
+def mint_clients(target_dir, count, prefix, domain):
+    """
+    Mints `count` client certificates with distinct email CNs (<prefix><n>@<domain>)
+    into <target_dir>/clients, signed by the existing CA, and writes the list of
+    CNs to clients/manifest.txt (one email per line, loadable with
+    `python manage.py provision_users certs/clients/manifest.txt`).
+    """
+    clients_dir = os.path.join(target_dir, "clients")
+    os.makedirs(clients_dir, exist_ok=True)
+    ca_crt = os.path.join(target_dir, "ca.crt")
+    ca_key = os.path.join(target_dir, "ca.key")
+    if not os.path.exists(ca_crt) or not os.path.exists(ca_key):
+        print(f"Error: CA not found in '{target_dir}'. Run without --only-clients first.")
+        sys.exit(1)
+
+    emails = []
+    for n in range(count):
+        cn = f"{prefix}{n}@{domain}"
+        base = os.path.join(clients_dir, cn)
+        cnf = base + ".cnf"
+        with open(cnf, "w") as f:
+            f.write(CLIENT_CNF_TEMPLATE.format(cn=cn))
+
+        run_command(f'openssl req -new -newkey rsa:2048 -nodes -keyout "{base}.key" -out "{base}.csr" -config "{cnf}"')
+        run_command(f'openssl x509 -req -in "{base}.csr" -CA {ca_crt} -CAkey {ca_key} -CAcreateserial -out "{base}.crt" -days 365 -sha256 -extfile "{cnf}" -extensions v3_req')
+
+        for leftover in (cnf, base + ".csr"):
+            os.remove(leftover)
+        emails.append(cn)
+
+    with open(os.path.join(clients_dir, "manifest.txt"), "w") as f:
+        f.write("\n".join(emails) + "\n")
+
+    print(f"\nMinted {count} client certificates in '{clients_dir}'.")
+
+
+# --- Bulk issuance (in process, with the `cryptography` package) ---------------
+
+_CA = None
+
+
+def _load_ca(ca_crt_pem, ca_key_pem):
+    # Process pool initializer: parse the CA once per worker, not once per cert
+    global _CA
+    _CA = (x509.load_pem_x509_certificate(ca_crt_pem),
+           serialization.load_pem_private_key(ca_key_pem, password=None))
+
+
+def _mint_chunk(cns, key_type, days):
+    """
+    Signs one client certificate per CN with the loaded CA, with the same
+    extensions as CLIENT_CNF_TEMPLATE. Returns [(cn, cert_pem, key_pem)].
+    """
+    ca_cert, ca_key = _CA
+    now = datetime.datetime.now(datetime.timezone.utc)
+    minted = []
+    for cn in cns:
+        if key_type == "ec":
+            key = ec.generate_private_key(ec.SECP256R1())
+        else:
+            key = rsa.generate_private_key(public_exponent=65537, key_size=2048)
+        cert = (
+            x509.CertificateBuilder()
+            .subject_name(x509.Name([x509.NameAttribute(NameOID.COMMON_NAME, cn)]))
+            .issuer_name(ca_cert.subject)
+            .public_key(key.public_key())
+            .serial_number(x509.random_serial_number())
+            .not_valid_before(now - datetime.timedelta(minutes=5))
+            .not_valid_after(now + datetime.timedelta(days=days))
+            .add_extension(x509.BasicConstraints(ca=False, path_length=None), critical=False)
+            .add_extension(x509.KeyUsage(
+                digital_signature=True, key_encipherment=key_type != "ec", content_commitment=False,
+                data_encipherment=False, key_agreement=False, key_cert_sign=False, crl_sign=False,
+                encipher_only=False, decipher_only=False,
+            ), critical=True)
+            .add_extension(x509.ExtendedKeyUsage([ExtendedKeyUsageOID.CLIENT_AUTH]), critical=False)
+            .sign(ca_key, hashes.SHA256())
+        )
+        minted.append((
+            cn,
+            cert.public_bytes(serialization.Encoding.PEM),
+            key.private_bytes(serialization.Encoding.PEM, serialization.PrivateFormat.PKCS8,
+                              serialization.NoEncryption()),
+        ))
+    return minted
+
+
+def mint_clients_bulk(target_dir, count, prefix, domain, jobs=None, key_type="rsa", bundle=None,
+                      days=365, chunk_size=64):
+    """
+    Same CNs as mint_clients(), minted in process: the CA is loaded once per
+    worker and key generation/signing is spread over a process pool. Writes
+    clients/<cn>.crt/.key plus clients/manifest.txt, or with `bundle` a single
+    JSON lines file of {"cn", "cert", "key"} (also accepted by provision_users).
+    """
+    if x509 is None:
+        print("Error: --bulk requires the 'cryptography' package (pip install -r certs/requirements.txt)")
+        sys.exit(1)
+
+    ca_crt = os.path.join(target_dir, "ca.crt")
+    ca_key = os.path.join(target_dir, "ca.key")
+    if not os.path.exists(ca_crt) or not os.path.exists(ca_key):
+        print(f"Error: CA not found in '{target_dir}'. Run without --only-clients first.")
+        sys.exit(1)
+    with open(ca_crt, "rb") as f:
+        ca_crt_pem = f.read()
+    with open(ca_key, "rb") as f:
+        ca_key_pem = f.read()
+
+    clients_dir = os.path.join(target_dir, "clients")
+    if bundle is None:
+        os.makedirs(clients_dir, exist_ok=True)
+        out = None
+    else:
+        # Holds every private key, so it is not world readable either
+        fd = os.open(bundle, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.fchmod(fd, 0o600)  # O_CREAT's mode doesn't apply to an existing file
+        out = os.fdopen(fd, "w")
+
+    cns = [f"{prefix}{n}@{domain}" for n in range(count)]
+    chunks = [cns[i:i + chunk_size] for i in range(0, len(cns), chunk_size)]
+    jobs = jobs or os.cpu_count() or 1
+    start = time.perf_counter()
+    done = 0
+    with ProcessPoolExecutor(max_workers=jobs, initializer=_load_ca, initargs=(ca_crt_pem, ca_key_pem)) as pool:
+        for minted in pool.map(_mint_chunk, chunks, [key_type] * len(chunks), [days] * len(chunks)):
+            for cn, cert_pem, key_pem in minted:
+                if out is not None:
+                    out.write(json.dumps({"cn": cn, "cert": cert_pem.decode(), "key": key_pem.decode()}) + "\n")
+                    continue
+                base = os.path.join(clients_dir, cn)
+                with open(base + ".crt", "wb") as f:
+                    f.write(cert_pem)
+                # Private keys are not world readable
+                fd = os.open(base + ".key", os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+                with os.fdopen(fd, "wb") as f:
+                    f.write(key_pem)
+            done += len(minted)
+            print(f"\rMinted {done}/{count}", end="", flush=True)
+
+    elapsed = time.perf_counter() - start
+    if out is not None:
+        out.close()
+        where = bundle
+    else:
+        with open(os.path.join(clients_dir, "manifest.txt"), "w") as f:
+            f.write("\n".join(cns) + "\n")
+        where = clients_dir
+    print(f"\nMinted {count} client certificates in '{where}' in {elapsed:.1f}s "
+          f"({count / max(elapsed, 1e-9):.0f} certs/s, {jobs} processes, {key_type} keys).")
+
+
 def main():
+    parser = argparse.ArgumentParser(description="Generate the CA, server and client certificates")
+    parser.add_argument("--clients", type=int, default=0,
+                        help="Also mint N client certs with distinct CNs into certs/clients (for load tests)")
+    parser.add_argument("--client-prefix", default="loadtest", help="CN prefix for minted clients (default: loadtest)")
+    parser.add_argument("--client-domain", default="qt-test.com", help="CN domain for minted clients (default: qt-test.com)")
+    parser.add_argument("--only-clients", action="store_true",
+                        help="Reuse the existing CA and only mint the --clients certificates")
+    parser.add_argument("--bulk", action="store_true",
+                        help="Mint the --clients certificates in process with the 'cryptography' package "
+                             "across a process pool, instead of two openssl calls per cert")
+    parser.add_argument("--jobs", type=int, default=None, help="With --bulk: worker processes (default: CPU count)")
+    parser.add_argument("--key-type", choices=["rsa", "ec"], default="rsa",
+                        help="With --bulk: RSA 2048 (default, as openssl) or EC P-256 keys (much faster)")
+    parser.add_argument("--bundle", help="With --bulk: write one JSON lines file of {cn, cert, key} "
+                                         "instead of certs/clients/")
+    args = parser.parse_args()
+
+    def mint():
+        if args.bulk:
+            mint_clients_bulk(target_dir, args.clients, args.client_prefix, args.client_domain,
+                              jobs=args.jobs, key_type=args.key_type, bundle=args.bundle)
+        else:
+            mint_clients(target_dir, args.clients, args.client_prefix, args.client_domain)
+
     target_dir = "."
     if os.path.basename(os.getcwd()) != "certs":
         if os.path.exists("certs"):
@@ -20,6 +225,10 @@ def main():
             print("Error: Could not find 'certs' directory.")
             sys.exit(1)
 
+    if args.only_clients:
+        mint()
+        return
+
     print(f"Generating certificates in '{target_dir}'...")
 
     # CA Config & Generation
@@ -106,5 +315,8 @@ def main():
 
     print("\nCertificate generation complete (v3 SAN compliant).")
 
+    if args.clients:
+        mint()
+
 if __name__ == "__main__":
     main()
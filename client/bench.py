@@ -0,0 +1,231 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from collections import Counter
+from pathlib import Path
+
+import requests
+
+from stats import percentile
+
+# Resolve paths relative to the script location
+script_dir = Path(__file__).resolve().parent
+repo_dir = script_dir.parent
+default_certs_dir = repo_dir / "certs"
+
+
+def load_identities(args):
+    """
+    Returns a list of identities: (cert, key) pairs for mTLS, or CN strings for --plain.
+    """
+    if args.plain:
+        if args.emails:
+            with open(args.emails) as f:
+                emails = [line.strip() for line in f if line.strip()]
+        else:
+            emails = ["valid_user@qt-test.com"]
+        if not emails:
+            print(f"Error: No emails found in {args.emails}")
+            sys.exit(1)
+        return emails
+
+    clients_dir = Path(args.clients_dir)
+    manifest = clients_dir / "manifest.txt"
+    if manifest.exists():
+        with open(manifest) as f:
+            emails = [line.strip() for line in f if line.strip()]
+        identities = [(str(clients_dir / f"{cn}.crt"), str(clients_dir / f"{cn}.key")) for cn in emails]
+    else:
+        identities = [(args.cert, args.key)]
+
+    for cert, key in identities:
+        if not Path(cert).exists() or not Path(key).exists():
+            print(f"Error: Client certificate or key not found: {cert}, {key}")
+            sys.exit(1)
+    return identities
+
+
+class Worker(threading.Thread):
+    """
+    One simulated client: a keep-alive session that sends PATCHes back to back
+    (or every `interval` seconds) until the deadline or its request quota.
+    """
+
+    def __init__(self, args, identity, deadline, quota):
+        super().__init__(daemon=True)
+        self.args = args
+        self.identity = identity
+        self.deadline = deadline
+        self.quota = quota
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+
+    def run(self):
+        session = requests.Session()
+        if self.args.plain:
+            session.headers["X-Subject-CN"] = self.identity
+        else:
+            session.cert = self.identity
+            session.verify = self.args.ca
+
+        sent = 0
+        while time.monotonic() < self.deadline and (self.quota is None or sent < self.quota):
+            start = time.perf_counter()
+            try:
+                response = session.patch(self.args.url, timeout=self.args.timeout)
+                self.latencies.append(time.perf_counter() - start)
+                self.statuses[response.status_code] += 1
+            except requests.RequestException as e:
+                self.errors[type(e).__name__] += 1
+            sent += 1
+            if self.args.interval:
+                time.sleep(self.args.interval)
+        session.close()
+
+
+class UDPCapture:
+    """
+    Counts the broadcasts the server emits during the run, using the batched
+    receive engine from udp_listener.py on a background thread.
+    """
+
+    def __init__(self, port, group=None, interface=None):
+        sys.path.insert(0, str(repo_dir))
+        import udp_listener
+
+        sock = udp_listener.open_socket(port, rcvbuf=4 * 1024 * 1024, group=group, interface=interface,
+                                        reuse_port=True)
+        self.listener = udp_listener.Listener(sock, udp_listener.CounterSink())
+        threading.Thread(target=self.listener.run, daemon=True).start()
+
+    def snapshot(self):
+        return self.listener.packets, self.listener.records, self.listener.lost, self.listener.malformed
+
+
+def run(args):
+    identities = load_identities(args)
+    capture = UDPCapture(args.udp_port, args.udp_group, args.udp_interface) if args.udp_port else None
+
+    quota = None
+    if args.requests:
+        quota = max(args.requests // args.concurrency, 1)
+    deadline = time.monotonic() + (args.duration if not args.requests else 10 ** 9)
+
+    workers = [Worker(args, identities[i % len(identities)], deadline, quota) for i in range(args.concurrency)]
+    print(f"Benchmarking {args.url} with {args.concurrency} clients "
+          f"({len(identities)} identit{'y' if len(identities) == 1 else 'ies'}, "
+          f"{'plain HTTP' if args.plain else 'mTLS'})...", file=sys.stderr)
+
+    udp_before = capture.snapshot() if capture else None
+    started = time.perf_counter()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    if capture:
+        # Give the last broadcasts (queued / write-behind) a moment to arrive
+        time.sleep(args.udp_grace)
+    udp_after = capture.snapshot() if capture else None
+
+    latencies = sorted(latency for worker in workers for latency in worker.latencies)
+    statuses = sum((worker.statuses for worker in workers), Counter())
+    errors = sum((worker.errors for worker in workers), Counter())
+    completed = len(latencies)
+
+    result = {
+        "url": args.url,
+        "clients": args.concurrency,
+        "identities": len(identities),
+        "duration_s": round(elapsed, 3),
+        "requests": completed + sum(errors.values()),
+        "completed": completed,
+        "throughput_rps": round(completed / elapsed, 1) if elapsed else 0.0,
+        "latency_ms": {
+            "p50": round(percentile(latencies, 50) * 1000, 3),
+            "p95": round(percentile(latencies, 95) * 1000, 3),
+            "p99": round(percentile(latencies, 99) * 1000, 3),
+            "max": round(latencies[-1] * 1000, 3) if latencies else 0.0,
+        },
+        "status": {str(code): count for code, count in sorted(statuses.items())},
+        "errors": dict(errors),
+    }
+    if capture:
+        packets, records, lost, malformed = (after - before for after, before in zip(udp_after, udp_before))
+        window = elapsed + args.udp_grace
+        result["udp"] = {
+            "datagrams": packets,
+            "records": records,
+            "lost": lost,
+            "malformed": malformed,
+            "records_per_s": round(records / window, 1) if window else 0.0,
+        }
+    return result
+
+
+def print_report(result):
+    print(f"Target:      {result['url']}")
+    print(f"Clients:     {result['clients']} ({result['identities']} identities)")
+    print(f"Duration:    {result['duration_s']:.2f}s")
+    print(f"Requests:    {result['requests']} ({result['completed']} completed)")
+    print(f"Throughput:  {result['throughput_rps']:.1f} req/s")
+    latency = result["latency_ms"]
+    print(f"Latency:     p50 {latency['p50']:.2f}ms  p95 {latency['p95']:.2f}ms  "
+          f"p99 {latency['p99']:.2f}ms  max {latency['max']:.2f}ms")
+    print("Status codes:")
+    for code, count in result["status"].items():
+        print(f"  {code}: {count}")
+    if result["errors"]:
+        print("Errors:")
+        for name, count in result["errors"].items():
+            print(f"  {name}: {count}")
+    if "udp" in result:
+        udp = result["udp"]
+        print(f"UDP:         {udp['records']} records in {udp['datagrams']} datagrams "
+              f"({udp['records_per_s']:.1f} records/s, lost {udp['lost']}, malformed {udp['malformed']})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="QT Assessment heartbeat load generator")
+    parser.add_argument("--url", default="https://localhost:443/api/client", help="Target URL")
+    parser.add_argument("--concurrency", "-c", type=int, default=10, help="Concurrent clients (default: 10)")
+    parser.add_argument("--duration", "-d", type=float, default=10.0, help="Run time in seconds (default: 10)")
+    parser.add_argument("--requests", "-n", type=int, default=0,
+                        help="Total requests instead of a duration (split across clients)")
+    parser.add_argument("--interval", type=float, default=0.0,
+                        help="Pause between a client's requests in seconds (default: 0, back to back)")
+    parser.add_argument("--timeout", type=float, default=10.0, help="Per-request timeout in seconds")
+    parser.add_argument("--clients-dir", default=str(default_certs_dir / "clients"),
+                        help="Directory of certs minted with `gen_certs.py --clients N`")
+    parser.add_argument("--cert", default=str(default_certs_dir / "client.crt"),
+                        help="Client Certificate (used when --clients-dir has no manifest)")
+    parser.add_argument("--key", default=str(default_certs_dir / "client.key"), help="Client Key")
+    parser.add_argument("--ca", default=str(default_certs_dir / "ca.crt"), help="CA Certificate to verify server")
+    parser.add_argument("--plain", action="store_true",
+                        help="Plain HTTP with an X-Subject-CN header, e.g. against `manage.py runserver`")
+    parser.add_argument("--emails", help="File of CNs (one per line) to cycle through in --plain mode")
+    parser.add_argument("--udp-port", type=int, default=0,
+                        help="Also count the server's UDP broadcasts on this port (e.g. 6667)")
+    parser.add_argument("--udp-group", help="Multicast group to join for --udp-port")
+    parser.add_argument("--udp-interface", help="Local interface address for --udp-group")
+    parser.add_argument("--udp-grace", type=float, default=1.0,
+                        help="Seconds to keep counting broadcasts after the last request (default: 1)")
+    parser.add_argument("--json", action="store_true", help="Print the result as JSON")
+    args = parser.parse_args()
+
+    if args.concurrency < 1:
+        parser.error("--concurrency must be at least 1")
+
+    result = run(args)
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+
+
+if __name__ == "__main__":
+    main()
@@ -14,8 +14,35 @@ def main():
     parser.add_argument("--cert", default=str(default_certs_dir / "client.crt"), help="Client Certificate")
     parser.add_argument("--key", default=str(default_certs_dir / "client.key"), help="Client Key")
     parser.add_argument("--ca", default=str(default_certs_dir / "ca.crt"), help="CA Certificate to verify server")
+
+    daemon_options = parser.add_argument_group("daemon mode")
+    daemon_options.add_argument("--daemon", action="store_true",
+                                help="Keep sending heartbeats over keep-alive connections with TLS session resumption")
+    daemon_options.add_argument("--interval", type=float, default=30.0,
+                                help="Seconds between an identity's heartbeats (default: 30)")
+    daemon_options.add_argument("--jitter", type=float, default=0.1,
+                                help="Randomize each interval by this fraction (default: 0.1)")
+    daemon_options.add_argument("--backoff-base", type=float, default=1.0,
+                                help="First retry delay after a 5xx or connection error, doubled per failure")
+    daemon_options.add_argument("--backoff-max", type=float, default=300.0,
+                                help="Cap on the retry delay in seconds (default: 300)")
+    daemon_options.add_argument("--timeout", type=float, default=10.0, help="Connect/request timeout in seconds")
+    daemon_options.add_argument("--clients-dir",
+                                help="Run every identity listed in <dir>/manifest.txt (from `gen_certs.py --clients N`)")
+    daemon_options.add_argument("--identities", type=int, default=0, help="Only use the first N identities")
+    daemon_options.add_argument("--duration", type=float, default=0.0, help="Stop after N seconds (default: run until Ctrl-C)")
+    daemon_options.add_argument("--count", type=int, default=0, help="Stop each identity after N heartbeats")
+    daemon_options.add_argument("--no-stagger", dest="stagger", action="store_false",
+                                help="Send every identity's first heartbeat at once instead of spread over one interval")
+    daemon_options.add_argument("--no-keepalive", action="store_true", help="Reconnect for every heartbeat")
+    daemon_options.add_argument("--no-resume", action="store_true", help="Never offer a previous TLS session")
+    daemon_options.add_argument("--json", action="store_true", help="Print the exit statistics as JSON")
     args = parser.parse_args()
 
+    if args.daemon:
+        import heartbeat_daemon
+        sys.exit(heartbeat_daemon.run(args))
+
     # Validate paths
     if not os.path.exists(args.cert) or not os.path.exists(args.key):
         print(f"Error: Client certificate or key not found.")
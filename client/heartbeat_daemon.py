@@ -0,0 +1,429 @@
+"""
+Heartbeat daemon for client.py --daemon: sends PATCH /api/client for one or many
+identities from a single asyncio process, every `interval` seconds (+/- jitter),
+with exponential backoff on 5xx responses and connection errors.
+
+Each identity keeps one keep-alive HTTP/1.1 connection. When it has to reconnect
+(idle timeout, error, --no-keepalive), it offers the TLS session of its previous
+connection (TLS 1.2 session ID or TLS 1.3 ticket), so the server can skip the
+certificate exchange and verification. asyncio's SSL transport has no way to pass
+a session, so connections drive an ssl.SSLObject over memory BIOs on a plain TCP
+stream instead.
+
+Standard library only.
+"""
+import asyncio
+import json
+import random
+import signal
+import ssl
+import sys
+import time
+from collections import Counter
+from pathlib import Path
+from urllib.parse import urlsplit
+
+from stats import percentile
+
+READ_SIZE = 65536
+
+
+class TLSConnection:
+    """
+    One HTTP/1.1 connection over TLS, resuming `session` if the server accepts it.
+    """
+
+    def __init__(self, host, port, context, session=None):
+        self.host = host
+        self.port = port
+        self.context = context
+        self.offered_session = session
+        self.requests = 0
+        self._reader = None
+        self._writer = None
+        self._incoming = ssl.MemoryBIO()
+        self._outgoing = ssl.MemoryBIO()
+        self._ssl = None
+        self._buffer = bytearray()
+
+    @property
+    def session(self):
+        return self._ssl.session if self._ssl else None
+
+    @property
+    def session_reused(self):
+        return bool(self._ssl and self._ssl.session_reused)
+
+    async def open(self):
+        """
+        Connects and completes the handshake. Returns the TLS handshake time in seconds.
+        """
+        self._reader, self._writer = await asyncio.open_connection(self.host, self.port)
+        start = time.perf_counter()
+        self._ssl = self.context.wrap_bio(self._incoming, self._outgoing, server_hostname=self.host,
+                                          session=self.offered_session)
+        while True:
+            try:
+                self._ssl.do_handshake()
+                break
+            except ssl.SSLWantReadError:
+                await self._flush()
+                await self._fill()
+        await self._flush()
+        return time.perf_counter() - start
+
+    async def request(self, method, target, headers=()):
+        """
+        Sends a bodyless request. Returns (status, headers, body, keep_alive).
+        """
+        lines = [f"{method} {target} HTTP/1.1", f"Host: {self.host}", "Content-Length: 0"]
+        lines.extend(f"{name}: {value}" for name, value in headers)
+        self._ssl.write(("\r\n".join(lines) + "\r\n\r\n").encode("latin-1"))
+        await self._flush()
+        self.requests += 1
+        return await self._read_response()
+
+    def close(self):
+        if self._writer is None:
+            return
+        try:
+            # Best-effort close_notify; the server's reply is not awaited
+            self._ssl.unwrap()
+        except (ssl.SSLError, AttributeError):
+            pass
+        try:
+            self._writer.write(self._outgoing.read())
+        except Exception:
+            pass
+        self._writer.close()
+        self._writer = None
+
+    async def _flush(self):
+        data = self._outgoing.read()
+        if data:
+            self._writer.write(data)
+            await self._writer.drain()
+
+    async def _fill(self):
+        data = await self._reader.read(READ_SIZE)
+        if not data:
+            raise ConnectionResetError("Connection closed by server")
+        self._incoming.write(data)
+
+    async def _recv(self):
+        while True:
+            try:
+                data = self._ssl.read(READ_SIZE)
+            except ssl.SSLWantReadError:
+                # TLS 1.3 may have post-handshake messages to answer
+                await self._flush()
+                await self._fill()
+                continue
+            except ssl.SSLZeroReturnError:
+                data = b""
+            if not data:
+                raise ConnectionResetError("Connection closed by server")
+            self._buffer += data
+            return
+
+    async def _read_line(self):
+        end = self._buffer.find(b"\r\n")
+        while end < 0:
+            await self._recv()
+            end = self._buffer.find(b"\r\n")
+        line = bytes(self._buffer[:end])
+        del self._buffer[:end + 2]
+        return line
+
+    async def _read_exactly(self, size):
+        while len(self._buffer) < size:
+            await self._recv()
+        data = bytes(self._buffer[:size])
+        del self._buffer[:size]
+        return data
+
+    async def _read_response(self):
+        status_line = await self._read_line()
+        parts = status_line.split(b" ", 2)
+        if len(parts) < 2 or not parts[0].startswith(b"HTTP/1."):
+            raise ValueError(f"Malformed status line: {status_line[:80]!r}")
+        status = int(parts[1])
+
+        headers = {}
+        while True:
+            line = await self._read_line()
+            if not line:
+                break
+            name, _, value = line.decode("latin-1").partition(":")
+            headers[name.strip().lower()] = value.strip()
+
+        keep_alive = headers.get("connection", "").lower() != "close" and parts[0] == b"HTTP/1.1"
+        if status in (204, 304) or 100 <= status < 200:
+            body = b""
+        elif headers.get("transfer-encoding", "").lower() == "chunked":
+            body = await self._read_chunked()
+        elif "content-length" in headers:
+            body = await self._read_exactly(int(headers["content-length"]))
+        else:
+            # Delimited by the server closing the connection
+            body = await self._read_until_close()
+            keep_alive = False
+        return status, headers, body, keep_alive
+
+    async def _read_chunked(self):
+        body = bytearray()
+        while True:
+            size = int((await self._read_line()).split(b";", 1)[0], 16)
+            if not size:
+                break
+            body += await self._read_exactly(size + 2)
+            del body[-2:]
+        while await self._read_line():
+            pass  # Trailers
+        return bytes(body)
+
+    async def _read_until_close(self):
+        try:
+            while True:
+                await self._recv()
+        except ConnectionResetError:
+            pass
+        body = bytes(self._buffer)
+        self._buffer.clear()
+        return body
+
+
+class Stats:
+    def __init__(self):
+        self.latencies = []
+        self.statuses = Counter()
+        self.errors = Counter()
+        self.full_handshakes = []
+        self.resumed_handshakes = []
+        self.offered_sessions = 0
+        self.stale_retries = 0
+
+
+class Heartbeat:
+    """
+    One identity's loop: heartbeat, sleep a jittered interval (or back off), repeat.
+    """
+
+    def __init__(self, args, host, port, target, context, stats):
+        self.args = args
+        self.host = host
+        self.port = port
+        self.target = target
+        self.context = context
+        self.stats = stats
+        self.session = None
+        self.connection = None
+        self.failures = 0
+
+    async def run(self, stop, quota):
+        # Spread the first heartbeats of many identities over one interval
+        if not await self._sleep(stop, random.uniform(0, self.args.interval) if self.args.stagger else 0):
+            return
+        sent = 0
+        while not stop.is_set() and (not quota or sent < quota):
+            retry_after = await self.beat()
+            sent += 1
+            if retry_after is None:
+                self.failures = 0
+                delay = self.args.interval * random.uniform(1 - self.args.jitter, 1 + self.args.jitter)
+            else:
+                self.failures += 1
+                backoff = min(self.args.backoff_max, self.args.backoff_base * 2 ** (self.failures - 1))
+                delay = max(backoff * random.uniform(0.5, 1.0), retry_after)
+            if not await self._sleep(stop, delay):
+                break
+        self._close()
+
+    async def beat(self):
+        """
+        Sends one heartbeat. Returns None on success, or the minimum delay before
+        retrying (0 unless the server sent Retry-After) when the caller should back off.
+        """
+        for attempt in range(2):
+            reused = self.connection is not None
+            try:
+                if self.connection is None:
+                    await asyncio.wait_for(self._connect(), self.args.timeout)
+                start = time.perf_counter()
+                status, headers, _, keep_alive = await asyncio.wait_for(
+                    self.connection.request("PATCH", self.target), self.args.timeout
+                )
+            except (ConnectionError, asyncio.IncompleteReadError) as e:
+                self._close()
+                if reused and attempt == 0:
+                    # The server closed the idle keep-alive connection; a heartbeat is
+                    # idempotent, so resend it once on a fresh (resumed) connection
+                    self.stats.stale_retries += 1
+                    continue
+                self.stats.errors[type(e).__name__] += 1
+                return 0.0
+            except (OSError, ssl.SSLError, asyncio.TimeoutError, ValueError) as e:
+                self._close()
+                self.stats.errors[type(e).__name__] += 1
+                return 0.0
+            break
+
+        self.stats.latencies.append(time.perf_counter() - start)
+        self.stats.statuses[status] += 1
+        # TLS 1.3 tickets arrive after the handshake, so keep the latest session
+        if not self.args.no_resume:
+            self.session = self.connection.session
+        if not keep_alive or self.args.no_keepalive:
+            self._close()
+
+        if status >= 500 or status == 429:
+            try:
+                return float(headers.get("retry-after", 0))
+            except ValueError:
+                return 0.0
+        return None
+
+    async def _connect(self):
+        connection = TLSConnection(self.host, self.port, self.context, self.session)
+        self.connection = connection
+        handshake = await connection.open()
+        if self.session is not None:
+            self.stats.offered_sessions += 1
+        if connection.session_reused:
+            self.stats.resumed_handshakes.append(handshake)
+        else:
+            self.stats.full_handshakes.append(handshake)
+
+    def _close(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    @staticmethod
+    async def _sleep(stop, delay):
+        """
+        Sleeps `delay` seconds or until stopped. Returns False if stopped.
+        """
+        try:
+            await asyncio.wait_for(stop.wait(), delay)
+            return False
+        except asyncio.TimeoutError:
+            return True
+
+
+def load_identities(args):
+    """
+    (cert, key) pairs: every client listed in <clients-dir>/manifest.txt, or --cert/--key.
+    """
+    if args.clients_dir:
+        clients_dir = Path(args.clients_dir)
+        with open(clients_dir / "manifest.txt") as f:
+            names = [line.strip() for line in f if line.strip()]
+        identities = [(str(clients_dir / f"{cn}.crt"), str(clients_dir / f"{cn}.key")) for cn in names]
+    else:
+        identities = [(args.cert, args.key)]
+    if args.identities:
+        identities = identities[:args.identities]
+    for cert, key in identities:
+        if not Path(cert).exists() or not Path(key).exists():
+            print(f"Error: Client certificate or key not found: {cert}, {key}", file=sys.stderr)
+            sys.exit(1)
+    return identities
+
+
+def make_context(args, cert, key):
+    context = ssl.create_default_context(ssl.Purpose.SERVER_AUTH)
+    if Path(args.ca).exists():
+        context.load_verify_locations(args.ca)
+    context.load_cert_chain(cert, key)
+    return context
+
+
+def summarize(seconds):
+    ordered = sorted(seconds)
+    return {
+        "count": len(ordered),
+        "p50": round(percentile(ordered, 50) * 1000, 3),
+        "p95": round(percentile(ordered, 95) * 1000, 3),
+        "p99": round(percentile(ordered, 99) * 1000, 3),
+    }
+
+
+async def run_async(args):
+    url = urlsplit(args.url)
+    if url.scheme != "https":
+        print("Error: --daemon needs an https:// URL", file=sys.stderr)
+        sys.exit(1)
+    host, port = url.hostname, url.port or 443
+    target = (url.path or "/") + (f"?{url.query}" if url.query else "")
+
+    identities = load_identities(args)
+    stats = Stats()
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    if args.duration:
+        loop.call_later(args.duration, stop.set)
+
+    print(f"Sending heartbeats to {args.url} for {len(identities)} "
+          f"identit{'y' if len(identities) == 1 else 'ies'} every {args.interval}s "
+          f"(+/-{args.jitter:.0%}); Ctrl-C to stop...", file=sys.stderr)
+    beats = [Heartbeat(args, host, port, target, make_context(args, cert, key), stats) for cert, key in identities]
+    started = time.perf_counter()
+    await asyncio.gather(*(beat.run(stop, args.count) for beat in beats))
+    elapsed = time.perf_counter() - started
+
+    handshakes = len(stats.full_handshakes) + len(stats.resumed_handshakes)
+    return {
+        "url": args.url,
+        "identities": len(identities),
+        "duration_s": round(elapsed, 3),
+        "requests": len(stats.latencies) + sum(stats.errors.values()),
+        "completed": len(stats.latencies),
+        "latency_ms": summarize(stats.latencies),
+        "status": {str(code): count for code, count in sorted(stats.statuses.items())},
+        "errors": dict(stats.errors),
+        "stale_retries": stats.stale_retries,
+        "handshakes": {
+            "total": handshakes,
+            "full": summarize(stats.full_handshakes),
+            "resumed": summarize(stats.resumed_handshakes),
+            "sessions_offered": stats.offered_sessions,
+            "requests_per_handshake": round(len(stats.latencies) / handshakes, 1) if handshakes else 0.0,
+        },
+    }
+
+
+def print_report(result):
+    print(f"Target:      {result['url']}")
+    print(f"Identities:  {result['identities']}")
+    print(f"Duration:    {result['duration_s']:.2f}s")
+    print(f"Requests:    {result['requests']} ({result['completed']} completed, "
+          f"{result['stale_retries']} resent after an idle close)")
+    latency = result["latency_ms"]
+    print(f"Latency:     p50 {latency['p50']:.2f}ms  p95 {latency['p95']:.2f}ms  p99 {latency['p99']:.2f}ms")
+    handshakes = result["handshakes"]
+    print(f"Handshakes:  {handshakes['total']} ({handshakes['requests_per_handshake']} requests each), "
+          f"{handshakes['resumed']['count']} of {handshakes['sessions_offered']} offered sessions resumed")
+    for kind in ("full", "resumed"):
+        summary = handshakes[kind]
+        if summary["count"]:
+            print(f"  {kind:<8} {summary['count']:>6}  p50 {summary['p50']:.2f}ms  "
+                  f"p95 {summary['p95']:.2f}ms  p99 {summary['p99']:.2f}ms")
+    print("Status codes:")
+    for code, count in result["status"].items():
+        print(f"  {code}: {count}")
+    if result["errors"]:
+        print("Errors:")
+        for name, count in result["errors"].items():
+            print(f"  {name}: {count}")
+
+
+def run(args):
+    result = asyncio.run(run_async(args))
+    if args.json:
+        print(json.dumps(result, indent=2))
+    else:
+        print_report(result)
+    return 0 if result["completed"] else 1
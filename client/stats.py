@@ -0,0 +1,13 @@
+"""
+Statistics helpers shared by bench.py and heartbeat_daemon.py (standard library only).
+"""
+
+
+def percentile(sorted_values, p):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return 0.0
+    rank = max(int(round(p / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
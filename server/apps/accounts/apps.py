@@ -1,12 +1,108 @@
 from django.apps import AppConfig
-import sys
 
 class AccountsConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'apps.accounts'
 
     def ready(self):
-        # Prevent initialization during migrations or management commands that don't need it
-        if 'runserver' in sys.argv or 'gunicorn' in sys.argv[0]:
-            from .broadcaster import broadcaster
-            broadcaster.initialize(bind_port=6666, target_port=6667)
+        from django.conf import settings
+        from . import signals  # noqa: F401  (connects identity cache invalidation)
+        from .metrics import metrics
+        metrics.configure(directory=settings.METRICS_DIR, enabled=settings.METRICS_ENABLED)
+
+        from .identity_cache import identity_cache
+        identity_cache.configure(
+            maxsize=settings.IDENTITY_CACHE_SIZE,
+            ttl=settings.IDENTITY_CACHE_TTL,
+            negative_ttl=settings.IDENTITY_CACHE_NEGATIVE_TTL,
+        )
+
+        from .ratelimit import rate_limiter
+        rate_limiter.configure(
+            backend=settings.RATE_LIMIT_BACKEND,
+            limit=settings.RATE_LIMIT_REQUESTS,
+            window=settings.RATE_LIMIT_WINDOW,
+            shm_path=settings.RATE_LIMIT_SHM_PATH or None,
+            shm_slots=settings.RATE_LIMIT_SHM_SLOTS,
+            redis_url=settings.RATE_LIMIT_REDIS_URL,
+        )
+
+        from .write_behind import write_behind
+        write_behind.configure(
+            flush_interval=settings.WRITE_BEHIND_FLUSH_INTERVAL,
+            batch_size=settings.WRITE_BEHIND_BATCH_SIZE,
+        )
+
+        from .presence_store import presence_store
+        presence_store.configure(
+            backend=settings.PRESENCE_BACKEND,
+            reconcile_interval=settings.PRESENCE_RECONCILE_INTERVAL,
+            batch_size=settings.WRITE_BEHIND_BATCH_SIZE,
+            write_behind=settings.CLIENT_STATE_WRITE_BEHIND,
+            redis_url=settings.PRESENCE_REDIS_URL,
+            redis_prefix=settings.PRESENCE_REDIS_PREFIX,
+        )
+
+        from .presence import presence_index
+        presence_index.configure(
+            sync_interval=settings.PRESENCE_SYNC_INTERVAL,
+            sync_overlap=settings.PRESENCE_SYNC_OVERLAP,
+        )
+
+        from .event_log import event_log
+        event_log.configure(
+            directory=settings.EVENT_LOG_DIR,
+            segment_size=settings.EVENT_LOG_SEGMENT_SIZE,
+            max_segments=settings.EVENT_LOG_MAX_SEGMENTS,
+            flush_interval=settings.EVENT_LOG_FLUSH_INTERVAL,
+            buffer_size=settings.EVENT_LOG_BUFFER_SIZE,
+            fsync=settings.EVENT_LOG_FSYNC,
+            fsync_interval=settings.EVENT_LOG_FSYNC_INTERVAL,
+        )
+
+        from .sweeper import presence_sweeper
+        presence_sweeper.configure(
+            ttl=settings.PRESENCE_OFFLINE_TTL,
+            interval=settings.PRESENCE_SWEEP_INTERVAL,
+            batch_size=settings.PRESENCE_SWEEP_BATCH_SIZE,
+            max_rows=settings.PRESENCE_SWEEP_MAX_ROWS,
+        )
+
+        from .snapshots import snapshot_emitter
+        snapshot_emitter.configure(
+            interval=settings.BROADCAST_SNAPSHOT_INTERVAL,
+            window=settings.BROADCAST_SNAPSHOT_WINDOW,
+            rate=settings.BROADCAST_SNAPSHOT_RATE,
+            source=settings.BROADCAST_SNAPSHOT_SOURCE,
+            lock_path=settings.BROADCAST_SNAPSHOT_LOCK,
+        )
+
+        from .broadcast_policy import broadcast_policy
+        broadcast_policy.configure(
+            min_interval=settings.BROADCAST_MIN_INTERVAL,
+            max_rate=settings.BROADCAST_RATE_LIMIT,
+            burst=settings.BROADCAST_RATE_BURST,
+            table_size=settings.BROADCAST_POLICY_TABLE_SIZE,
+        )
+
+        from .broadcaster import broadcaster
+        broadcaster.configure(
+            use_queue=settings.BROADCAST_QUEUE,
+            queue_size=settings.BROADCAST_QUEUE_SIZE,
+            batch=settings.BROADCAST_BATCH,
+            max_datagram=settings.BROADCAST_MAX_DATAGRAM,
+            wire_version=settings.BROADCAST_WIRE_VERSION,
+        )
+
+        # The socket itself is created lazily in each process (see gunicorn.conf.py),
+        # so migrations and other management commands never bind it.
+        broadcaster.set_endpoint(
+            bind_port=settings.BROADCAST_BIND_PORT,
+            target_port=settings.BROADCAST_TARGET_PORT,
+            mode=settings.BROADCAST_MODE,
+            target_host=settings.BROADCAST_TARGET_HOST or None,
+            multicast_ttl=settings.BROADCAST_MULTICAST_TTL,
+            multicast_loop=settings.BROADCAST_MULTICAST_LOOP,
+            multicast_interface=settings.BROADCAST_MULTICAST_INTERFACE or None,
+            reuse_port=settings.BROADCAST_REUSEPORT,
+        )
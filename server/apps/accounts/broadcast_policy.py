@@ -0,0 +1,105 @@
+import threading
+import time
+
+from .metrics import metrics
+
+
+class BroadcastPolicy:
+    """
+    Decides whether a heartbeat is worth a broadcast, in front of broadcaster.send().
+
+    A change of ip/port is broadcast immediately; an unchanged heartbeat only
+    once every `min_interval` seconds per user. The last broadcast state per
+    user is kept in a per-worker table of (ip, port, sent_at_ns) tuples capped
+    at `table_size` entries (oldest inserted evicted first; an evicted user's
+    next heartbeat is simply broadcast again).
+
+    Optionally a token bucket caps the total at `max_rate` broadcasts per second
+    per worker with bursts of up to `burst`. With BROADCAST_BATCH this bounds
+    records rather than datagrams. A change suppressed by the bucket is not
+    recorded, so the next heartbeat retries it.
+
+    min_interval=0 and max_rate=0 (the defaults) broadcast every heartbeat.
+    """
+
+    def __init__(self, min_interval=0.0, max_rate=0.0, burst=0, table_size=100000):
+        self._lock = threading.Lock()
+        self._table = {}
+        self.allowed = 0
+        self.suppressed_unchanged = 0
+        self.suppressed_rate = 0
+        self.configure(min_interval, max_rate, burst, table_size)
+
+    def configure(self, min_interval=None, max_rate=None, burst=None, table_size=None):
+        with self._lock:
+            if min_interval is not None:
+                self.min_interval_ns = int(min_interval * 1e9)
+            if table_size is not None:
+                self.table_size = max(table_size, 1)
+            if max_rate is not None:
+                self.max_rate = max_rate
+            if burst is not None:
+                self._burst_setting = burst
+            if burst is not None or max_rate is not None:
+                # Burst defaults to one second's worth of broadcasts
+                self.burst = max(self._burst_setting or self.max_rate, 1)
+                self._tokens = self.burst
+                self._refilled_at = time.monotonic()
+            self.enabled = self.min_interval_ns > 0 or self.max_rate > 0
+
+    def allow(self, email, ip, port, now_ns=None):
+        """
+        True if this update should be broadcast (and records it as broadcast).
+        """
+        if not self.enabled:
+            return True
+        now_ns = now_ns or time.time_ns()
+
+        with self._lock:
+            previous = self._table.get(email)
+            if (previous is not None and previous[0] == ip and previous[1] == port
+                    and now_ns - previous[2] < self.min_interval_ns):
+                self.suppressed_unchanged += 1
+                outcome = 'suppressed_unchanged'
+            elif self.max_rate > 0 and not self._take():
+                self.suppressed_rate += 1
+                outcome = 'suppressed_rate'
+            else:
+                if previous is None and len(self._table) >= self.table_size:
+                    del self._table[next(iter(self._table))]
+                self._table[email] = (ip, port, now_ns)
+                self.allowed += 1
+                return True
+
+        metrics.count_broadcast(outcome)
+        return False
+
+    def filter(self, records):
+        """
+        The (email, last_seen_ns, ip, port) records that should be broadcast.
+        """
+        if not self.enabled:
+            return records
+        return [record for record in records if self.allow(record[0], record[2], record[3], record[1])]
+
+    def stats(self):
+        return {
+            'allowed': self.allowed,
+            'suppressed_unchanged': self.suppressed_unchanged,
+            'suppressed_rate': self.suppressed_rate,
+            'tracked_users': len(self._table),
+        }
+
+    def _take(self):
+        # Caller holds the lock.
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._refilled_at) * self.max_rate)
+        self._refilled_at = now
+        if self._tokens >= 1:
+            self._tokens -= 1
+            return True
+        return False
+
+
+# Global instance, configured from settings in AccountsConfig.ready()
+broadcast_policy = BroadcastPolicy()
@@ -1,13 +1,33 @@
+import asyncio
+import atexit
+import collections
+import os
 import socket
-import struct
 import logging
+import threading
+import time
+
+from . import codec
+from .metrics import metrics
 
 logger = logging.getLogger(__name__)
 
+BROADCAST = 'broadcast'
+MULTICAST = 'multicast'
+UNICAST = 'unicast'
+DEFAULT_MULTICAST_GROUP = '239.255.66.67'
+
+
 class UDPBroadcaster:
     """
     Singleton UDP Broadcaster.
     Binds to a fixed port (default 6666) and broadcasts packets to a target port (default 6667).
+    Can also send to a multicast group or a single unicast listener instead.
+
+    By default send() only enqueues the update; a background sender thread drains
+    the queue so the request never waits on the network. When the queue is full
+    the oldest pending update is dropped. With batching enabled, the sender packs
+    as many records as fit in one datagram. Wire formats live in codec.py.
     """
     _instance = None
 
@@ -16,74 +36,382 @@ class UDPBroadcaster:
             cls._instance = super(UDPBroadcaster, cls).__new__(cls)
             cls._instance._sock = None
             cls._instance._initialized = False
+            cls._instance._target = None
+            cls._instance._transport = None
+            cls._instance._transport_loop = None
+
+            cls._instance.use_queue = True
+            cls._instance._encoder = codec.Encoder()
+            cls._instance._offline_encoder = codec.Encoder(version=codec.VERSION_2, batch=True)
+            cls._instance._snapshot_encoder = codec.SnapshotEncoder()
+            cls._instance._send_lock = threading.Lock()
+            cls._instance._queue = collections.deque()
+            cls._instance._queue_size = 10000
+            cls._instance._cond = threading.Condition()
+            cls._instance._sender_pid = None
+
+            cls._instance._endpoint = None
+            cls._instance._endpoint_pid = None
+            cls._instance._init_lock = threading.Lock()
+            os.register_at_fork(after_in_child=cls._instance._after_fork)
+
+            cls._instance.queued = 0
+            cls._instance.sent = 0
+            cls._instance.dropped = 0
+            cls._instance.bytes_sent = 0
+            cls._instance.datagrams_sent = 0
+            cls._instance.send_errors = 0
         return cls._instance
 
-    def initialize(self, bind_port=6666, target_port=6667):
+    def configure(self, use_queue=None, queue_size=None, batch=None, max_datagram=None, wire_version=None):
+        if use_queue is not None:
+            self.use_queue = use_queue
+        if queue_size is not None:
+            self._queue_size = max(queue_size, 1)
+        with self._send_lock:
+            encoder = self._encoder
+            self._encoder = codec.Encoder(
+                version=encoder.version if wire_version is None else wire_version,
+                batch=encoder.batch if batch is None else batch,
+                max_datagram=encoder.max_datagram if max_datagram is None else max_datagram,
+            )
+            self._offline_encoder = codec.Encoder(
+                version=codec.VERSION_2, batch=True, max_datagram=self._encoder.max_datagram,
+            )
+            self._snapshot_encoder = codec.SnapshotEncoder(max_datagram=self._encoder.max_datagram)
+            self._encoder.seq = encoder.seq
+
+    def set_endpoint(self, **options):
+        """
+        Stores the initialize() arguments without opening a socket. Each process
+        then creates its own socket on first use (or in gunicorn's post_fork
+        hook), so the app can be imported in a preloading master safely.
+        """
+        self._endpoint = options
+
+    def ensure_initialized(self):
+        """
+        Creates this process's socket from the stored endpoint if needed.
+        Returns True if the broadcaster can send.
+        """
+        if self._sock is not None:
+            return True
+        if self._endpoint is None:
+            return False
+        with self._init_lock:
+            # One attempt per process, so a bind failure isn't retried on every request
+            if self._sock is None and self._endpoint_pid != os.getpid():
+                self._endpoint_pid = os.getpid()
+                self.initialize(**self._endpoint)
+        return self._sock is not None
+
+    def initialize(self, bind_port=6666, target_port=6667, mode=BROADCAST, target_host=None,
+                   multicast_ttl=1, multicast_loop=True, multicast_interface=None, reuse_port=False):
+        """
+        Creates the sending socket.
+
+        mode is 'broadcast' (255.255.255.255), 'multicast' (target_host is the
+        group) or 'unicast' (target_host is a single listener). bind_port=0 gives
+        every worker its own ephemeral source port; with reuse_port, workers can
+        share a fixed source port through SO_REUSEPORT instead of racing for it.
+        """
         if self._initialized:
             return
 
         self.target_port = target_port
+        self.mode = mode
 
         try:
             self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-            self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
             # Re-use address to avoid conflicts during restarts
             self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            if reuse_port:
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+
+            if mode == MULTICAST:
+                self._target = (target_host or DEFAULT_MULTICAST_GROUP, target_port)
+                self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, multicast_ttl)
+                self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, 1 if multicast_loop else 0)
+                if multicast_interface:
+                    self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(multicast_interface))
+            elif mode == UNICAST:
+                self._target = (target_host, target_port)
+            else:
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+                self._target = ('<broadcast>', target_port)
 
-            # Bind to specific port as requested "Send from port 6666"
+            # Bind to specific port as requested "Send from port 6666" (0 = ephemeral)
             self._sock.bind(('', bind_port))
 
             self._initialized = True
-            logger.info(f"UDP Broadcaster initialized. Bound to {bind_port}, targeting {target_port}")
+            logger.info("UDP Broadcaster initialized (%s). Bound to %d, targeting %s",
+                        mode, self._sock.getsockname()[1], self._target)
         except Exception as e:
-            logger.error(f"Failed to initialize UDP Broadcaster: {e}")
+            logger.error("Failed to initialize UDP Broadcaster: %s", e)
+            if self._sock is not None:
+                self._sock.close()
             self._sock = None
 
     def send(self, email: str, last_seen_ns: int, ip: str, port: int):
         """
         Broadcasts the binary payload.
-        Format (Big Endian):
+        v1 Format (Big Endian):
         - Email Length (1 byte)
         - Email (UTF-8 bytes)
         - Last Seen Nanoseconds (8 bytes / Q)
         - IP Length (1 byte)
-        - IP String (UTF-8 bytes)  <-- Storing as string is simpler than packing 4/16 bytes for IPv4/6 mix
+        - IP String (UTF-8 bytes)
         - Port (2 bytes / H)
+        v2 adds a versioned header with a sequence number and packs the IP as 4/16 raw bytes.
+        """
+        if not self._sock and not self.ensure_initialized():
+            # No endpoint configured (e.g. a management command) or the socket failed; we log.
+            logger.error("UDP Broadcaster not initialized. Skipping broadcast.")
+            metrics.count_broadcast('skipped')
+            return
+
+        start = time.perf_counter_ns()
+        if self.use_queue:
+            self._enqueue((email, last_seen_ns, ip, port))
+        else:
+            # Broadcast to 255.255.255.255 (or the multicast group / unicast target)
+            self._transmit([(email, last_seen_ns, ip, port)])
+            logger.debug("Broadcast sent for %s", email)
+        metrics.observe('broadcast_send', time.perf_counter_ns() - start)
+
+    def send_many(self, records):
+        """
+        Broadcasts many (email, last_seen_ns, ip, port) records in one go: a single
+        enqueue, or one encode-and-send pass (packed per datagram when batching).
+        """
+        if not records:
+            return
+        if not self._sock and not self.ensure_initialized():
+            logger.error("UDP Broadcaster not initialized. Skipping broadcast.")
+            metrics.count_broadcast('skipped', len(records))
+            return
+
+        start = time.perf_counter_ns()
+        if self.use_queue:
+            self._enqueue_many(records)
+        else:
+            self._transmit(records)
+        metrics.observe('broadcast_send', time.perf_counter_ns() - start)
+
+    def send_offline(self, records):
+        """
+        Broadcasts the last known (email, last_seen_ns, ip, port) of users that
+        went offline, as batched v2 TYPE_OFFLINE frames sent on the calling thread
+        (the presence sweeper). Offline frames are always v2, since v1 has no type
+        byte; with BROADCAST_WIRE_VERSION=2 they share the heartbeat sequence numbers.
+        """
+        if not records:
+            return
+        if not self._sock and not self.ensure_initialized():
+            logger.error("UDP Broadcaster not initialized. Skipping broadcast.")
+            metrics.count_broadcast('skipped', len(records))
+            return
+
+        start = time.perf_counter_ns()
+        with self._send_lock:
+            encoder = self._offline_encoder
+            shared_seq = self._encoder.version == codec.VERSION_2
+            if shared_seq:
+                encoder.seq = self._encoder.seq
+            self._send_frames(encoder.frames(records, codec.TYPE_OFFLINE, on_error=self._encode_failed))
+            if shared_seq:
+                self._encoder.seq = encoder.seq
+        metrics.observe('broadcast_send', time.perf_counter_ns() - start)
+
+    def snapshot_chunks(self, records, snapshot_id, since_ns):
+        """
+        Splits records sorted by last_seen_ns into (record_count, body) snapshot
+        chunks sized for this broadcaster's datagrams; see codec.SnapshotEncoder.
+        """
+        return self._snapshot_encoder.chunks(records, snapshot_id, since_ns)
+
+    def send_snapshot(self, record_count, body):
+        """
+        Sends one chunk from snapshot_chunks() as a v2 TYPE_SNAPSHOT frame on the
+        calling thread (the snapshot emitter), numbered in the same sequence as
+        this process's other v2 frames. Returns False if the broadcaster can't send.
+        """
+        if not self._sock and not self.ensure_initialized():
+            return False
+
+        start = time.perf_counter_ns()
+        with self._send_lock:
+            source = self._encoder if self._encoder.version == codec.VERSION_2 else self._offline_encoder
+            encoder = self._snapshot_encoder
+            encoder.seq = source.seq
+            payload = encoder.frame(record_count, body)
+            source.seq = encoder.seq
+            self._send_frames([(payload, record_count)])
+        metrics.observe('broadcast_send', time.perf_counter_ns() - start)
+        return True
+
+    async def asend(self, email: str, last_seen_ns: int, ip: str, port: int):
+        """
+        Same payload as send(), written through an asyncio datagram transport
+        so the event loop never blocks on the socket.
         """
-        if not self._sock:
-            # Try to re-init if not running? Or just log error.
-            # For this assessment, we log.
+        if not self._sock and not self.ensure_initialized():
             logger.error("UDP Broadcaster not initialized. Skipping broadcast.")
+            metrics.count_broadcast('skipped')
+            return
+
+        start = time.perf_counter_ns()
+        if self.use_queue:
+            # Enqueueing never blocks, so the sender thread serves the async path too
+            self._enqueue((email, last_seen_ns, ip, port))
+            metrics.observe('broadcast_send', time.perf_counter_ns() - start)
             return
 
         try:
-            email_bytes = email.encode('utf-8')
-            ip_bytes = ip.encode('utf-8')
-
-            # Struct Format:
-            # B = unsigned char (1 byte)
-            # {len}s = string of length
-            # Q = unsigned long long (8 bytes)
-            # H = unsigned short (2 bytes)
-
-            fmt = f'>B{len(email_bytes)}sQB{len(ip_bytes)}sH'
-
-            payload = struct.pack(
-                fmt,
-                len(email_bytes),
-                email_bytes,
-                last_seen_ns,
-                len(ip_bytes),
-                ip_bytes,
-                port
-            )
+            with self._send_lock:
+                # Copy out of the encoder's reusable buffer; the transport may hold on to it
+                payloads = [bytes(payload) for payload, _ in self._encoder.frames([(email, last_seen_ns, ip, port)])]
+            transport = await self._get_transport()
+            for payload in payloads:
+                transport.sendto(payload, self._async_target())
+                self._count_sent(1, len(payload))
+            logger.debug("Broadcast sent for %s", email)
 
-            # Broadcast to 255.255.255.255
-            self._sock.sendto(payload, ('<broadcast>', self.target_port))
-            logger.debug(f"Broadcast sent for {email}")
+        except Exception as e:
+            self._count_error(1)
+            logger.error("Broadcast failed: %s", e)
+        metrics.observe('broadcast_send', time.perf_counter_ns() - start)
 
+    def flush(self):
+        """
+        Sends everything still queued on the calling thread (used at shutdown).
+        """
+        with self._cond:
+            records = list(self._queue)
+            self._queue.clear()
+        if records:
+            self._transmit(records)
+
+    def stats(self):
+        with self._cond:
+            depth = len(self._queue)
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'dropped': self.dropped,
+            'bytes_sent': self.bytes_sent,
+            'datagrams_sent': self.datagrams_sent,
+            'send_errors': self.send_errors,
+            'queue_depth': depth,
+        }
+
+    def _after_fork(self):
+        # A socket or lock inherited from the parent is not this worker's to use
+        if self._sock is not None:
+            self._sock.close()
+        self._sock = None
+        self._initialized = False
+        self._transport = None
+        self._transport_loop = None
+        self._endpoint_pid = None
+        self._init_lock = threading.Lock()
+        self._send_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._queue.clear()
+
+    def _enqueue(self, record):
+        self._enqueue_many((record,))
+
+    def _enqueue_many(self, records):
+        self._ensure_sender()
+        dropped = 0
+        with self._cond:
+            for record in records:
+                if len(self._queue) >= self._queue_size:
+                    # Drop-oldest: the newest state for a client is the one worth sending
+                    self._queue.popleft()
+                    dropped += 1
+                self._queue.append(record)
+            self.dropped += dropped
+            self.queued += len(records)
+            self._cond.notify()
+        metrics.count_broadcast('queued', len(records))
+        if dropped:
+            metrics.count_broadcast('dropped', dropped)
+
+    def _ensure_sender(self):
+        # Started lazily in each process, so it survives gunicorn's fork.
+        if self._sender_pid == os.getpid():
+            return
+        with self._cond:
+            if self._sender_pid == os.getpid():
+                return
+            self._sender_pid = os.getpid()
+            threading.Thread(target=self._run_sender, name='udp-broadcaster', daemon=True).start()
+            atexit.register(self.flush)
+
+    def _run_sender(self):
+        while True:
+            with self._cond:
+                while not self._queue:
+                    self._cond.wait()
+                records = list(self._queue)
+                self._queue.clear()
+            self._transmit(records)
+
+    def _transmit(self, records):
+        # The encoder reuses one buffer, so encoding and sending happen under one lock
+        with self._send_lock:
+            self._send_frames(self._encoder.frames(records, on_error=self._encode_failed))
+
+    def _send_frames(self, frames):
+        # Caller holds _send_lock. Records that can't be encoded are skipped by the
+        # encoder (_encode_failed), so one bad record never costs the rest of the batch.
+        try:
+            for payload, count in frames:
+                try:
+                    self._sendto(payload, count)
+                except Exception as e:
+                    self._count_error(count)
+                    logger.error("Broadcast failed: %s", e)
         except Exception as e:
-            logger.error(f"Broadcast failed: {e}")
+            # Not a bad record; keep the sender thread alive
+            self._count_error(1)
+            logger.error("Broadcast encoding failed: %s", e)
+
+    def _encode_failed(self, record, error):
+        self._count_error(1)
+        logger.error("Broadcast skipped an unencodable record %r: %s", record, error)
+
+    def _sendto(self, payload, record_count):
+        self._sock.sendto(payload, self._target)
+        self._count_sent(record_count, len(payload))
+
+    def _count_sent(self, record_count, size):
+        self.sent += record_count
+        self.datagrams_sent += 1
+        self.bytes_sent += size
+        metrics.count_broadcast('sent', record_count)
+
+    def _count_error(self, record_count):
+        self.send_errors += 1
+        metrics.count_broadcast('error', record_count)
+
+    def _async_target(self):
+        # Some event loops (uvloop) don't resolve '<broadcast>', so use the literal address
+        if self._target[0] == '<broadcast>':
+            return ('255.255.255.255', self._target[1])
+        return self._target
+
+    async def _get_transport(self):
+        loop = asyncio.get_running_loop()
+        if self._transport is None or self._transport_loop is not loop or self._transport.is_closing():
+            # A dup of the bound socket keeps the source port; the transport makes it non-blocking.
+            self._transport, _ = await loop.create_datagram_endpoint(
+                asyncio.DatagramProtocol, sock=self._sock.dup()
+            )
+            self._transport_loop = loop
+        return self._transport
 
 # Global instance
 broadcaster = UDPBroadcaster()
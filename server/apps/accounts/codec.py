@@ -0,0 +1,487 @@
+"""
+Wire codec for the UDP presence broadcast, shared by the server and udp_listener.py.
+
+Pure standard library (no Django imports) so the listener can use it standalone.
+
+v1 single record (legacy, Big Endian):
+    email_len B | email | last_seen_ns Q | ip_len B | ip (UTF-8 text) | port H
+
+Every other frame starts with a zero byte, which can never begin a v1 record
+(emails are never empty), followed by a version byte:
+
+v1 batch:
+    0 B | 1 B | count B | count x v1 record
+
+v2:
+    0 B | 2 B | type B | seq I | count B | count x v2 record
+    v2 record: email_len B | email | last_seen_ns Q | ip_len B (0, 4 or 16) | ip (raw) | port H
+
+`seq` increments per v2 frame and wraps at 2**32 so receivers can count lost datagrams.
+`type` is TYPE_UPDATE for heartbeats and TYPE_OFFLINE for users the presence
+sweeper has expired (their last known state). Only v2 can carry TYPE_OFFLINE.
+
+TYPE_SNAPSHOT frames carry one chunk of a periodic snapshot of everyone online
+(snapshots.py) and have their own body after the v2 header:
+    snapshot_id I | chunk I | flags B (SNAPSHOT_LAST) | since_ns Q | base_ns Q | zlib(records)
+    record: varint delta_ns | email_len B | email | ip_len B | ip (raw) | varint port
+Records are sorted by last_seen_ns; each stores the (unsigned LEB128 varint)
+difference to the previous one, the first to base_ns. The header's count is the
+number of records in the chunk.
+
+A bare run of v2 records (no header) is also the binary body of api/client/batch.
+"""
+import ipaddress
+import socket
+import struct
+import zlib
+from collections import namedtuple
+
+FRAME_MARKER = 0
+VERSION_1 = 1
+VERSION_2 = 2
+
+# v2 frame types
+TYPE_UPDATE = 1
+TYPE_OFFLINE = 2
+TYPE_SNAPSHOT = 3
+
+TYPE_NAMES = {TYPE_UPDATE: 'update', TYPE_OFFLINE: 'offline', TYPE_SNAPSHOT: 'snapshot'}
+
+MAX_FRAME_RECORDS = 255
+SEQ_MODULO = 1 << 32
+# What a record with an out-of-range or mistyped field raises while being encoded
+ENCODE_ERRORS = (struct.error, ValueError, TypeError, AttributeError, OverflowError)
+
+U8 = struct.Struct('>B')
+V1_BATCH_HEADER = struct.Struct('>BBB')
+V2_HEADER = struct.Struct('>BBBIB')
+LAST_SEEN_AND_LEN = struct.Struct('>QB')
+PORT = struct.Struct('>H')
+SNAPSHOT_HEADER = struct.Struct('>IIBQQ')
+
+SNAPSHOT_LAST = 0x01
+# Decompressed size cap for one snapshot chunk, so a bad datagram can't cost much
+MAX_SNAPSHOT_BODY = 65536
+
+# Smallest valid datagram: a v1 record with a 1 byte email and a 1 byte IP
+MIN_PACKET_SIZE = 14
+
+Frame = namedtuple('Frame', ['version', 'type', 'seq', 'records', 'snapshot'], defaults=(None,))
+# Position of a TYPE_SNAPSHOT frame in its snapshot
+Snapshot = namedtuple('Snapshot', ['id', 'chunk', 'last', 'since_ns'])
+
+
+def pack_ip(ip):
+    """
+    Returns the 4 or 16 raw bytes of an IP address, or b'' if it isn't one.
+    """
+    if not ip:
+        return b''
+    # inet_pton is several times faster than ipaddress on this hot path
+    try:
+        return socket.inet_pton(socket.AF_INET6 if ':' in ip else socket.AF_INET, ip)
+    except (OSError, ValueError):
+        pass
+    try:
+        # Forms inet_pton rejects, e.g. scoped IPv6 (fe80::1%eth0)
+        return ipaddress.ip_address(ip).packed
+    except ValueError:
+        return b''
+
+
+def unpack_ip(raw):
+    if not raw:
+        return ''
+    return str(ipaddress.ip_address(bytes(raw)))
+
+
+def encode_v1(email, last_seen_ns, ip, port):
+    email_bytes = email.encode('utf-8')
+    ip_bytes = ip.encode('utf-8')
+    return b''.join((
+        U8.pack(len(email_bytes)), email_bytes,
+        LAST_SEEN_AND_LEN.pack(last_seen_ns, len(ip_bytes)), ip_bytes,
+        PORT.pack(port),
+    ))
+
+
+class Encoder:
+    """
+    Turns records into datagrams for one wire version.
+
+    v2 frames are packed into a single reusable bytearray, so each payload
+    yielded by frames() is a memoryview that is only valid until the next
+    iteration; send it (or copy it) before advancing. Not thread-safe.
+
+    A record that can't be encoded (e.g. a port over 65535 or an email over 255
+    bytes) raises, unless frames() is given `on_error`: then it is called with
+    the record and the exception, the record is skipped and the rest are sent.
+    """
+
+    def __init__(self, version=VERSION_1, batch=False, max_datagram=1472):
+        self.version = version
+        self.batch = batch
+        self.max_datagram = max_datagram
+        self.seq = 0
+        self._buf = bytearray(max(max_datagram, 512))
+        self._view = memoryview(self._buf)
+
+    def frames(self, records, record_type=TYPE_UPDATE, on_error=None):
+        """
+        Yields (payload, record_count) for an iterable of
+        (email, last_seen_ns, ip, port) records.
+        """
+        if self.version == VERSION_2:
+            yield from self._frames_v2(records, record_type, on_error)
+        elif self.batch:
+            yield from self._frames_v1_batch(records, on_error)
+        else:
+            for record in records:
+                encoded = _encode_or_skip(encode_v1, record, on_error)
+                if encoded is not None:
+                    yield encoded, 1
+
+    def _frames_v1_batch(self, records, on_error):
+        body = []
+        size = V1_BATCH_HEADER.size
+        for record in records:
+            encoded = _encode_or_skip(encode_v1, record, on_error)
+            if encoded is None:
+                continue
+            if body and (size + len(encoded) > self.max_datagram or len(body) == MAX_FRAME_RECORDS):
+                yield V1_BATCH_HEADER.pack(FRAME_MARKER, VERSION_1, len(body)) + b''.join(body), len(body)
+                body = []
+                size = V1_BATCH_HEADER.size
+            body.append(encoded)
+            size += len(encoded)
+        if body:
+            yield V1_BATCH_HEADER.pack(FRAME_MARKER, VERSION_1, len(body)) + b''.join(body), len(body)
+
+    def _frames_v2(self, records, record_type, on_error):
+        buf = self._buf
+        limit = self.max_datagram if self.batch else len(buf)
+        per_frame = MAX_FRAME_RECORDS if self.batch else 1
+        offset = V2_HEADER.size
+        count = 0
+
+        for record in records:
+            try:
+                email, last_seen_ns, ip, port = record
+                email_bytes = email.encode('utf-8')
+                ip_bytes = pack_ip(ip)
+            except ENCODE_ERRORS as e:
+                _skip(record, e, on_error)
+                continue
+            size = 1 + len(email_bytes) + LAST_SEEN_AND_LEN.size + len(ip_bytes) + PORT.size
+
+            if count and (offset + size > limit or count == per_frame):
+                yield self._finish_v2(record_type, offset, count), count
+                offset = V2_HEADER.size
+                count = 0
+
+            # Packed at `end` and only committed once the whole record fits the
+            # Structs, so a bad record leaves the frame as it was
+            try:
+                end = offset
+                U8.pack_into(buf, end, len(email_bytes))
+                end += 1
+                buf[end:end + len(email_bytes)] = email_bytes
+                end += len(email_bytes)
+                LAST_SEEN_AND_LEN.pack_into(buf, end, last_seen_ns, len(ip_bytes))
+                end += LAST_SEEN_AND_LEN.size
+                buf[end:end + len(ip_bytes)] = ip_bytes
+                end += len(ip_bytes)
+                PORT.pack_into(buf, end, port)
+                end += PORT.size
+            except ENCODE_ERRORS as e:
+                _skip(record, e, on_error)
+                continue
+            offset = end
+            count += 1
+
+        if count:
+            yield self._finish_v2(record_type, offset, count), count
+
+    def _finish_v2(self, record_type, length, count):
+        V2_HEADER.pack_into(self._buf, 0, FRAME_MARKER, VERSION_2, record_type, self.seq, count)
+        self.seq = (self.seq + 1) % SEQ_MODULO
+        return self._view[:length]
+
+
+def _encode_or_skip(encode, record, on_error):
+    try:
+        return encode(*record)
+    except ENCODE_ERRORS as e:
+        _skip(record, e, on_error)
+        return None
+
+
+def _skip(record, error, on_error):
+    if on_error is None:
+        raise error
+    on_error(record, error)
+
+
+class SnapshotEncoder:
+    """
+    Packs records sorted by last_seen_ns into compressed TYPE_SNAPSHOT chunks
+    that fit `max_datagram` once framed.
+
+    How many records fit is only known after compressing, so each chunk is sized
+    from the compression ratio of the previous ones and trimmed (the surplus
+    carries over to the next chunk) in the rare case it comes out too large.
+    Not thread-safe.
+    """
+
+    def __init__(self, max_datagram=1472, level=6):
+        self.max_datagram = max_datagram
+        self.level = level
+        self.seq = 0
+        self._budget = max(max_datagram, 512) - V2_HEADER.size - SNAPSHOT_HEADER.size
+        self._ratio = 3.0
+
+    def chunks(self, records, snapshot_id, since_ns):
+        """
+        Yields (record_count, body) per chunk of a snapshot of `records`; pass
+        each to frame() to send it. The last chunk is flagged SNAPSHOT_LAST, and
+        an empty snapshot is a single empty chunk, so receivers can tell it ended.
+        """
+        records = iter(records)
+        pending = []
+        index = 0
+        previous = self._next_chunk(records, pending)
+        while True:
+            current = self._next_chunk(records, pending) if previous else None
+            count, base_ns, compressed = previous or (0, 0, zlib.compress(b'', self.level))
+            flags = 0 if current else SNAPSHOT_LAST
+            yield count, SNAPSHOT_HEADER.pack(snapshot_id, index, flags, since_ns, base_ns) + compressed
+            if not current:
+                return
+            previous = current
+            index += 1
+
+    def frame(self, record_count, body):
+        """
+        Prepends the v2 header with the next sequence number.
+        """
+        header = V2_HEADER.pack(FRAME_MARKER, VERSION_2, TYPE_SNAPSHOT, self.seq, record_count)
+        self.seq = (self.seq + 1) % SEQ_MODULO
+        return header + body
+
+    def _next_chunk(self, records, pending):
+        # Returns (count, base_ns, compressed) or None once `records` and `pending` are exhausted.
+        # `pending` holds trimmed records in reverse order.
+        target = self._budget * self._ratio
+        taken = []
+        size = 0
+        while size < target and len(taken) < MAX_FRAME_RECORDS:
+            record = pending.pop() if pending else next(records, None)
+            if record is None:
+                break
+            taken.append(record)
+            # Close enough to the encoded size for sizing purposes
+            size += len(record[0]) + 16
+        if not taken:
+            return None
+
+        while True:
+            raw = _encode_snapshot_records(taken)
+            compressed = zlib.compress(raw, self.level)
+            if len(compressed) <= self._budget or len(taken) == 1:
+                break
+            keep = max(min(int(len(taken) * self._budget / len(compressed) * 0.95), len(taken) - 1), 1)
+            pending.extend(reversed(taken[keep:]))
+            del taken[keep:]
+        # Aim a little under the observed ratio so trimming stays rare
+        self._ratio = 0.7 * self._ratio + 0.3 * 0.95 * len(raw) / len(compressed)
+        return len(taken), taken[0][1], compressed
+
+
+def _encode_snapshot_records(records):
+    out = bytearray()
+    previous = records[0][1]
+    for email, last_seen_ns, ip, port in records:
+        _write_varint(out, last_seen_ns - previous)
+        previous = last_seen_ns
+        email_bytes = email.encode('utf-8')
+        ip_bytes = pack_ip(ip)
+        out.append(len(email_bytes))
+        out += email_bytes
+        out.append(len(ip_bytes))
+        out += ip_bytes
+        _write_varint(out, port)
+    return bytes(out)
+
+
+def _write_varint(out, value):
+    if value < 0:
+        raise ValueError("Snapshot records must be sorted by last_seen_ns")
+    while value > 0x7F:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+        if shift > 63:
+            raise ValueError("Varint too long")
+
+
+def _decode_snapshot(data, count):
+    if len(data) < SNAPSHOT_HEADER.size:
+        raise ValueError("Truncated snapshot header")
+    snapshot_id, chunk, flags, since_ns, base_ns = SNAPSHOT_HEADER.unpack_from(data, 0)
+    try:
+        inflater = zlib.decompressobj()
+        raw = inflater.decompress(bytes(data[SNAPSHOT_HEADER.size:]), MAX_SNAPSHOT_BODY)
+    except zlib.error as e:
+        raise ValueError(f"Bad snapshot compression: {e}")
+    if inflater.unconsumed_tail:
+        raise ValueError("Snapshot chunk too large")
+
+    records = []
+    offset = 0
+    last_seen_ns = base_ns
+    for _ in range(count):
+        delta, offset = _read_varint(raw, offset)
+        last_seen_ns += delta
+        email_len = raw[offset]
+        offset += 1
+        email = raw[offset:offset + email_len].decode('utf-8')
+        offset += email_len
+        ip_len = raw[offset]
+        if ip_len not in (0, 4, 16):
+            raise ValueError("Bad IP length")
+        offset += 1
+        ip = unpack_ip(raw[offset:offset + ip_len])
+        offset += ip_len
+        port, offset = _read_varint(raw, offset)
+        records.append((email, last_seen_ns, ip, port))
+    if offset != len(raw):
+        raise ValueError("Snapshot record count mismatch")
+    return records, Snapshot(snapshot_id, chunk, bool(flags & SNAPSHOT_LAST), since_ns)
+
+
+def decode(data):
+    """
+    Decodes any supported datagram into a Frame. Raises ValueError if malformed.
+    """
+    if len(data) < 3:
+        raise ValueError("Packet too short")
+
+    if data[0] != FRAME_MARKER:
+        record, offset = _decode_v1_record(data, 0)
+        return Frame(VERSION_1, TYPE_UPDATE, None, [record])
+
+    version = data[1]
+    if version == VERSION_1:
+        _, _, count = V1_BATCH_HEADER.unpack_from(data, 0)
+        offset = V1_BATCH_HEADER.size
+        records = []
+        for _ in range(count):
+            record, offset = _decode_v1_record(data, offset)
+            records.append(record)
+        return Frame(VERSION_1, TYPE_UPDATE, None, records)
+
+    if version == VERSION_2:
+        if len(data) < V2_HEADER.size:
+            raise ValueError("Truncated v2 header")
+        _, _, record_type, seq, count = V2_HEADER.unpack_from(data, 0)
+        if record_type == TYPE_SNAPSHOT:
+            records, snapshot = _decode_snapshot(data[V2_HEADER.size:], count)
+            return Frame(VERSION_2, record_type, seq, records, snapshot)
+        offset = V2_HEADER.size
+        records = []
+        for _ in range(count):
+            record, offset = _decode_v2_record(data, offset)
+            records.append(record)
+        return Frame(VERSION_2, record_type, seq, records)
+
+    raise ValueError(f"Unknown frame version {version}")
+
+
+def decode_records(data):
+    """
+    Decodes a bare run of v2 records (no frame header), as sent by gateways to
+    api/client/batch. Raises ValueError if malformed.
+    """
+    records = []
+    offset = 0
+    while offset < len(data):
+        record, offset = _decode_v2_record(data, offset)
+        records.append(record)
+    return records
+
+
+def encode_records(records):
+    """
+    Encodes (email, last_seen_ns, ip, port) records as a bare run of v2 records.
+    """
+    parts = []
+    for email, last_seen_ns, ip, port in records:
+        email_bytes = email.encode('utf-8')
+        ip_bytes = pack_ip(ip)
+        parts.append(b''.join((
+            U8.pack(len(email_bytes)), email_bytes,
+            LAST_SEEN_AND_LEN.pack(last_seen_ns, len(ip_bytes)), ip_bytes,
+            PORT.pack(port),
+        )))
+    return b''.join(parts)
+
+
+def seq_gap(previous, seq):
+    """
+    Number of frames missing between two consecutive sequence numbers (0 if in order).
+    A jump backwards (reordering, or a restarted sender) is not counted as loss.
+    """
+    gap = (seq - previous - 1) % SEQ_MODULO
+    return 0 if gap >= SEQ_MODULO // 2 else gap
+
+
+def _decode_v1_record(data, offset):
+    email_len = data[offset]
+    offset += 1
+    end = offset + email_len
+    if len(data) < end + LAST_SEEN_AND_LEN.size:
+        raise ValueError("Email length mismatch")
+    email = bytes(data[offset:end]).decode('utf-8')
+
+    last_seen_ns, ip_len = LAST_SEEN_AND_LEN.unpack_from(data, end)
+    offset = end + LAST_SEEN_AND_LEN.size
+    end = offset + ip_len
+    if len(data) < end + PORT.size:
+        raise ValueError("IP length mismatch")
+    ip = bytes(data[offset:end]).decode('utf-8')
+
+    port = PORT.unpack_from(data, end)[0]
+    return (email, last_seen_ns, ip, port), end + PORT.size
+
+
+def _decode_v2_record(data, offset):
+    email_len = data[offset]
+    offset += 1
+    end = offset + email_len
+    if len(data) < end + LAST_SEEN_AND_LEN.size:
+        raise ValueError("Email length mismatch")
+    email = bytes(data[offset:end]).decode('utf-8')
+
+    last_seen_ns, ip_len = LAST_SEEN_AND_LEN.unpack_from(data, end)
+    if ip_len not in (0, 4, 16):
+        raise ValueError("Bad IP length")
+    offset = end + LAST_SEEN_AND_LEN.size
+    end = offset + ip_len
+    if len(data) < end + PORT.size:
+        raise ValueError("IP length mismatch")
+    ip = unpack_ip(data[offset:end])
+
+    port = PORT.unpack_from(data, end)[0]
+    return (email, last_seen_ns, ip, port), end + PORT.size
@@ -0,0 +1,154 @@
+import socket
+import sys
+from array import array
+
+# ip_kind values
+NO_IP = 0
+IPV4 = 4
+IPV6 = 6
+
+
+class UserDirectory:
+    """
+    Compact in-process table of (email, last_seen_ns, ip, port) for millions of users.
+
+    Each email is interned and mapped to a dense integer id; the other fields live
+    in typed `array` columns indexed by that id (int64 last_seen_ns, int32 port as
+    in the DB, IPv4 packed into a uint32). The rare IPv6 address is kept in a side
+    dict of its 16 packed bytes. Per user this costs one dict entry plus ~25 bytes
+    of columns, instead of a model instance or a tuple of boxed ints and strings
+    (`manage.py bench_directory` measures both).
+
+    Not thread-safe: callers serialize writes (PresenceIndex holds its lock).
+    """
+    __slots__ = ('_ids', '_emails', '_last_seen', '_ports', '_ipv4', '_ip_kind', '_ipv6')
+
+    def __init__(self):
+        self._ids = {}
+        self._emails = []
+        self._last_seen = array('q')
+        self._ports = array('i')
+        self._ipv4 = array('I')
+        self._ip_kind = array('B')
+        self._ipv6 = {}
+
+    def __len__(self):
+        return len(self._emails)
+
+    def __contains__(self, email):
+        return email in self._ids
+
+    def id_of(self, email):
+        return self._ids.get(email)
+
+    def email_of(self, user_id):
+        return self._emails[user_id]
+
+    def get(self, email):
+        """
+        Returns (last_seen_ns, ip_address, port) or None.
+        """
+        user_id = self._ids.get(email)
+        if user_id is None:
+            return None
+        return self._last_seen[user_id], self._ip(user_id), self._ports[user_id]
+
+    def last_seen(self, email):
+        user_id = self._ids.get(email)
+        return None if user_id is None else self._last_seen[user_id]
+
+    def set(self, email, last_seen_ns, ip_address, port):
+        """
+        Stores the state for `email` (adding it if new). Returns its id.
+        """
+        user_id = self._ids.get(email)
+        if user_id is None:
+            return self._add(email, last_seen_ns, ip_address, port)
+        self._last_seen[user_id] = last_seen_ns
+        self._ports[user_id] = port
+        self._set_ip(user_id, ip_address)
+        return user_id
+
+    def update(self, email, last_seen_ns, ip_address, port):
+        """
+        Like set(), but only if newer than the stored state. Returns True if applied.
+        """
+        user_id = self._ids.get(email)
+        if user_id is None:
+            self._add(email, last_seen_ns, ip_address, port)
+            return True
+        if self._last_seen[user_id] >= last_seen_ns:
+            return False
+        self._last_seen[user_id] = last_seen_ns
+        self._ports[user_id] = port
+        self._set_ip(user_id, ip_address)
+        return True
+
+    def load(self, rows):
+        """
+        Applies (email, last_seen_ns, ip_address, port) rows, e.g. a streaming
+        `.values_list(...).iterator()` over accounts.User. Returns the number applied.
+        """
+        applied = 0
+        for email, last_seen_ns, ip_address, port in rows:
+            if self.update(email, last_seen_ns, ip_address, port):
+                applied += 1
+        return applied
+
+    def items(self):
+        """
+        Yields (email, (last_seen_ns, ip_address, port)) in id order.
+        """
+        for user_id, email in enumerate(self._emails):
+            yield email, (self._last_seen[user_id], self._ip(user_id), self._ports[user_id])
+
+    def nbytes(self):
+        """
+        Approximate memory held by the directory (containers, columns and emails).
+        """
+        size = sys.getsizeof(self._ids) + sys.getsizeof(self._emails) + sys.getsizeof(self._ipv6)
+        size += sum(sys.getsizeof(column) for column in
+                    (self._last_seen, self._ports, self._ipv4, self._ip_kind))
+        size += sum(sys.getsizeof(email) for email in self._emails)
+        size += sum(sys.getsizeof(packed) for packed in self._ipv6.values())
+        # Boxed ids (small ints are shared)
+        size += max(len(self._emails) - 256, 0) * sys.getsizeof(2 ** 20)
+        return size
+
+    def _add(self, email, last_seen_ns, ip_address, port):
+        user_id = len(self._emails)
+        email = sys.intern(email)
+        self._ids[email] = user_id
+        self._emails.append(email)
+        self._last_seen.append(last_seen_ns)
+        self._ports.append(port)
+        self._ipv4.append(0)
+        self._ip_kind.append(NO_IP)
+        self._set_ip(user_id, ip_address)
+        return user_id
+
+    def _set_ip(self, user_id, ip_address):
+        if ip_address:
+            try:
+                self._ipv4[user_id] = int.from_bytes(socket.inet_pton(socket.AF_INET, ip_address), 'big')
+                kind = IPV4
+            except OSError:
+                try:
+                    self._ipv6[user_id] = socket.inet_pton(socket.AF_INET6, ip_address)
+                    self._ip_kind[user_id] = IPV6
+                    return
+                except OSError:
+                    kind = NO_IP
+        else:
+            kind = NO_IP
+        self._ip_kind[user_id] = kind
+        if self._ipv6:
+            self._ipv6.pop(user_id, None)
+
+    def _ip(self, user_id):
+        kind = self._ip_kind[user_id]
+        if kind == IPV4:
+            return socket.inet_ntoa(self._ipv4[user_id].to_bytes(4, 'big'))
+        if kind == IPV6:
+            return socket.inet_ntop(socket.AF_INET6, self._ipv6[user_id])
+        return None
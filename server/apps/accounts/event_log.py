@@ -0,0 +1,336 @@
+"""
+Durable, append-only log of client state changes, for consumers that missed
+UDP broadcasts (`udp_listener.py --replay`).
+
+The log is a directory of segment files named after the global byte offset of
+their first block (`00000000000000000000.seg`, ...), shared by every worker on
+the host. A segment is a run of blocks:
+
+    magic 4s | length I | crc32 I | max_last_seen_ns Q | length bytes of v2 records
+
+The records are the v2 wire records of UDPBroadcaster.send (codec.encode_records).
+A block is one group commit: appends are buffered in memory and written by a
+background thread every `flush_interval` seconds (or once `buffer_size` bytes are
+pending) as a single O_APPEND write under an flock on the directory, which also
+serializes segment rotation and retention between workers. `fsync` is 'always'
+(after every block), 'interval' (at most every `fsync_interval` seconds) or
+'never' (left to the OS).
+
+A block's offset (segment base + position) is stable, so readers can resume from
+it. Readers skip blocks with a bad checksum by scanning for the next magic, and
+stop at a torn block at the end of the newest segment.
+
+Pure standard library (no Django imports) so udp_listener.py can read the log.
+"""
+import atexit
+import fcntl
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+
+from . import codec
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'QTEL'
+BLOCK_HEADER = struct.Struct('>4sIIQ')
+SEGMENT_SUFFIX = '.seg'
+LOCK_FILE = '.lock'
+
+FSYNC_ALWAYS = 'always'
+FSYNC_INTERVAL = 'interval'
+FSYNC_NEVER = 'never'
+
+
+def segments(directory):
+    """
+    Sorted (base_offset, path) of the segments in `directory`.
+    """
+    found = []
+    for name in os.listdir(directory):
+        if name.endswith(SEGMENT_SUFFIX) and name[:-len(SEGMENT_SUFFIX)].isdigit():
+            found.append((int(name[:-len(SEGMENT_SUFFIX)]), os.path.join(directory, name)))
+    return sorted(found)
+
+
+def segment_path(directory, base):
+    return os.path.join(directory, f'{base:020d}{SEGMENT_SUFFIX}')
+
+
+def encode_block(payload, max_ns):
+    return BLOCK_HEADER.pack(MAGIC, len(payload), zlib.crc32(payload), max_ns) + payload
+
+
+class EventLog:
+    """
+    Writer side. Disabled (append() is a no-op) until configured with a directory.
+    The flush thread is started lazily in each process, like the write-behind flusher.
+    """
+
+    def __init__(self):
+        self.directory = None
+        self.segment_size = 64 * 1024 * 1024
+        self.max_segments = 0
+        self.flush_interval = 0.05
+        self.buffer_size = 1024 * 1024
+        self.fsync = FSYNC_INTERVAL
+        self.fsync_interval = 1.0
+
+        self._buffer = bytearray()
+        self._max_ns = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._pid = None
+        self._fd = None
+        self._fd_path = None
+        self._lock_fd = None
+        self._synced_at = 0.0
+        self.blocks_written = 0
+        self.bytes_written = 0
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def enabled(self):
+        return self.directory is not None
+
+    def configure(self, directory=None, segment_size=None, max_segments=None, flush_interval=None,
+                  buffer_size=None, fsync=None, fsync_interval=None):
+        if fsync is not None and fsync not in (FSYNC_ALWAYS, FSYNC_INTERVAL, FSYNC_NEVER):
+            raise ValueError(f"Unknown event log fsync policy '{fsync}'")
+        if directory is not None:
+            # '' disables the log
+            with self._write_lock:
+                self._close()
+                self.directory = directory or None
+                if self.directory:
+                    os.makedirs(self.directory, exist_ok=True)
+        if segment_size is not None:
+            self.segment_size = max(segment_size, 4096)
+        if max_segments is not None:
+            self.max_segments = max(max_segments, 0)
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if buffer_size is not None:
+            self.buffer_size = max(buffer_size, 1)
+        if fsync is not None:
+            self.fsync = fsync
+        if fsync_interval is not None:
+            self.fsync_interval = fsync_interval
+
+    def append(self, records):
+        """
+        Buffers (email, last_seen_ns, ip, port) records for the next group commit.
+        """
+        if self.directory is None or not records:
+            return
+        payload = codec.encode_records(records)
+        max_ns = max(record[1] for record in records)
+        with self._lock:
+            self._buffer += payload
+            if max_ns > self._max_ns:
+                self._max_ns = max_ns
+            pending = len(self._buffer)
+
+        self._ensure_started()
+        if pending >= 4 * self.buffer_size:
+            # The flusher is falling behind (slow disk): write on this thread instead of growing
+            self.flush()
+        elif pending >= self.buffer_size:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes everything buffered as one block. Returns the number of bytes written.
+        """
+        # Taking the buffer under the write lock keeps this process's blocks in order
+        with self._write_lock:
+            with self._lock:
+                if not self._buffer:
+                    return 0
+                payload, max_ns = bytes(self._buffer), self._max_ns
+                self._buffer.clear()
+                self._max_ns = 0
+            if self.directory is None:
+                return 0
+
+            block = encode_block(payload, max_ns)
+            fcntl.flock(self._get_lock_fd(), fcntl.LOCK_EX)
+            try:
+                fd = self._current_segment()
+                os.write(fd, block)
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+            now = time.monotonic()
+            if self.fsync == FSYNC_ALWAYS or (self.fsync == FSYNC_INTERVAL
+                                              and now - self._synced_at >= self.fsync_interval):
+                os.fsync(fd)
+                self._synced_at = now
+            self.blocks_written += 1
+            self.bytes_written += len(block)
+        return len(block)
+
+    def _current_segment(self):
+        # Caller holds _write_lock and the directory flock.
+        existing = segments(self.directory)
+        if not existing:
+            base, path = 0, segment_path(self.directory, 0)
+        else:
+            base, path = existing[-1]
+
+        if path != self._fd_path:
+            self._close_segment()
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._fd_path = path
+
+        size = os.fstat(self._fd).st_size
+        if size >= self.segment_size:
+            self._close_segment()
+            path = segment_path(self.directory, base + size)
+            self._fd = os.open(path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._fd_path = path
+            existing.append((base + size, path))
+            if self.max_segments and len(existing) > self.max_segments:
+                for _, old in existing[:-self.max_segments]:
+                    os.remove(old)
+        return self._fd
+
+    def _get_lock_fd(self):
+        if self._lock_fd is None:
+            self._lock_fd = os.open(os.path.join(self.directory, LOCK_FILE), os.O_RDWR | os.O_CREAT, 0o644)
+        return self._lock_fd
+
+    def _close_segment(self):
+        if self._fd is not None:
+            if self.fsync != FSYNC_NEVER:
+                os.fsync(self._fd)
+            os.close(self._fd)
+        self._fd = None
+        self._fd_path = None
+
+    def _close(self):
+        self._close_segment()
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+            self._lock_fd = None
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='event-log-flush', daemon=True).start()
+            atexit.register(self._flush_at_exit)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            start = time.perf_counter_ns()
+            try:
+                if self.flush():
+                    metrics.observe('event_log_flush', time.perf_counter_ns() - start)
+            except Exception as e:
+                logger.error("Event log flush failed: %s", e)
+
+    def _flush_at_exit(self):
+        try:
+            self.flush()
+            with self._write_lock:
+                self._close()
+        except Exception as e:
+            logger.error("Event log final flush failed: %s", e)
+
+    def _after_fork(self):
+        # Descriptors are shared with the parent; this process opens its own
+        self._fd = None
+        self._fd_path = None
+        self._lock_fd = None
+        self._buffer = bytearray()
+        self._max_ns = 0
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()
+
+
+def read(directory, offset=0, since_ns=None):
+    """
+    Yields (offset, next_offset, records) for every block at or after the global
+    byte `offset`, reading the segments through mmap. With `since_ns`, whole
+    blocks older than it are skipped from their header and only records with
+    last_seen_ns >= since_ns are returned. Resume a later read from next_offset.
+    """
+    found = segments(directory)
+    if not found:
+        return
+
+    first = 0
+    for index, (base, _) in enumerate(found):
+        if base <= offset:
+            first = index
+    if since_ns is not None:
+        # Blocks are nearly ordered (flush delays overlap by a few ms across workers);
+        # start one segment before the first one that begins after since_ns.
+        for index in range(first, len(found)):
+            head = _first_block_max_ns(found[index][1])
+            if head is not None and head >= since_ns:
+                break
+            first = index
+
+    for index in range(first, len(found)):
+        base, path = found[index]
+        start = max(offset - base, 0)
+        newest = index == len(found) - 1
+        yield from _read_segment(base, path, start, since_ns, newest)
+
+
+def _first_block_max_ns(path):
+    with open(path, 'rb') as f:
+        header = f.read(BLOCK_HEADER.size)
+    if len(header) < BLOCK_HEADER.size or header[:4] != MAGIC:
+        return None
+    return BLOCK_HEADER.unpack(header)[3]
+
+
+def _read_segment(base, path, position, since_ns, newest):
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= position:
+            return
+        with mmap.mmap(f.fileno(), size, access=mmap.ACCESS_READ) as mapped:
+            data = memoryview(mapped)
+            try:
+                while position + BLOCK_HEADER.size <= size:
+                    magic, length, crc, max_ns = BLOCK_HEADER.unpack_from(data, position)
+                    end = position + BLOCK_HEADER.size + length
+                    if magic != MAGIC or end > size or zlib.crc32(data[position + BLOCK_HEADER.size:end]) != crc:
+                        if newest and end > size and magic == MAGIC:
+                            # Torn (or still being written) tail of the live segment
+                            return
+                        logger.warning("Event log: bad block at offset %d, resyncing", base + position)
+                        found = mapped.find(MAGIC, position + 1)
+                        if found < 0:
+                            return
+                        position = found
+                        continue
+
+                    if since_ns is None or max_ns >= since_ns:
+                        records = codec.decode_records(data[position + BLOCK_HEADER.size:end])
+                        if since_ns is not None:
+                            records = [record for record in records if record[1] >= since_ns]
+                        if records:
+                            yield base + position, base + end, records
+                    position = end
+            finally:
+                data.release()
+
+
+# Global instance, configured from settings in AccountsConfig.ready()
+event_log = EventLog()
@@ -0,0 +1,157 @@
+"""
+Fast path for the heartbeat: PATCH /api/client answered without Django's
+request stack (URL resolution, middleware chain, HttpRequest, view dispatch).
+
+The WSGI and ASGI apps here wrap the Django application and read
+X-Subject-CN, X-Real-IP and X-Real-Port straight from the environ / scope.
+They reuse the same pieces as ClientUpdateView: the rate limiter, the identity
+cache lookup (identify), identity_error() for the status codes, and
+ClientService for persistence and the broadcast. Anything else falls through
+to Django. Enabled with FASTPATH=True (see wsgi.py / asgi.py).
+
+request_started / request_finished are still sent, so database connections
+are managed exactly as for a Django request.
+"""
+import logging
+import time
+
+from django.core import signals
+
+from .identity_cache import VALID
+from .metrics import metrics
+from .middleware import MTLS_ERRORS, aidentify, identify
+from .ratelimit import rate_limiter
+from .views import INVALID_PORT, ClientService, identity_error, parse_port
+
+logger = logging.getLogger(__name__)
+
+PATH = '/api/client'
+METHOD = 'PATCH'
+
+_REASONS = {204: 'No Content', 400: 'Bad Request', 401: 'Unauthorized', 403: 'Forbidden',
+            429: 'Too Many Requests', 500: 'Internal Server Error'}
+
+
+def handle_heartbeat(cn, ip_address, port):
+    """
+    Runs one heartbeat. Returns (status, body, extra headers).
+    """
+    if cn:
+        retry_after = rate_limiter.check(cn)
+        if retry_after:
+            return 429, b'Too Many Requests', [('Retry-After', str(retry_after))]
+        outcome, user = identify(cn)
+    else:
+        outcome, user = None, None
+
+    error = identity_error(cn, MTLS_ERRORS.get(outcome), outcome == VALID and user is not None)
+    if error:
+        return error[0], error[1].encode(), []
+    if port is None:
+        return 400, INVALID_PORT.encode(), []
+
+    ClientService.update_client_state(user, ip_address, port)
+    return 204, b'', []
+
+
+async def ahandle_heartbeat(cn, ip_address, port):
+    """
+    Async counterpart of handle_heartbeat().
+    """
+    if cn:
+        retry_after = rate_limiter.check(cn)
+        if retry_after:
+            return 429, b'Too Many Requests', [('Retry-After', str(retry_after))]
+        outcome, user = await aidentify(cn)
+    else:
+        outcome, user = None, None
+
+    error = identity_error(cn, MTLS_ERRORS.get(outcome), outcome == VALID and user is not None)
+    if error:
+        return error[0], error[1].encode(), []
+    if port is None:
+        return 400, INVALID_PORT.encode(), []
+
+    await ClientService.aupdate_client_state(user, ip_address, port)
+    return 204, b'', []
+
+
+def _headers(body, extra):
+    headers = [('Content-Length', str(len(body)))]
+    if body:
+        headers.append(('Content-Type', 'text/html; charset=utf-8'))
+    return headers + extra
+
+
+class FastPathWSGI:
+    def __init__(self, application):
+        self.application = application
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') != PATH or environ.get('REQUEST_METHOD') != METHOD:
+            return self.application(environ, start_response)
+
+        start = time.perf_counter_ns()
+        signals.request_started.send(sender=self.__class__, environ=environ)
+        try:
+            status, body, extra = handle_heartbeat(
+                environ.get('HTTP_X_SUBJECT_CN'),
+                environ.get('HTTP_X_REAL_IP', environ.get('REMOTE_ADDR')),
+                parse_port(environ.get('HTTP_X_REAL_PORT', '0')),
+            )
+        except Exception:
+            logger.exception("Fast path heartbeat failed")
+            status, body, extra = 500, b'', []
+        finally:
+            signals.request_finished.send(sender=self.__class__)
+
+        start_response(f'{status} {_REASONS.get(status, "")}', _headers(body, extra))
+        metrics.observe('request', time.perf_counter_ns() - start)
+        metrics.count_status(status)
+        return [body]
+
+
+class FastPathASGI:
+    def __init__(self, application):
+        self.application = application
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] != 'http' or scope['path'] != PATH or scope['method'] != METHOD:
+            return await self.application(scope, receive, send)
+
+        start = time.perf_counter_ns()
+        # The heartbeat has no body, but drain it so the server can reuse the connection
+        message = {'more_body': True}
+        while message.get('more_body'):
+            message = await receive()
+            if message['type'] == 'http.disconnect':
+                return
+
+        headers = {}
+        for name, value in scope['headers']:
+            if name in (b'x-subject-cn', b'x-real-ip', b'x-real-port'):
+                headers[name] = value.decode('latin-1')
+        client = scope.get('client')
+
+        await signals.request_started.asend(sender=self.__class__, scope=scope)
+        try:
+            status, body, extra = await ahandle_heartbeat(
+                headers.get(b'x-subject-cn'),
+                headers.get(b'x-real-ip', client[0] if client else None),
+                parse_port(headers.get(b'x-real-port', '0')),
+            )
+        except Exception:
+            logger.exception("Fast path heartbeat failed")
+            status, body, extra = 500, b'', []
+        finally:
+            await signals.request_finished.asend(sender=self.__class__)
+
+        await send({
+            'type': 'http.response.start',
+            'status': status,
+            'headers': [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                        for name, value in _headers(body, extra)],
+        })
+        await send({'type': 'http.response.body', 'body': body})
+        metrics.observe('request', time.perf_counter_ns() - start)
+        metrics.count_status(status)
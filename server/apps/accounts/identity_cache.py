@@ -0,0 +1,141 @@
+import copy
+import threading
+import time
+from collections import OrderedDict
+
+from .metrics import metrics
+
+# Outcomes of resolving an X-Subject-CN header to a user.
+VALID = 'valid'
+INVALID_CN = 'invalid_cn'
+NOT_FOUND = 'not_found'
+
+
+class IdentityCache:
+    """
+    Per-worker bounded LRU cache mapping a certificate CN to its resolved identity.
+
+    Positive entries hold a loaded User instance; negative entries remember that
+    the CN was not a valid email or that no matching user exists. Entries expire
+    after a TTL (negative entries use their own, usually shorter, TTL) and are
+    dropped explicitly when the underlying User row is saved or deleted.
+
+    Invalidation is process-local: a user created in another worker becomes
+    visible here once the negative entry expires.
+
+    Hits, misses and removed entries are counted in stats() and in /metrics.
+    """
+
+    def __init__(self, maxsize=10000, ttl=300.0, negative_ttl=30.0):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def configure(self, maxsize=None, ttl=None, negative_ttl=None):
+        with self._lock:
+            if maxsize is not None:
+                self.maxsize = maxsize
+            if ttl is not None:
+                self.ttl = ttl
+            if negative_ttl is not None:
+                self.negative_ttl = negative_ttl
+            evicted = self._shrink()
+        metrics.count_identity_cache('evicted', evicted)
+
+    def get(self, cn):
+        """
+        Returns (outcome, user) for a cached CN, or None on a miss.
+        The user is a private copy, so callers may mutate it freely.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(cn)
+            expired = entry is not None and entry[2] <= now
+            if expired:
+                del self._entries[cn]
+            if entry is None or expired:
+                self.misses += 1
+            else:
+                self._entries.move_to_end(cn)
+                self.hits += 1
+
+        if entry is None or expired:
+            metrics.count_identity_cache('miss')
+            if expired:
+                metrics.count_identity_cache('expired')
+            return None
+        metrics.count_identity_cache('hit')
+
+        outcome, user, _ = entry
+        if user is not None:
+            user = copy.copy(user)
+        return outcome, user
+
+    def set(self, cn, outcome, user=None):
+        if self.maxsize <= 0:
+            return
+        ttl = self.ttl if outcome == VALID else self.negative_ttl
+        if ttl <= 0:
+            return
+        if user is not None:
+            user = copy.copy(user)
+
+        expires_at = time.monotonic() + ttl
+        with self._lock:
+            self._entries[cn] = (outcome, user, expires_at)
+            self._entries.move_to_end(cn)
+            evicted = self._shrink()
+        metrics.count_identity_cache('evicted', evicted)
+
+    def invalidate(self, cn):
+        with self._lock:
+            if self._entries.pop(cn, None) is None:
+                return
+            self.invalidations += 1
+        metrics.count_identity_cache('invalidated')
+
+    def invalidate_user(self, user):
+        """
+        Drops every entry for this user, including any cached under a previous email.
+        """
+        with self._lock:
+            stale = [cn for cn, (_, cached, _) in self._entries.items()
+                     if cn == user.email or (cached is not None and cached.pk == user.pk)]
+            for cn in stale:
+                del self._entries[cn]
+            self.invalidations += len(stale)
+        metrics.count_identity_cache('invalidated', len(stale))
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'maxsize': self.maxsize,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def _shrink(self):
+        # Caller holds the lock. Returns the number of entries evicted.
+        evicted = 0
+        while len(self._entries) > max(self.maxsize, 0):
+            self._entries.popitem(last=False)
+            evicted += 1
+        self.evictions += evicted
+        return evicted
+
+
+# Global instance, sized from settings in AccountsConfig.ready()
+identity_cache = IdentityCache()
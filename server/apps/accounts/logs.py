@@ -0,0 +1,223 @@
+"""
+Logging pipeline used by settings.LOGGING.
+
+QueueingHandler puts records on a bounded in-memory queue; a background thread
+formats and writes them in batches, so request threads never block on (or pay
+to format for) stdout. When the queue is full, records are dropped and counted.
+JSONFormatter writes one compact JSON object per line, including `extra=` fields.
+DedupFilter rate-limits repeated warnings and errors (e.g. a broadcaster that is
+not initialized logging once per request) and reports how many were suppressed.
+
+Loggers should use lazy %-style arguments (`logger.debug("Sent for %s", email)`),
+so nothing is formatted for records that are filtered out, and so DedupFilter
+sees the same message template for every repeat.
+
+Pure standard library (no Django imports): it is loaded while settings are applied.
+"""
+import atexit
+import json
+import logging
+import os
+import sys
+import threading
+import time
+from collections import deque
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+class JSONFormatter(logging.Formatter):
+    """
+    {"ts": "...Z", "level": "ERROR", "logger": "...", "msg": "...", ...} per line.
+    """
+
+    def format(self, record):
+        entry = {
+            'ts': time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(record.created)) + f'.{int(record.msecs):03d}Z',
+            'level': record.levelname,
+            'logger': record.name,
+            'msg': record.getMessage(),
+        }
+        for key, value in record.__dict__.items():
+            if key not in _RECORD_ATTRIBUTES:
+                entry[key] = value
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = self.formatException(record.exc_info)
+            entry['exc'] = record.exc_text
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, separators=(',', ':'), ensure_ascii=False, default=str)
+
+
+class TextFormatter(logging.Formatter):
+    """
+    The default text format, plus the suppressed count set by DedupFilter.
+    """
+
+    def format(self, record):
+        text = super().format(record)
+        suppressed = getattr(record, 'suppressed', 0)
+        if suppressed:
+            text += f' ({suppressed} similar suppressed)'
+        return text
+
+
+class DedupFilter(logging.Filter):
+    """
+    Lets at most `burst` records per `window` seconds through for each message
+    template (logger, level, source line and unformatted msg) at or above `level`.
+    The first record let through after a suppressed run carries
+    `record.suppressed`, the number dropped since the last one. Lower levels
+    always pass. `window` <= 0 disables the filter.
+    """
+
+    def __init__(self, window=60.0, burst=5, level=logging.WARNING, max_keys=1024):
+        super().__init__()
+        self.window = window
+        self.burst = max(burst, 1)
+        self.level = logging._checkLevel(level)
+        self.max_keys = max_keys
+        # key -> [window start, records passed, records suppressed]
+        self._state = {}
+        self._lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def filter(self, record):
+        if record.levelno < self.level or self.window <= 0:
+            return True
+        msg = record.msg if isinstance(record.msg, str) else None
+        key = (record.name, record.levelno, record.pathname, record.lineno, msg)
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state else 0
+                if state is None and len(self._state) >= self.max_keys:
+                    self._evict(now)
+                self._state[key] = [now, 1, 0]
+            elif state[1] < self.burst:
+                state[1] += 1
+                suppressed = 0
+            else:
+                state[2] += 1
+                return False
+        if suppressed:
+            record.suppressed = suppressed
+        return True
+
+    def _evict(self, now):
+        # Caller holds _lock. Expired windows first, then the oldest keys.
+        for key in [key for key, state in self._state.items() if now - state[0] >= self.window]:
+            del self._state[key]
+        while len(self._state) >= self.max_keys:
+            del self._state[next(iter(self._state))]
+
+    def _after_fork(self):
+        self._lock = threading.Lock()
+
+
+class QueueingHandler(logging.Handler):
+    """
+    Writes to `stream` (stderr by default) from a background thread. Logging
+    threads run the filters and append the record to a deque (no lock, no
+    formatting, no wakeup); every `flush_interval` seconds, or once half of
+    `queue_size` records are pending, the writer formats everything pending and
+    writes it in one call. Beyond `queue_size` pending records, new ones are
+    dropped and counted. The thread is started lazily in each process, like the
+    other background workers, and what is pending is written at exit.
+    """
+
+    def __init__(self, stream=None, queue_size=10000, flush_interval=0.1):
+        super().__init__()
+        self.stream = stream or sys.stderr
+        self.queue_size = max(queue_size, 1)
+        self.flush_interval = flush_interval
+        self.dropped = 0
+        self._reported_dropped = 0
+        self._pending = deque()
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        atexit.register(self.flush)
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def handle(self, record):
+        # Handler.handle would take the handler lock; the deque doesn't need it
+        rv = self.filter(record)
+        if rv:
+            self.emit(record if rv is True else rv)
+        return rv
+
+    def emit(self, record):
+        pending = len(self._pending)
+        if pending >= self.queue_size:
+            self.dropped += 1
+            return
+        self._pending.append(record)
+        if self._pid != os.getpid():
+            self._ensure_started()
+        if pending + 1 >= self.queue_size // 2:
+            self._wakeup.set()
+
+    def flush(self):
+        """
+        Writes everything pending on the calling thread. Returns the number of records.
+        """
+        with self._write_lock:
+            records = []
+            try:
+                while True:
+                    records.append(self._pending.popleft())
+            except IndexError:
+                pass
+            dropped = self.dropped - self._reported_dropped
+            if dropped:
+                self._reported_dropped += dropped
+                records.append(logging.makeLogRecord({
+                    'name': __name__, 'levelno': logging.WARNING, 'levelname': 'WARNING',
+                    'msg': 'Log queue full, dropped %d records', 'args': (dropped,),
+                }))
+            if not records:
+                return 0
+
+            lines = []
+            for record in records:
+                try:
+                    lines.append(self.format(record))
+                except Exception:
+                    self.handleError(record)
+            try:
+                self.stream.write('\n'.join(lines) + '\n')
+                self.stream.flush()
+            except Exception:
+                self.handleError(records[-1])
+        return len(records)
+
+    def close(self):
+        atexit.unregister(self.flush)
+        self.flush()
+        super().close()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='log-writer', daemon=True).start()
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            self.flush()
+
+    def _after_fork(self):
+        # The parent writes its own pending records; this process starts its own writer
+        self._pending = deque()
+        self._wakeup = threading.Event()
+        self._write_lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pid = None
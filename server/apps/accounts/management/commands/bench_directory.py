@@ -0,0 +1,156 @@
+import gc
+import random
+import time
+import tracemalloc
+
+from django.core.management.base import BaseCommand
+
+from apps.accounts.directory import UserDirectory
+from apps.accounts.models import User
+from apps.accounts.presence import PresenceIndex
+
+
+class Command(BaseCommand):
+    help = ("Compares memory per user and lookup/update throughput of the compact "
+            "UserDirectory, and of the whole PresenceIndex built on it, against a "
+            "dict of User instances and a dict of tuples")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', '-n', type=int, default=200000)
+        parser.add_argument('--operations', type=int, default=200000, help="Lookups and updates timed per structure")
+        parser.add_argument('--from-db', action='store_true',
+                            help="Load the directory and the presence index from accounts.User with a "
+                                 "streaming .iterator() instead")
+
+    def handle(self, *args, **options):
+        if options['from_db']:
+            self._from_db()
+            return
+
+        count = options['users']
+        now = time.time_ns()
+        # Emails are created up front and shared, so the figures exclude them; every
+        # structure gets fresh ints and IP strings per row, as a database load would
+        emails = [f'device-{i:08d}@qt-test.com' for i in range(count)]
+
+        results = []
+        for name, build, lookup, update in (
+            ('model instances', self._build_models, self._lookup_model, self._update_model),
+            ('dict of tuples', self._build_tuples, self._lookup_tuple, self._update_tuple),
+            ('UserDirectory', self._build_directory, self._lookup_directory, self._update_directory),
+            # The directory plus the one-second buckets online()/page() walk
+            ('PresenceIndex', self._build_index, self._lookup_index, self._update_index),
+        ):
+            gc.collect()
+            tracemalloc.start()
+            structure = build(self._rows(emails, now))
+            size = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+
+            probes = [random.choice(emails) for _ in range(options['operations'])]
+            start = time.perf_counter()
+            for email in probes:
+                lookup(structure, email)
+            lookups = len(probes) / (time.perf_counter() - start)
+
+            start = time.perf_counter()
+            for i, email in enumerate(probes):
+                update(structure, email, now + i, '192.168.1.10', 40000)
+            updates = len(probes) / (time.perf_counter() - start)
+
+            results.append((name, size / count, lookups, updates))
+            del structure
+
+        self.stdout.write(f"{count} users, {options['operations']} operations each (bytes exclude the emails)\n")
+        self.stdout.write(f"{'structure':<18}{'bytes/user':>12}{'lookups/s':>14}{'updates/s':>14}")
+        for name, per_user, lookups, updates in results:
+            self.stdout.write(f"{name:<18}{per_user:>12.0f}{lookups:>14.0f}{updates:>14.0f}")
+        baseline = results[0][1]
+        self.stdout.write(self.style.SUCCESS(
+            f"UserDirectory uses {baseline / results[2][1]:.1f}x and the full PresenceIndex "
+            f"{baseline / results[3][1]:.1f}x less memory than model instances"
+        ))
+
+    @staticmethod
+    def _rows(emails, now):
+        # 100 users per second, so the presence index holds a realistic number of buckets
+        for i, email in enumerate(emails):
+            yield email, now - i * 10_000_000, f'10.{i >> 16 & 255}.{i >> 8 & 255}.{i & 255}', 1024 + i % 60000
+
+    def _from_db(self):
+        directory = UserDirectory()
+        start = time.perf_counter()
+        loaded = directory.load(User.objects.values_list('email', 'last_seen_ns', 'ip_address', 'port')
+                                .iterator(chunk_size=2000))
+        elapsed = time.perf_counter() - start
+        per_user = directory.nbytes() / max(len(directory), 1)
+        self.stdout.write(f"Loaded {loaded} users in {elapsed:.2f}s ({per_user:.0f} bytes/user incl. emails)")
+
+        gc.collect()
+        tracemalloc.start()
+        index = self._build_index(User.objects.values_list('email', 'last_seen_ns', 'ip_address', 'port')
+                                  .iterator(chunk_size=2000))
+        size = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        self.stdout.write(f"Presence index with buckets: {size / max(len(index), 1):.0f} bytes/user incl. emails")
+
+    # Structures under test
+
+    @staticmethod
+    def _build_models(rows):
+        return {email: User(email=email, last_seen_ns=last_seen_ns, ip_address=ip, port=port)
+                for email, last_seen_ns, ip, port in rows}
+
+    @staticmethod
+    def _lookup_model(users, email):
+        user = users[email]
+        return user.last_seen_ns, user.ip_address, user.port
+
+    @staticmethod
+    def _update_model(users, email, last_seen_ns, ip, port):
+        user = users[email]
+        user.last_seen_ns = last_seen_ns
+        user.ip_address = ip
+        user.port = port
+
+    @staticmethod
+    def _build_tuples(rows):
+        return {email: (last_seen_ns, ip, port) for email, last_seen_ns, ip, port in rows}
+
+    @staticmethod
+    def _lookup_tuple(states, email):
+        return states[email]
+
+    @staticmethod
+    def _update_tuple(states, email, last_seen_ns, ip, port):
+        states[email] = (last_seen_ns, ip, port)
+
+    @staticmethod
+    def _build_directory(rows):
+        directory = UserDirectory()
+        for row in rows:
+            directory.set(*row)
+        return directory
+
+    @staticmethod
+    def _lookup_directory(directory, email):
+        return directory.get(email)
+
+    @staticmethod
+    def _update_directory(directory, email, last_seen_ns, ip, port):
+        directory.update(email, last_seen_ns, ip, port)
+
+    @staticmethod
+    def _build_index(rows):
+        index = PresenceIndex()
+        for row in rows:
+            index.update(*row)
+        return index
+
+    @staticmethod
+    def _lookup_index(index, email):
+        return index.get(email)
+
+    @staticmethod
+    def _update_index(index, email, last_seen_ns, ip, port):
+        index.update(email, last_seen_ns, ip, port)
@@ -0,0 +1,79 @@
+import io
+import time
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+
+from apps.accounts.fastpath import FastPathWSGI
+from apps.accounts.presence_store import presence_store
+
+
+class Command(BaseCommand):
+    help = ("Compares in-process requests/sec of PATCH /api/client through the stock "
+            "Django WSGI handler and through the fast path")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', '-n', type=int, default=5000)
+        parser.add_argument('--cn', default='valid_user@qt-test.com', help="X-Subject-CN to send")
+        parser.add_argument('--backend', default=None,
+                            help="Presence backend for the run (e.g. 'memory' to leave the database out)")
+        parser.add_argument('--broadcast', action='store_true',
+                            help="Send X-Real-IP so heartbeats are broadcast (initialize the broadcaster first)")
+
+    def handle(self, *args, **options):
+        if options['backend']:
+            presence_store.configure(backend=options['backend'], reconcile_interval=3600)
+
+        environ = {
+            'REQUEST_METHOD': 'PATCH',
+            'PATH_INFO': '/api/client',
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '8000',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '',
+            'HTTP_HOST': 'localhost',
+            'HTTP_X_SUBJECT_CN': options['cn'],
+            'HTTP_X_REAL_PORT': '40000',
+            'CONTENT_LENGTH': '0',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if options['broadcast']:
+            environ['HTTP_X_REAL_IP'] = '127.0.0.1'
+
+        stock = WSGIHandler()
+        results = {}
+        for name, app in (('django', stock), ('fastpath', FastPathWSGI(stock))):
+            statuses = {}
+            # Warm up (identity cache, connections), then measure
+            self._run(app, environ, 50, statuses)
+            statuses.clear()
+            start = time.perf_counter()
+            self._run(app, environ, options['requests'], statuses)
+            elapsed = time.perf_counter() - start
+            results[name] = options['requests'] / elapsed
+            self.stdout.write(f"{name:>9}: {results[name]:10.0f} req/s  "
+                              f"({elapsed / options['requests'] * 1e6:.1f} us/req, status {statuses})")
+
+        self.stdout.write(self.style.SUCCESS(f"fastpath speedup: {results['fastpath'] / results['django']:.2f}x"))
+
+    @staticmethod
+    def _run(app, environ, count, statuses):
+        def start_response(status, headers):
+            code = status.split(' ', 1)[0]
+            statuses[code] = statuses.get(code, 0) + 1
+
+        for _ in range(count):
+            request_environ = dict(environ)
+            request_environ['wsgi.input'] = io.BytesIO(b'')
+            response = app(request_environ, start_response)
+            for _ in response:
+                pass
+            if hasattr(response, 'close'):
+                response.close()
@@ -0,0 +1,141 @@
+import io
+import logging
+import tempfile
+import time
+
+from django.core.handlers.wsgi import WSGIHandler
+from django.core.management.base import BaseCommand
+
+from apps.accounts.logs import DedupFilter, JSONFormatter, QueueingHandler
+
+
+class Command(BaseCommand):
+    help = ("Measures the request-path cost of logging: PATCH /api/client with an unknown CN "
+            "(one django.request warning per 403) with logging off, through a synchronous "
+            "StreamHandler, and through the queued JSON pipeline with and without deduplication")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', '-n', type=int, default=5000)
+        parser.add_argument('--cn', default='nobody@qt-test.com', help="X-Subject-CN to send (unknown -> 403)")
+        parser.add_argument('--rounds', type=int, default=3)
+        parser.add_argument('--output', help="File the handlers write to (default: a temporary file)")
+
+    def handle(self, *args, **options):
+        environ = {
+            'REQUEST_METHOD': 'PATCH',
+            'PATH_INFO': '/api/client',
+            'SCRIPT_NAME': '',
+            'QUERY_STRING': '',
+            'SERVER_NAME': 'localhost',
+            'SERVER_PORT': '8000',
+            'SERVER_PROTOCOL': 'HTTP/1.1',
+            'REMOTE_ADDR': '',
+            'HTTP_HOST': 'localhost',
+            'HTTP_X_SUBJECT_CN': options['cn'],
+            'CONTENT_LENGTH': '0',
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': 'http',
+            'wsgi.errors': io.StringIO(),
+            'wsgi.multithread': False,
+            'wsgi.multiprocess': False,
+            'wsgi.run_once': False,
+        }
+        if options['output']:
+            stream = open(options['output'], 'a')
+        else:
+            stream = tempfile.TemporaryFile('w+')
+
+        root = logging.getLogger()
+        saved = root.handlers[:]
+        app = WSGIHandler()
+        count = options['requests']
+        modes = ('off', 'sync text', 'queue json', 'queue json+dedup')
+        handlers = {name: self._handler(name, stream) for name in modes}
+        request_logger = logging.getLogger('django.request')
+        # name -> [best wall us/req, best request-thread CPU us/req, best us/log call, bytes, statuses, dropped]
+        results = {}
+        try:
+            # Interleaved rounds, best of each, to keep other load on the host out of the figures
+            for _ in range(options['rounds']):
+                for name in modes:
+                    handler = handlers[name]
+                    root.handlers = [handler] if handler else []
+                    logging.disable(logging.CRITICAL if handler is None else logging.NOTSET)
+
+                    statuses = {}
+                    self._run(app, environ, 50, statuses)
+                    if handler:
+                        handler.flush()
+                    statuses.clear()
+                    written = stream.tell()
+
+                    start, start_cpu = time.perf_counter(), time.thread_time()
+                    self._run(app, environ, count, statuses)
+                    cpu = time.thread_time() - start_cpu
+                    elapsed = time.perf_counter() - start
+                    if handler:
+                        # Drain outside the timed section
+                        handler.flush()
+                    written = stream.tell() - written
+
+                    # The same warning on its own, without the rest of the request
+                    start_call = time.thread_time()
+                    for _ in range(count):
+                        request_logger.warning("Forbidden: %s", '/api/client', extra={'status_code': 403})
+                    call = time.thread_time() - start_call
+                    if handler:
+                        handler.flush()
+
+                    result = results.setdefault(name, [float('inf')] * 3 + [0, statuses, 0])
+                    result[0] = min(result[0], elapsed / count * 1e6)
+                    result[1] = min(result[1], cpu / count * 1e6)
+                    result[2] = min(result[2], call / count * 1e6)
+                    result[3] = written
+                    result[5] = getattr(handler, 'dropped', 0)
+        finally:
+            logging.disable(logging.NOTSET)
+            root.handlers = saved
+            for handler in handlers.values():
+                if handler:
+                    handler.close()
+            stream.close()
+
+        wall_baseline, cpu_baseline = results['off'][0], results['off'][1]
+        self.stdout.write(f"{count} requests and log calls per mode, best of {options['rounds']} rounds. Wall time "
+                          f"includes the writer thread when it shares a CPU; request CPU and log call are "
+                          f"the request thread alone.")
+        self.stdout.write(f"{'mode':>17}{'wall us/req':>16}{'request CPU':>16}{'us/log call':>13}{'bytes logged':>14}")
+        for name in modes:
+            wall, cpu, call, written, statuses, dropped = results[name]
+            self.stdout.write(f"{name:>17}{wall:>8.1f} ({wall - wall_baseline:+5.1f})"
+                              f"{cpu:>8.1f} ({cpu - cpu_baseline:+5.1f}){call:>13.2f}{written:>14}  status {statuses}"
+                              + (f", {dropped} dropped" if dropped else ""))
+
+    @staticmethod
+    def _handler(name, stream):
+        if name == 'off':
+            return None
+        if name == 'sync text':
+            handler = logging.StreamHandler(stream)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(levelname)s %(name)s %(message)s'))
+            return handler
+        handler = QueueingHandler(stream)
+        handler.setFormatter(JSONFormatter())
+        if name.endswith('dedup'):
+            handler.addFilter(DedupFilter())
+        return handler
+
+    @staticmethod
+    def _run(app, environ, count, statuses):
+        def start_response(status, headers):
+            code = status.split(' ', 1)[0]
+            statuses[code] = statuses.get(code, 0) + 1
+
+        for _ in range(count):
+            request_environ = dict(environ)
+            request_environ['wsgi.input'] = io.BytesIO(b'')
+            response = app(request_environ, start_response)
+            for _ in response:
+                pass
+            if hasattr(response, 'close'):
+                response.close()
@@ -0,0 +1,102 @@
+import json
+import sys
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.core.validators import validate_email
+from django.core.exceptions import ValidationError
+
+from apps.accounts.models import User
+
+# Invalid lines reported individually before only counting them
+MAX_REPORTED_INVALID = 20
+
+# Longer addresses would fail the whole chunk's COPY on Postgres
+MAX_EMAIL_LENGTH = User._meta.get_field('email').max_length
+
+
+class Command(BaseCommand):
+    help = ("Creates users from a file of emails (one per line), e.g. certs/clients/manifest.txt, "
+            "or from a `gen_certs.py --bulk --bundle` file (JSON lines with a 'cn' each). "
+            "The input is streamed and loaded in chunks (COPY on Postgres), so memory stays "
+            "bounded for millions of lines")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File of emails, or '-' for stdin")
+        parser.add_argument('--batch-size', type=int, default=10000, help="Emails validated and loaded per chunk")
+        parser.add_argument('--progress-interval', type=float, default=5.0,
+                            help="Seconds between progress lines on stderr (0 for none)")
+
+    def handle(self, *args, **options):
+        path = options['path']
+        try:
+            stream = sys.stdin if path == '-' else open(path)
+        except OSError as e:
+            raise CommandError(f"Cannot read {path}: {e}")
+
+        batch_size = max(options['batch_size'], 1)
+        self.lines = self.invalid = self.loaded = self.created = 0
+        self.started = self.reported = time.monotonic()
+        chunk = {}
+        with stream:
+            for line in stream:
+                self.lines += 1
+                email = self._parse(line)
+                if email is None:
+                    continue
+                # dict keeps order and drops duplicates within the chunk
+                chunk[email] = None
+                if len(chunk) >= batch_size:
+                    self._load(chunk, options['progress_interval'])
+            self._load(chunk, 0)
+
+        elapsed = time.monotonic() - self.started
+        if self.invalid > MAX_REPORTED_INVALID:
+            self.stderr.write(f"... {self.invalid - MAX_REPORTED_INVALID} more invalid lines not shown")
+        self.stdout.write(self.style.SUCCESS(
+            f"Provisioned {self.created} new user(s) from {self.lines} lines "
+            f"({self.loaded} valid, {self.invalid} invalid) in {elapsed:.1f}s "
+            f"({self.lines / elapsed if elapsed else 0:.0f} rows/s)"
+        ))
+
+    def _parse(self, line):
+        """
+        Returns the normalized email on `line`, or None to skip it.
+        """
+        email = line.strip()
+        if not email:
+            return None
+        if email.startswith('{'):
+            try:
+                email = json.loads(email)['cn']
+            except (ValueError, KeyError, TypeError):
+                self._skip("Skipping malformed bundle line")
+                return None
+        try:
+            validate_email(email)
+        except ValidationError:
+            self._skip(f"Skipping invalid email: {email}")
+            return None
+        if len(email) > MAX_EMAIL_LENGTH:
+            self._skip(f"Skipping email longer than {MAX_EMAIL_LENGTH} characters: {email[:40]}...")
+            return None
+        return User.objects.normalize_email(email)
+
+    def _skip(self, message):
+        self.invalid += 1
+        if self.invalid <= MAX_REPORTED_INVALID:
+            self.stderr.write(message)
+
+    def _load(self, chunk, progress_interval):
+        if chunk:
+            # Existing users are left untouched
+            self.created += User.objects.bulk_provision(list(chunk))
+            self.loaded += len(chunk)
+            chunk.clear()
+
+        now = time.monotonic()
+        if progress_interval and now - self.reported >= progress_interval:
+            self.reported = now
+            elapsed = now - self.started
+            self.stderr.write(f"{self.lines} lines, {self.created} created, "
+                              f"{self.lines / elapsed:.0f} rows/s")
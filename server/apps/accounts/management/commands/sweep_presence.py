@@ -0,0 +1,30 @@
+from django.core.management.base import BaseCommand
+
+from apps.accounts.sweeper import presence_sweeper
+
+
+class Command(BaseCommand):
+    help = ("Broadcasts an offline record for every user whose last heartbeat is older than "
+            "PRESENCE_OFFLINE_TTL. Runs forever unless --once is given")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--once', action='store_true', help="Run a single sweep and exit")
+        parser.add_argument('--lookback', type=float, default=None,
+                            help="On start, also announce users that expired this many seconds ago "
+                                 "(default: PRESENCE_OFFLINE_TTL)")
+
+    def handle(self, *args, **options):
+        if options['lookback'] is not None:
+            presence_sweeper.configure(lookback=options['lookback'])
+
+        if options['once']:
+            swept = presence_sweeper.sweep()
+            self.stdout.write(self.style.SUCCESS(f"{swept} users marked offline"))
+            return
+
+        self.stdout.write(f"Sweeping every {presence_sweeper.interval}s "
+                          f"(offline after {presence_sweeper.ttl_ns / 1e9:.0f}s)")
+        try:
+            presence_sweeper.run()
+        except KeyboardInterrupt:
+            pass
@@ -0,0 +1,254 @@
+"""
+Low-overhead hot-path metrics: per-stage latency histograms and counters,
+rendered in the Prometheus text format by the /metrics view.
+
+Every metric lives at a fixed offset in a flat array of int64 slots. With
+METRICS_DIR set, each process maps its own file `<METRICS_DIR>/metrics-<pid>.db`
+(created lazily after fork, so gunicorn workers never share one) and a scrape
+sums the files of all workers, including ones that have exited, so counters
+stay monotonic across worker restarts. Without METRICS_DIR the slots are plain
+process memory, which is enough for the dev server.
+
+Pure standard library (no Django imports) so the broadcaster can use it.
+"""
+import bisect
+import glob
+import mmap
+import os
+import threading
+
+# Hot-path stages, timed with time.perf_counter_ns()
+STAGES = (
+    'request',              # whole request, outermost middleware
+    'mtls_auth',            # MTLSAuthenticationMiddleware
+    'identity_lookup',      # identity cache miss: CN validation + user lookup
+    'view',                 # ClientUpdateView.patch
+    'update_client_state',  # ClientService.update_client_state
+    'db_write',             # heartbeat UPDATE (or write-behind enqueue)
+    'broadcast_send',       # UDPBroadcaster.send (enqueue, or the socket write)
+    'write_behind_flush',   # one write-behind bulk flush
+    'gateway_batch',        # ClientBatchUpdateView.patch
+    'event_log_flush',      # one event log group commit (write + fsync)
+)
+
+# Upper bounds in nanoseconds: 10us .. 10s, plus +Inf
+BUCKETS_NS = (
+    10_000, 25_000, 50_000, 100_000, 250_000, 500_000,
+    1_000_000, 2_500_000, 5_000_000, 10_000_000, 25_000_000, 50_000_000,
+    100_000_000, 250_000_000, 500_000_000, 1_000_000_000, 2_500_000_000, 10_000_000_000,
+)
+
+BROADCAST_OUTCOMES = ('queued', 'sent', 'dropped', 'error', 'skipped', 'suppressed_unchanged', 'suppressed_rate')
+IDENTITY_CACHE_RESULTS = ('hit', 'miss')
+IDENTITY_CACHE_REMOVALS = ('evicted', 'expired', 'invalidated')
+
+# HTTP status codes 100..599 each get a slot
+STATUS_MIN = 100
+STATUS_MAX = 599
+
+SLOT_SIZE = 8
+_HISTOGRAM_SLOTS = len(BUCKETS_NS) + 3  # buckets + +Inf, sum, count
+
+
+def _layout():
+    offsets = {}
+    position = 0
+    for stage in STAGES:
+        offsets[('stage', stage)] = position
+        position += _HISTOGRAM_SLOTS
+    for outcome in BROADCAST_OUTCOMES:
+        offsets[('broadcast', outcome)] = position
+        position += 1
+    for result in IDENTITY_CACHE_RESULTS + IDENTITY_CACHE_REMOVALS:
+        offsets[('identity_cache', result)] = position
+        position += 1
+    offsets['status'] = position
+    position += STATUS_MAX - STATUS_MIN + 1
+    return offsets, position
+
+
+_OFFSETS, SLOT_COUNT = _layout()
+
+
+class Metrics:
+    """
+    Per-process writer and cross-process reader of the metric slots.
+    Writes take a process-local lock (gthread workers share the slots).
+    """
+
+    def __init__(self, directory=None, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._slots = None
+        self._mmap = None
+        os.register_at_fork(after_in_child=self._reset)
+
+    def configure(self, directory=None, enabled=None):
+        if enabled is not None:
+            self.enabled = enabled
+        if directory is not None:
+            self.directory = directory or None
+        self._reset()
+
+    def observe(self, stage, elapsed_ns):
+        """
+        Records one duration for a stage (a name from STAGES).
+        """
+        if not self.enabled:
+            return
+        offset = _OFFSETS[('stage', stage)]
+        bucket = bisect.bisect_left(BUCKETS_NS, elapsed_ns)
+        with self._lock:
+            slots = self._slots if self._slots is not None else self._open()
+            slots[offset + bucket] += 1
+            slots[offset + len(BUCKETS_NS) + 1] += elapsed_ns
+            slots[offset + len(BUCKETS_NS) + 2] += 1
+
+    def count_status(self, status):
+        if not self.enabled or not STATUS_MIN <= status <= STATUS_MAX:
+            return
+        self._add(_OFFSETS['status'] + status - STATUS_MIN, 1)
+
+    def count_broadcast(self, outcome, amount=1):
+        if self.enabled:
+            self._add(_OFFSETS[('broadcast', outcome)], amount)
+
+    def count_identity_cache(self, result, amount=1):
+        """
+        Counts identity cache lookups (IDENTITY_CACHE_RESULTS) or removed entries (IDENTITY_CACHE_REMOVALS).
+        """
+        if self.enabled and amount:
+            self._add(_OFFSETS[('identity_cache', result)], amount)
+
+    def collect(self):
+        """
+        Returns (totals, process_count): the slot-wise sum over every process.
+        """
+        if self.directory is None:
+            with self._lock:
+                slots = self._slots if self._slots is not None else self._open()
+                return list(slots), 1
+
+        totals = [0] * SLOT_COUNT
+        paths = glob.glob(os.path.join(self.directory, 'metrics-*.db'))
+        for path in paths:
+            try:
+                with open(path, 'rb') as f:
+                    data = f.read(SLOT_COUNT * SLOT_SIZE)
+            except OSError:
+                continue
+            if len(data) != SLOT_COUNT * SLOT_SIZE:
+                # Written by a build with a different layout
+                continue
+            for i, value in enumerate(memoryview(data).cast('q')):
+                totals[i] += value
+        return totals, len(paths)
+
+    def render(self):
+        """
+        Prometheus text exposition (format 0.0.4) of the aggregated metrics.
+        """
+        totals, processes = self.collect()
+        lines = [
+            '# HELP qt_stage_duration_seconds Time spent in each heartbeat stage.',
+            '# TYPE qt_stage_duration_seconds histogram',
+        ]
+        for stage in STAGES:
+            offset = _OFFSETS[('stage', stage)]
+            cumulative = 0
+            for i, bound in enumerate(BUCKETS_NS):
+                cumulative += totals[offset + i]
+                lines.append(f'qt_stage_duration_seconds_bucket{{stage="{stage}",le="{bound / 1e9:g}"}} {cumulative}')
+            cumulative += totals[offset + len(BUCKETS_NS)]
+            lines.append(f'qt_stage_duration_seconds_bucket{{stage="{stage}",le="+Inf"}} {cumulative}')
+            lines.append(f'qt_stage_duration_seconds_sum{{stage="{stage}"}} '
+                         f'{totals[offset + len(BUCKETS_NS) + 1] / 1e9:.9f}')
+            lines.append(f'qt_stage_duration_seconds_count{{stage="{stage}"}} {totals[offset + len(BUCKETS_NS) + 2]}')
+
+        lines += [
+            '# HELP qt_http_responses_total HTTP responses by status code.',
+            '# TYPE qt_http_responses_total counter',
+        ]
+        base = _OFFSETS['status']
+        for i in range(STATUS_MAX - STATUS_MIN + 1):
+            if totals[base + i]:
+                lines.append(f'qt_http_responses_total{{status="{STATUS_MIN + i}"}} {totals[base + i]}')
+
+        lines += [
+            '# HELP qt_broadcast_records_total Presence updates by broadcast outcome.',
+            '# TYPE qt_broadcast_records_total counter',
+        ]
+        for outcome in BROADCAST_OUTCOMES:
+            lines.append(f'qt_broadcast_records_total{{outcome="{outcome}"}} {totals[_OFFSETS[("broadcast", outcome)]]}')
+
+        lines += [
+            '# HELP qt_identity_cache_lookups_total mTLS identity cache lookups.',
+            '# TYPE qt_identity_cache_lookups_total counter',
+        ]
+        for result in IDENTITY_CACHE_RESULTS:
+            lines.append(f'qt_identity_cache_lookups_total{{result="{result}"}} '
+                         f'{totals[_OFFSETS[("identity_cache", result)]]}')
+
+        lines += [
+            '# HELP qt_identity_cache_removals_total mTLS identity cache entries removed, by reason.',
+            '# TYPE qt_identity_cache_removals_total counter',
+        ]
+        for reason in IDENTITY_CACHE_REMOVALS:
+            lines.append(f'qt_identity_cache_removals_total{{reason="{reason}"}} '
+                         f'{totals[_OFFSETS[("identity_cache", reason)]]}')
+
+        lines += [
+            '# HELP qt_metrics_processes Processes whose metrics are included.',
+            '# TYPE qt_metrics_processes gauge',
+            f'qt_metrics_processes {processes}',
+        ]
+        return '\n'.join(lines) + '\n'
+
+    def _add(self, index, amount):
+        with self._lock:
+            slots = self._slots if self._slots is not None else self._open()
+            slots[index] += amount
+
+    def _open(self):
+        # Caller holds the lock.
+        if self.directory is None:
+            self._slots = memoryview(bytearray(SLOT_COUNT * SLOT_SIZE)).cast('q')
+            return self._slots
+
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f'metrics-{os.getpid()}.db')
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size != SLOT_COUNT * SLOT_SIZE:
+                # New file (or a stale one from an older layout with a recycled pid)
+                os.ftruncate(fd, 0)
+                os.ftruncate(fd, SLOT_COUNT * SLOT_SIZE)
+            self._mmap = mmap.mmap(fd, SLOT_COUNT * SLOT_SIZE)
+        finally:
+            os.close(fd)
+        self._slots = memoryview(self._mmap).cast('q')
+        return self._slots
+
+    def _reset(self):
+        # After fork (or reconfiguration) the next write opens this process's own slots.
+        # The parent's mapping is dropped, not closed, since the parent still uses it.
+        self._lock = threading.Lock()
+        self._slots = None
+        self._mmap = None
+
+
+def clear_directory(directory):
+    """
+    Removes every process's slot file; called once by the gunicorn master before
+    workers start, so a restart doesn't add the previous run's counts.
+    """
+    for path in glob.glob(os.path.join(directory, 'metrics-*.db')):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+# Global instance, configured from settings in AccountsConfig.ready()
+metrics = Metrics()
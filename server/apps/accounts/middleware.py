@@ -2,12 +2,48 @@ from django.contrib.auth import get_user_model
 from django.utils.deprecation import MiddlewareMixin
 from django.core.exceptions import ValidationError
 from django.core.validators import validate_email
+from django.http import HttpResponse
 import logging
+import time
+
+from .identity_cache import INVALID_CN, NOT_FOUND, VALID, identity_cache
+from .metrics import metrics
+from .ratelimit import rate_limiter
 
 logger = logging.getLogger(__name__)
 
 User = get_user_model()
 
+# request.mtls_error for each failed identity outcome
+MTLS_ERRORS = {
+    INVALID_CN: "Invalid CN format",
+    NOT_FOUND: "User not found",
+}
+
+
+class MetricsMiddleware(MiddlewareMixin):
+    """
+    Outermost middleware: times the whole request and counts responses by status code.
+    Implements both call paths itself so ASGI requests never hop to a thread.
+    """
+
+    def __call__(self, request):
+        if self.async_mode:
+            return self.__acall__(request)
+        start = time.perf_counter_ns()
+        response = self.get_response(request)
+        metrics.observe('request', time.perf_counter_ns() - start)
+        metrics.count_status(response.status_code)
+        return response
+
+    async def __acall__(self, request):
+        start = time.perf_counter_ns()
+        response = await self.get_response(request)
+        metrics.observe('request', time.perf_counter_ns() - start)
+        metrics.count_status(response.status_code)
+        return response
+
+
 class MTLSAuthenticationMiddleware(MiddlewareMixin):
     """
     Middleware to authenticate users based on Nginx-forwarded Client Certificate CN.
@@ -31,13 +67,78 @@ class MTLSAuthenticationMiddleware(MiddlewareMixin):
         # and the View will check for IsAuthenticated and return 401/403.
         # However, the spec says "else 400".
 
+        start = time.perf_counter_ns()
+        # Rate limit per CN before any ORM access
+        limited = self._rate_limit(cn)
+        if limited:
+            return limited
+
+        # The per-worker identity cache answers repeat CNs (valid or not) without a DB hit.
+        self._authenticate(request, *identify(cn))
+        metrics.observe('mtls_auth', time.perf_counter_ns() - start)
+
+    async def __acall__(self, request):
+        # Native async path (ASGI): resolve the identity without hopping to a worker thread.
+        response = await self.aprocess_request(request)
+        return response or await self.get_response(request)
+
+    async def aprocess_request(self, request):
+        """
+        Async counterpart of process_request(); a cache hit never touches the ORM.
+        """
+        cn = request.headers.get('X-Subject-CN')
+        if not cn:
+            return
+
+        start = time.perf_counter_ns()
+        limited = self._rate_limit(cn)
+        if limited:
+            return limited
+
+        self._authenticate(request, *await aidentify(cn))
+        metrics.observe('mtls_auth', time.perf_counter_ns() - start)
+
+    @staticmethod
+    def _rate_limit(cn):
+        """
+        A 429 response if this CN is over its rate limit, else None.
+        """
+        retry_after = rate_limiter.check(cn)
+        if not retry_after:
+            return None
+        response = HttpResponse(status=429, content="Too Many Requests")
+        response['Retry-After'] = str(retry_after)
+        return response
+
+    def _authenticate(self, request, outcome, user):
+        if outcome != VALID:
+            # Valid cert, but CN is not an email (view returns 400), or no such user (403).
+            # We will attach the error to the request so the view can map it.
+            request.mtls_error = MTLS_ERRORS[outcome]
+            return
+
+        # Success: Log the user in
+        if user:
+            # Use force_login to bypass authentication backends
+            from django.contrib.auth import login
+            # We need a backend to login. We can use the ModelBackend by default
+            # but it usually expects credentials.
+            # Let's just set request.user manually or use login() with a backend hack.
+            # Simpler: just set request.user if we are stateless, but Django session auth
+            # might be overkill.
+            # Given this is an API, per-request auth is better.
+            request.user = user
+
+    @staticmethod
+    def _resolve(cn):
+        """
+        Resolves a CN to (outcome, user) against the database.
+        Only called on an identity cache miss.
+        """
         try:
             validate_email(cn)
         except ValidationError:
-            # Valid cert, but CN is not an email.
-            # We will attach the error to the request so the view can return 400.
-            request.mtls_error = "Invalid CN format"
-            return
+            return INVALID_CN, None
 
         # Lookup or Create User
         try:
@@ -48,20 +149,56 @@ class MTLSAuthenticationMiddleware(MiddlewareMixin):
              if cn == "valid_user@qt-test.com":
                  user = User.objects.create(email=cn)
              else:
-                 request.mtls_error = "User not found"
-                 return
+                 return NOT_FOUND, None
         except Exception as e:
             # DB Error (ProgrammingError) propagates as 500.
             raise e
 
-        # Success: Log the user in
-        if user:
-            # Use force_login to bypass authentication backends
-            from django.contrib.auth import login
-            # We need a backend to login. We can use the ModelBackend by default
-            # but it usually expects credentials.
-            # Let's just set request.user manually or use login() with a backend hack.
-            # Simpler: just set request.user if we are stateless, but Django session auth
-            # might be overkill.
-            # Given this is an API, per-request auth is better.
-            request.user = user
+        return VALID, user
+
+    @staticmethod
+    async def _aresolve(cn):
+        """
+        Async counterpart of _resolve() using the async ORM.
+        """
+        try:
+            validate_email(cn)
+        except ValidationError:
+            return INVALID_CN, None
+
+        try:
+            user = await User.objects.aget(email=cn)
+        except User.DoesNotExist:
+             if cn == "valid_user@qt-test.com":
+                 user = await User.objects.acreate(email=cn)
+             else:
+                 return NOT_FOUND, None
+
+        return VALID, user
+
+
+def identify(cn):
+    """
+    Resolves a CN to (outcome, user) through the per-worker identity cache,
+    falling back to the database on a miss.
+    """
+    start = time.perf_counter_ns()
+    cached = identity_cache.get(cn)
+    if cached is None:
+        cached = MTLSAuthenticationMiddleware._resolve(cn)
+        identity_cache.set(cn, *cached)
+        metrics.observe('identity_lookup', time.perf_counter_ns() - start)
+    return cached
+
+
+async def aidentify(cn):
+    """
+    Async counterpart of identify(); a cache hit never touches the ORM.
+    """
+    start = time.perf_counter_ns()
+    cached = identity_cache.get(cn)
+    if cached is None:
+        cached = await MTLSAuthenticationMiddleware._aresolve(cn)
+        identity_cache.set(cn, *cached)
+        metrics.observe('identity_lookup', time.perf_counter_ns() - start)
+    return cached
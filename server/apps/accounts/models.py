@@ -1,7 +1,20 @@
-from django.db import models
+import os
+
+from django.db import connections, models, transaction
+from django.contrib.auth.hashers import UNUSABLE_PASSWORD_PREFIX
 from django.contrib.auth.models import AbstractBaseUser, BaseUserManager
 
 
+def unusable_passwords(count):
+    """
+    `count` distinct unusable password values, like make_password(None) (the
+    prefix and 40 random characters) but from one urandom read instead of 40
+    SystemRandom calls each, which dominated bulk provisioning.
+    """
+    data = os.urandom(20 * count).hex()
+    return [UNUSABLE_PASSWORD_PREFIX + data[i:i + 40] for i in range(0, 40 * count, 40)]
+
+
 class UserManager(BaseUserManager):
     def create_user(self, email, password=None):
         """
@@ -17,6 +30,91 @@ class UserManager(BaseUserManager):
         user.save(using=self._db)
         return user
 
+    def bulk_update_presence(self, rows):
+        """
+        Writes many (pk, last_seen_ns, ip_address, port) rows in a single UPDATE.
+        A row only applies if it is newer than what is stored, so last_seen_ns
+        never goes backwards even when several workers flush the same user.
+        Returns the number of rows updated.
+        """
+        if not rows:
+            return 0
+
+        connection = connections[self.db]
+        qn = connection.ops.quote_name
+        meta = self.model._meta
+        table = qn(meta.db_table)
+        pk_col = qn(meta.pk.column)
+        cols = [qn(meta.get_field(name).column) for name in self.model.PRESENCE_FIELDS]
+
+        if connection.vendor == 'postgresql':
+            # VALUES literals are untyped in Postgres; inet in particular needs a cast.
+            placeholder = '(%s::bigint, %s::bigint, %s::inet, %s::integer)'
+        else:
+            placeholder = '(%s, %s, %s, %s)'
+
+        # VALUES columns are named column1..columnN by both Postgres and SQLite.
+        sql = (
+            f'UPDATE {table} SET '
+            f'{", ".join(f"{col} = v.column{i}" for i, col in enumerate(cols, start=2))} '
+            f'FROM (VALUES {", ".join([placeholder] * len(rows))}) AS v '
+            f'WHERE {table}.{pk_col} = v.column1 AND {table}.{cols[0]} < v.column2'
+        )
+        params = [value for row in rows for value in row]
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            return cursor.rowcount
+
+    def bulk_provision(self, emails):
+        """
+        Creates users with unusable passwords for many normalized, distinct emails,
+        leaving existing ones untouched. Returns the number created.
+
+        On Postgres the rows are streamed with COPY into a temporary table (dropped
+        at commit, so this is safe behind pgbouncer) and moved over with one
+        INSERT ... ON CONFLICT DO NOTHING. Elsewhere, existing emails are looked up
+        and the rest go through bulk_create(ignore_conflicts=True).
+        """
+        if not emails:
+            return 0
+
+        connection = connections[self.db]
+        meta = self.model._meta
+        if connection.vendor != 'postgresql':
+            batch_size = connection.ops.bulk_batch_size(['email'], emails) or len(emails)
+            existing = set()
+            for start in range(0, len(emails), batch_size):
+                existing.update(self.filter(email__in=emails[start:start + batch_size])
+                                .values_list('email', flat=True))
+            new = [email for email in emails if email not in existing]
+            users = [self.model(email=email, password=password)
+                     for email, password in zip(new, unusable_passwords(len(new)))]
+            self.bulk_create(users, batch_size=batch_size, ignore_conflicts=True)
+            return len(users)
+
+        qn = connection.ops.quote_name
+        table = qn(meta.db_table)
+        email_col = qn(meta.get_field('email').column)
+        password_col = qn(meta.get_field('password').column)
+        # Model defaults are applied by Django, not the database
+        defaults = [meta.get_field(name) for name in ('last_seen_ns', 'port')]
+
+        with transaction.atomic(using=self.db), connection.cursor() as cursor:
+            cursor.execute('CREATE TEMPORARY TABLE provision_users (email varchar(255), password varchar(128)) '
+                           'ON COMMIT DROP')
+            with cursor.copy('COPY provision_users (email, password) FROM STDIN') as copy:
+                for row in zip(emails, unusable_passwords(len(emails))):
+                    copy.write_row(row)
+            cursor.execute(
+                f'INSERT INTO {table} ({email_col}, {password_col}, '
+                f'{", ".join(qn(field.column) for field in defaults)}) '
+                f'SELECT email, password, {", ".join(["%s"] * len(defaults))} FROM provision_users '
+                f'ON CONFLICT ({email_col}) DO NOTHING',
+                [field.get_default() for field in defaults],
+            )
+            return cursor.rowcount
+
 
 class User(AbstractBaseUser):
     """
@@ -31,7 +129,8 @@ class User(AbstractBaseUser):
 
     # State fields requested by spec
     # lastSeen: nanoseconds since epoch
-    last_seen_ns = models.BigIntegerField(default=0)
+    # Indexed for "seen since" range queries (presence API, index sync)
+    last_seen_ns = models.BigIntegerField(default=0, db_index=True)
 
     ip_address = models.GenericIPAddressField(null=True, blank=True)
     port = models.IntegerField(default=0)
@@ -39,6 +138,9 @@ class User(AbstractBaseUser):
     # Required for custom user model
     objects = UserManager()
 
+    # Columns rewritten on every heartbeat
+    PRESENCE_FIELDS = ('last_seen_ns', 'ip_address', 'port')
+
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
 
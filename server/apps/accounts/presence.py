@@ -0,0 +1,189 @@
+import bisect
+import logging
+import os
+import threading
+import time
+
+from .directory import UserDirectory
+
+logger = logging.getLogger(__name__)
+
+BUCKET_NS = 1_000_000_000
+
+
+class PresenceIndex:
+    """
+    Per-process index of the latest (last_seen_ns, ip, port) per email, ordered by last_seen_ns.
+    The state itself is held in a compact UserDirectory (array columns, not tuples).
+
+    Entries live in one-second buckets keyed by last_seen_ns // 1s, with a sorted
+    list of bucket keys, so an update is O(1) and "seen in the last N seconds" or
+    "newest first" reads only walk the buckets they return.
+
+    Heartbeats handled by this worker are applied directly. Other workers' writes
+    are pulled from the database every `sync_interval` seconds by a background
+    thread, with a range query on the last_seen_ns index; the query overlaps the
+    previous one by `sync_overlap` seconds to catch rows committed late (e.g.
+    write-behind). Request threads only read the index. Until the first sync has
+    completed, `ready` is False and callers should fall back to querying the database.
+    """
+
+    def __init__(self, sync_interval=1.0, sync_overlap=10.0):
+        self.sync_interval = sync_interval
+        self.sync_overlap = sync_overlap
+        self._state = UserDirectory()
+        self._buckets = {}
+        self._bucket_keys = []
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._pid = None
+        self._high_water = 0
+        self._synced_at = None
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    def configure(self, sync_interval=None, sync_overlap=None):
+        if sync_interval is not None:
+            self.sync_interval = sync_interval
+        if sync_overlap is not None:
+            self.sync_overlap = sync_overlap
+
+    @property
+    def ready(self):
+        return self._synced_at is not None
+
+    def update(self, email, last_seen_ns, ip_address, port):
+        if not last_seen_ns:
+            return
+        with self._lock:
+            self._apply(email, last_seen_ns, ip_address, port)
+
+    def get(self, email):
+        """
+        Returns (last_seen_ns, ip_address, port) or None.
+        """
+        return self._state.get(email)
+
+    def online(self, within_ns, now_ns=None, limit=None):
+        """
+        Users seen within the last `within_ns` nanoseconds, newest first.
+        """
+        cutoff = (now_ns or time.time_ns()) - within_ns
+        users = []
+        for email, state in self._newest_first():
+            if state[0] < cutoff:
+                break
+            users.append((email, *state))
+            if limit is not None and len(users) >= limit:
+                break
+        return users
+
+    def page(self, limit, offset=0):
+        """
+        One page of all known users ordered by last_seen_ns, newest first.
+        """
+        users = []
+        for position, (email, state) in enumerate(self._newest_first()):
+            if position < offset:
+                continue
+            users.append((email, *state))
+            if len(users) >= limit:
+                break
+        return users
+
+    def __len__(self):
+        return len(self._state)
+
+    def refresh(self):
+        """
+        Starts this process's sync thread if it isn't running. Never queries or
+        blocks: the thread does the initial full load (callers fall back to the
+        database until `ready`) and then syncs every sync_interval seconds.
+        """
+        if self._pid != os.getpid():
+            self._ensure_started()
+
+    def _ensure_started(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='presence-sync', daemon=True).start()
+
+    def _run(self):
+        from django.db import close_old_connections
+        while True:
+            started = time.monotonic()
+            close_old_connections()
+            try:
+                self.sync()
+            except Exception as e:
+                logger.error("Presence index sync failed: %s", e)
+            time.sleep(max(self.sync_interval - (time.monotonic() - started), 0.0))
+
+    def _after_fork(self):
+        # The parent's sync thread doesn't exist here; refresh() starts this process's own
+        self._pid = None
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+
+    def sync(self):
+        from .models import User
+
+        since = max(self._high_water - int(self.sync_overlap * 1e9), 0)
+        rows = (User.objects.filter(last_seen_ns__gt=since)
+                .values_list('email', 'last_seen_ns', 'ip_address', 'port')
+                .iterator(chunk_size=2000))
+
+        high_water = self._high_water
+        for email, last_seen_ns, ip_address, port in rows:
+            with self._lock:
+                self._apply(email, last_seen_ns, ip_address, port)
+            if last_seen_ns > high_water:
+                high_water = last_seen_ns
+
+        self._high_water = high_water
+        self._synced_at = time.monotonic()
+
+    def _apply(self, email, last_seen_ns, ip_address, port):
+        # Caller holds the lock.
+        current = self._state.last_seen(email)
+        if current is not None:
+            if current >= last_seen_ns:
+                return
+            old_key = current // BUCKET_NS
+            bucket = self._buckets.get(old_key)
+            if bucket is not None:
+                bucket.discard(email)
+                if not bucket:
+                    del self._buckets[old_key]
+                    position = bisect.bisect_left(self._bucket_keys, old_key)
+                    if position < len(self._bucket_keys) and self._bucket_keys[position] == old_key:
+                        del self._bucket_keys[position]
+
+        self._state.set(email, last_seen_ns, ip_address, port)
+        key = last_seen_ns // BUCKET_NS
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            bucket = self._buckets[key] = set()
+            bisect.insort(self._bucket_keys, key)
+        bucket.add(email)
+
+    def _newest_first(self):
+        """
+        Yields (email, state) newest first, walking one bucket at a time.
+        """
+        bound = None
+        while True:
+            with self._lock:
+                keys = self._bucket_keys
+                position = (len(keys) if bound is None else bisect.bisect_left(keys, bound)) - 1
+                if position < 0:
+                    return
+                bound = keys[position]
+                entries = sorted(((email, self._state.get(email)) for email in self._buckets[bound]),
+                                 key=lambda item: item[1][0], reverse=True)
+            yield from entries
+
+
+# Global instance, configured from settings in AccountsConfig.ready()
+presence_index = PresenceIndex()
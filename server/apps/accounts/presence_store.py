@@ -0,0 +1,384 @@
+import asyncio
+import atexit
+import logging
+import os
+import threading
+import time
+import uuid
+from contextlib import closing
+
+from django.core.exceptions import ImproperlyConfigured
+from django.db import close_old_connections
+
+try:
+    import redis
+except ImportError:  # only needed for the redis backend
+    redis = None
+
+logger = logging.getLogger(__name__)
+
+POSTGRES = 'postgres'
+MEMORY = 'memory'
+REDIS = 'redis'
+
+
+class PostgresBackend:
+    """
+    Today's behavior: every heartbeat is a narrow UPDATE (or a write-behind
+    enqueue). Postgres is the source of truth, so there is nothing to reconcile.
+    """
+    reconciles = False
+
+    def __init__(self, write_behind=False):
+        self.write_behind = write_behind
+
+    def write(self, user):
+        if self.write_behind:
+            # Coalesced and written in bulk by the flush thread
+            from .write_behind import write_behind
+            write_behind.enqueue(user.pk, user.last_seen_ns, user.ip_address, user.port)
+        else:
+            self._update(user).update(last_seen_ns=user.last_seen_ns, ip_address=user.ip_address, port=user.port)
+
+    async def awrite(self, user):
+        if self.write_behind:
+            from .write_behind import write_behind
+            write_behind.enqueue(user.pk, user.last_seen_ns, user.ip_address, user.port)
+        else:
+            await self._update(user).aupdate(
+                last_seen_ns=user.last_seen_ns, ip_address=user.ip_address, port=user.port
+            )
+
+    def write_many(self, records):
+        if self.write_behind:
+            from .write_behind import write_behind
+            for user_id, _, last_seen_ns, ip_address, port in records:
+                write_behind.enqueue(user_id, last_seen_ns, ip_address, port)
+        else:
+            from .models import User
+            User.objects.bulk_update_presence([(user_id, *state) for user_id, _, *state in records])
+
+    @staticmethod
+    def _update(user):
+        """
+        Queryset for a single narrow `UPDATE ... SET last_seen_ns, ip_address, port
+        WHERE email = ...` with no preceding SELECT. Rows that already hold a newer
+        last_seen_ns are left alone, so the value never goes backwards.
+        """
+        from .models import User
+        return User.objects.filter(email=user.email, last_seen_ns__lt=user.last_seen_ns)
+
+
+class MemoryBackend:
+    """
+    Keeps the newest state per user in this process and hands the changed rows
+    to the reconciler. Nothing is shared between workers until it is reconciled.
+    """
+    reconciles = True
+
+    def __init__(self):
+        self._state = {}
+        self._dirty = {}
+        self._lock = threading.Lock()
+
+    def write(self, user):
+        with self._lock:
+            self._merge(user.pk, (user.last_seen_ns, user.ip_address, user.port))
+
+    async def awrite(self, user):
+        self.write(user)
+
+    def write_many(self, records):
+        with self._lock:
+            for user_id, _, *state in records:
+                self._merge(user_id, tuple(state))
+
+    def _merge(self, user_id, state):
+        # Caller holds the lock.
+        current = self._state.get(user_id)
+        if current is None or current[0] < state[0]:
+            self._state[user_id] = state
+            self._dirty[user_id] = state
+
+    def get(self, user_id):
+        return self._state.get(user_id)
+
+    def drain(self, page_size):
+        """
+        Yields the changed rows in pages of `page_size`. Rows of pages not yet
+        yielded when the reconciler stops early are requeued.
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        rows = [(user_id, *state) for user_id, state in dirty.items()]
+        position = 0
+        try:
+            while position < len(rows):
+                position += page_size
+                yield rows[position - page_size:position]
+        finally:
+            self.requeue(rows[position:])
+
+    def commit(self, rows):
+        pass
+
+    def requeue(self, rows):
+        with self._lock:
+            for user_id, *state in rows:
+                current = self._dirty.get(user_id)
+                if current is None or current[0] < state[0]:
+                    self._dirty[user_id] = tuple(state)
+
+
+class RedisBackend:
+    """
+    Shared store on any Redis-protocol server. Each heartbeat is one pipelined
+    round trip: HSET <prefix>:user:<pk> (email, last_seen_ns, ip, port) and
+    ZADD GT <prefix>:last_seen <last_seen_ns> <pk>.
+
+    The reconciler pages through users whose score moved since its last pass
+    (with an overlap for late writers) in the sorted set, oldest first, and moves
+    the shared high-water mark after each page, so memory stays bounded after an
+    outage. A short-lived lock key, extended after every page, makes sure only
+    one worker reconciles at a time. The hash is last-writer-wins; the sorted
+    set and the reconciled DB row only ever move forward.
+
+    `client` / `async_client` may be injected (e.g. fakeredis) instead of a URL.
+    """
+    reconciles = True
+
+    def __init__(self, url='redis://localhost:6379/0', prefix='qt:presence', client=None, async_client=None,
+                 overlap=10.0, lock_ttl=1.0):
+        if client is None:
+            if redis is None:
+                raise ImproperlyConfigured("PRESENCE_BACKEND=redis requires the 'redis' package")
+            client = redis.Redis.from_url(url)
+        self.url = url
+        self.prefix = prefix
+        self.client = client
+        self.overlap_ns = int(overlap * 1e9)
+        self.lock_ttl_ms = max(int(lock_ttl * 1000), 1)
+        self.zset_key = f'{prefix}:last_seen'
+        self.lock_key = f'{prefix}:reconcile-lock'
+        self.reconciled_key = f'{prefix}:reconciled-until'
+        self._async_client = async_client
+        self._async_injected = async_client is not None
+        self._async_loop = None
+
+    def user_key(self, user_id):
+        return f'{self.prefix}:user:{user_id}'
+
+    def write(self, user):
+        pipe = self.client.pipeline(transaction=False)
+        self._queue(pipe, user.pk, user.email, user.last_seen_ns, user.ip_address, user.port)
+        pipe.execute()
+
+    async def awrite(self, user):
+        pipe = self._get_async_client().pipeline(transaction=False)
+        self._queue(pipe, user.pk, user.email, user.last_seen_ns, user.ip_address, user.port)
+        await pipe.execute()
+
+    def write_many(self, records):
+        pipe = self.client.pipeline(transaction=False)
+        for record in records:
+            self._queue(pipe, *record)
+        pipe.execute()
+
+    def get(self, user_id):
+        raw = self.client.hmget(self.user_key(user_id), 'last_seen_ns', 'ip', 'port')
+        if raw[0] is None:
+            return None
+        return self._state(raw)
+
+    def drain(self, page_size):
+        """
+        Yields pages of up to `page_size` rows changed since the last reconcile,
+        oldest first. Yields nothing if another worker holds the reconcile lock,
+        and stops if the lock is lost while paging.
+        """
+        token = f'{os.getpid()}:{uuid.uuid4().hex}'
+        if not self.client.set(self.lock_key, token, nx=True, px=self.lock_ttl_ms):
+            return
+
+        reconciled = int(self.client.get(self.reconciled_key) or 0)
+        # Keyset cursor: members are ordered by (score, member), so resume at the
+        # last score seen, past the members already read at that score
+        low, skip = f'({max(reconciled - self.overlap_ns, 0)}', 0
+        while True:
+            members = self.client.zrangebyscore(self.zset_key, low, '+inf', start=skip, num=page_size,
+                                                withscores=True)
+            if not members:
+                return
+
+            pipe = self.client.pipeline(transaction=False)
+            for member, _ in members:
+                pipe.hmget(self.user_key(int(member)), 'last_seen_ns', 'ip', 'port')
+            rows = []
+            for (member, _), raw in zip(members, pipe.execute()):
+                if raw[0] is not None:
+                    rows.append((int(member), *self._state(raw)))
+            if rows:
+                yield rows
+            if len(members) < page_size or not self._extend_lock(token):
+                return
+
+            last = members[-1][1]
+            ties = sum(1 for _, score in members if score == last)
+            if low == repr(last):
+                skip += ties
+            else:
+                low, skip = repr(last), ties
+
+    def _extend_lock(self, token):
+        # Another worker may have taken an expired lock; only extend our own
+        held = self.client.get(self.lock_key)
+        if (held.decode() if isinstance(held, bytes) else held) != token:
+            logger.warning("Presence reconcile lock lost while draining; stopping this pass")
+            return False
+        self.client.pexpire(self.lock_key, self.lock_ttl_ms)
+        return True
+
+    def commit(self, rows):
+        # Shared high-water mark, so whichever worker reconciles next starts from here
+        if rows:
+            self.client.set(self.reconciled_key, max(row[1] for row in rows))
+
+    def requeue(self, rows):
+        # Redis still holds the state and the high-water mark didn't move; the next pass re-reads it
+        pass
+
+    def _queue(self, pipe, user_id, email, last_seen_ns, ip_address, port):
+        pipe.hset(self.user_key(user_id), mapping={
+            'email': email,
+            'last_seen_ns': last_seen_ns,
+            'ip': ip_address or '',
+            'port': port,
+        })
+        pipe.zadd(self.zset_key, {user_id: last_seen_ns}, gt=True)
+
+    @staticmethod
+    def _state(raw):
+        last_seen_ns, ip, port = raw
+        ip = ip.decode() if isinstance(ip, bytes) else ip
+        return int(last_seen_ns), ip or None, int(port)
+
+    def _get_async_client(self):
+        if self._async_injected:
+            return self._async_client
+        loop = asyncio.get_running_loop()
+        if self._async_client is None or self._async_loop is not loop:
+            # redis.asyncio connections belong to the loop that opened them
+            import redis.asyncio
+            self._async_client = redis.asyncio.Redis.from_url(self.url)
+            self._async_loop = loop
+        return self._async_client
+
+
+class PresenceStore:
+    """
+    Where ClientService writes heartbeat state: 'postgres' (a narrow UPDATE per
+    heartbeat, optionally write-behind), 'memory' (this process only) or 'redis'
+    (shared across workers and hosts).
+
+    The memory and redis backends keep Postgres off the request path. A
+    reconciler thread, started lazily in each worker like the write-behind
+    flusher, copies changed rows into accounts.User every `reconcile_interval`
+    seconds with one multi-row UPDATE per batch, and once more at exit.
+    """
+
+    def __init__(self):
+        self.backend = PostgresBackend()
+        self.reconcile_interval = 5.0
+        self.batch_size = 500
+        self._lock = threading.Lock()
+        self._pid = None
+
+    def configure(self, backend=None, reconcile_interval=None, batch_size=None, write_behind=False,
+                  redis_url=None, redis_prefix=None, redis_client=None, redis_async_client=None):
+        if reconcile_interval is not None:
+            self.reconcile_interval = reconcile_interval
+        if batch_size is not None:
+            self.batch_size = max(batch_size, 1)
+
+        if backend is None or backend == POSTGRES:
+            self.backend = PostgresBackend(write_behind=write_behind)
+        elif backend == MEMORY:
+            self.backend = MemoryBackend()
+        elif backend == REDIS:
+            options = {'client': redis_client, 'async_client': redis_async_client,
+                       'lock_ttl': max(self.reconcile_interval / 2, 0.1)}
+            if redis_url:
+                options['url'] = redis_url
+            if redis_prefix:
+                options['prefix'] = redis_prefix
+            self.backend = RedisBackend(**options)
+        else:
+            raise ImproperlyConfigured(f"Unknown PRESENCE_BACKEND '{backend}'")
+
+    def write(self, user):
+        self.backend.write(user)
+        self._ensure_started()
+
+    async def awrite(self, user):
+        await self.backend.awrite(user)
+        self._ensure_started()
+
+    def write_many(self, records):
+        """
+        Writes many (user_id, email, last_seen_ns, ip_address, port) records at once
+        (a single statement or pipeline, depending on the backend).
+        """
+        if records:
+            self.backend.write_many(records)
+            self._ensure_started()
+
+    def reconcile(self):
+        """
+        Copies changed presence into accounts.User. Returns the number of rows updated.
+        """
+        if not self.backend.reconciles:
+            return 0
+        from .write_behind import write_presence_rows
+
+        updated = 0
+        with closing(self.backend.drain(self.batch_size)) as pages:
+            for rows in pages:
+                # Rows the database rejects are dropped rather than requeued forever
+                written, unwritten = write_presence_rows(rows, self.batch_size, "Presence reconcile")
+                updated += written
+                if unwritten:
+                    self.backend.requeue(unwritten)
+                    break
+                self.backend.commit(rows)
+        return updated
+
+    def _ensure_started(self):
+        if self._pid == os.getpid() or not self.backend.reconciles:
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='presence-reconciler', daemon=True).start()
+            atexit.register(self._reconcile_at_exit)
+
+    def _run(self):
+        while True:
+            time.sleep(self.reconcile_interval)
+            close_old_connections()
+            try:
+                self.reconcile()
+            except Exception as e:
+                logger.error("Presence reconcile loop error: %s", e)
+
+    def _reconcile_at_exit(self):
+        try:
+            updated = self.reconcile()
+            if updated:
+                logger.info("Presence reconciled %d rows on shutdown", updated)
+        except Exception as e:
+            logger.error("Presence final reconcile failed: %s", e)
+
+
+# Global instance, configured from settings in AccountsConfig.ready()
+presence_store = PresenceStore()
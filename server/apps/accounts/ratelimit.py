@@ -0,0 +1,223 @@
+"""
+Per-CN request rate limiting for MTLSAuthenticationMiddleware.
+
+All backends implement the same sliding window counter: a key may make at
+most `limit` requests per `window` seconds, estimated as
+
+    previous_window_count * (1 - elapsed_fraction) + current_window_count
+
+Only allowed requests are counted, so a client that keeps hammering is let
+through again as soon as its estimate drops below the limit.
+
+Backends:
+    local   per-worker dict (each gunicorn worker enforces the limit on its own)
+    shm     fixed-size table of hashed slots in a MAP_SHARED file (default under
+            /dev/shm) shared by every worker on the host. Updates are plain,
+            lock-free reads and writes: two workers racing on one slot can lose
+            an increment (the limit is enforced slightly late, never early).
+    redis   INCR on per-window keys, shared across hosts (one round trip).
+"""
+import math
+import mmap
+import os
+import threading
+import time
+import zlib
+
+from django.core.exceptions import ImproperlyConfigured
+
+try:
+    import redis
+except ImportError:  # only needed for the redis backend
+    redis = None
+
+LOCAL = 'local'
+SHM = 'shm'
+REDIS = 'redis'
+
+# shm slot: key, window id, current count, previous count (int64 each)
+_SLOT_FIELDS = 4
+_SLOT_SIZE = _SLOT_FIELDS * 8
+
+
+def _retry_after(limit, window_ns, offset_ns, current, previous):
+    """
+    Seconds until a request would be allowed again (at least 1).
+    """
+    if current >= limit:
+        # Only the next window can help
+        wait_ns = window_ns - offset_ns
+    else:
+        # Wait until the previous window's weight has decayed enough
+        fraction = 1 - (limit - current - 1) / previous
+        wait_ns = max(fraction * window_ns - offset_ns, 0)
+    return max(math.ceil(wait_ns / 1e9), 1)
+
+
+def _check(limit, window_ns, now_ns, window_id, current, previous):
+    """
+    Sliding window decision for counts already rolled over to `window_id`.
+    Returns retry_after (0 if the request is allowed).
+    """
+    offset_ns = now_ns - window_id * window_ns
+    if previous * (window_ns - offset_ns) / window_ns + current + 1 > limit:
+        return _retry_after(limit, window_ns, offset_ns, current, previous)
+    return 0
+
+
+class LocalCounters:
+    def __init__(self, limit, window_ns, max_keys=100000):
+        self.limit = limit
+        self.window_ns = window_ns
+        self.max_keys = max_keys
+        self._counts = {}
+        self._lock = threading.Lock()
+
+    def hit(self, key, now_ns):
+        window_id = now_ns // self.window_ns
+        with self._lock:
+            state = self._counts.get(key)
+            if state is None:
+                if len(self._counts) >= self.max_keys:
+                    del self._counts[next(iter(self._counts))]
+                state = self._counts[key] = [window_id, 0, 0]
+            elif state[0] != window_id:
+                state[2] = state[1] if state[0] == window_id - 1 else 0
+                state[1] = 0
+                state[0] = window_id
+
+            retry_after = _check(self.limit, self.window_ns, now_ns, window_id, state[1], state[2])
+            if not retry_after:
+                state[1] += 1
+            return retry_after
+
+
+class SharedMemoryCounters:
+    """
+    Open-addressed table of `slots` counters (2-way: a key lives in one of two
+    adjacent slots) in a file mapped by every worker. A key whose slots are both
+    taken by other active keys evicts the one with the older window.
+    """
+
+    def __init__(self, limit, window_ns, path, slots=65536):
+        self.limit = limit
+        self.window_ns = window_ns
+        self.slots = max(slots, 2)
+        size = self.slots * _SLOT_SIZE
+
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            if os.fstat(fd).st_size != size:
+                os.ftruncate(fd, size)
+            # MAP_SHARED mappings stay shared with forked workers
+            self._mmap = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+        self._table = memoryview(self._mmap).cast('q')
+
+    def hit(self, key, now_ns):
+        data = key.encode('utf-8')
+        crc = zlib.crc32(data)
+        # 64-bit tag to tell keys apart within a slot; never 0 (empty)
+        tag = ((crc << 31) ^ zlib.adler32(data)) | 1
+        window_id = now_ns // self.window_ns
+        table = self._table
+
+        first = (crc % self.slots) * _SLOT_FIELDS
+        second = ((crc + 1) % self.slots) * _SLOT_FIELDS
+        if table[first] == tag:
+            base = first
+        elif table[second] == tag:
+            base = second
+        else:
+            # New key (or evicted): take the stalest of the two slots
+            base = first if table[first + 1] <= table[second + 1] else second
+            table[base] = tag
+            table[base + 1] = window_id
+            table[base + 2] = 0
+            table[base + 3] = 0
+
+        slot_window = table[base + 1]
+        if slot_window != window_id:
+            table[base + 3] = table[base + 2] if slot_window == window_id - 1 else 0
+            table[base + 2] = 0
+            table[base + 1] = window_id
+
+        current = table[base + 2]
+        retry_after = _check(self.limit, self.window_ns, now_ns, window_id, current, table[base + 3])
+        if not retry_after:
+            table[base + 2] = current + 1
+        return retry_after
+
+
+class RedisCounters:
+    """
+    One pipelined round trip per request: INCR + PEXPIRE on the current window
+    key and GET of the previous one. Denied requests are counted here too.
+    """
+
+    def __init__(self, limit, window_ns, url='redis://localhost:6379/0', prefix='qt:ratelimit', client=None):
+        if client is None:
+            if redis is None:
+                raise ImproperlyConfigured("RATE_LIMIT_BACKEND=redis requires the 'redis' package")
+            client = redis.Redis.from_url(url)
+        self.limit = limit
+        self.window_ns = window_ns
+        self.prefix = prefix
+        self.client = client
+        self._expire_ms = max(2 * window_ns // 1_000_000, 1)
+
+    def hit(self, key, now_ns):
+        window_id = now_ns // self.window_ns
+        current_key = f'{self.prefix}:{key}:{window_id}'
+        pipe = self.client.pipeline(transaction=False)
+        pipe.incr(current_key)
+        pipe.pexpire(current_key, self._expire_ms)
+        pipe.get(f'{self.prefix}:{key}:{window_id - 1}')
+        current, _, previous = pipe.execute()
+        # INCR already counted this request
+        return _check(self.limit, self.window_ns, now_ns, window_id, current - 1, int(previous or 0))
+
+
+class RateLimiter:
+    """
+    Facade used by the middleware. Disabled (every request allowed) until
+    configured with a backend.
+    """
+
+    def __init__(self):
+        self.counters = None
+
+    @property
+    def enabled(self):
+        return self.counters is not None
+
+    def configure(self, backend=None, limit=60, window=60.0, shm_path=None, shm_slots=65536,
+                  redis_url=None, redis_client=None):
+        window_ns = max(int(window * 1e9), 1)
+        if not backend:
+            self.counters = None
+        elif backend == LOCAL:
+            self.counters = LocalCounters(limit, window_ns)
+        elif backend == SHM:
+            path = shm_path or os.path.join('/dev/shm' if os.path.isdir('/dev/shm') else '/tmp', 'qt-ratelimit')
+            self.counters = SharedMemoryCounters(limit, window_ns, path, shm_slots)
+        elif backend == REDIS:
+            options = {'client': redis_client}
+            if redis_url:
+                options['url'] = redis_url
+            self.counters = RedisCounters(limit, window_ns, **options)
+        else:
+            raise ImproperlyConfigured(f"Unknown RATE_LIMIT_BACKEND '{backend}'")
+
+    def check(self, key):
+        """
+        Returns 0 if the request is allowed, else the Retry-After in seconds.
+        """
+        if self.counters is None:
+            return 0
+        return self.counters.hit(key, time.time_ns())
+
+
+# Global instance, configured from settings in AccountsConfig.ready()
+rate_limiter = RateLimiter()
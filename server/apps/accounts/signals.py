@@ -0,0 +1,18 @@
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from .identity_cache import identity_cache
+from .models import User
+
+
+@receiver(post_save, sender=User)
+def invalidate_identity_on_save(sender, instance, update_fields=None, **kwargs):
+    # Heartbeats only touch presence columns, which the cached identity doesn't depend on.
+    if update_fields and set(update_fields) <= set(User.PRESENCE_FIELDS):
+        return
+    identity_cache.invalidate_user(instance)
+
+
+@receiver(post_delete, sender=User)
+def invalidate_identity_on_delete(sender, instance, **kwargs):
+    identity_cache.invalidate_user(instance)
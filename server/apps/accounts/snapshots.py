@@ -0,0 +1,185 @@
+import fcntl
+import logging
+import os
+import random
+import threading
+import time
+
+from django.db.models import Q
+
+from .broadcaster import broadcaster
+
+logger = logging.getLogger(__name__)
+
+SOURCE_DB = 'db'
+SOURCE_INDEX = 'index'
+
+
+class SnapshotEmitter:
+    """
+    Every `interval` seconds, broadcasts everyone seen within the last `window`
+    seconds as compressed TYPE_SNAPSHOT chunks (codec.SnapshotEncoder), so a
+    listener that starts late or lost datagrams has the complete online table
+    after one snapshot. A snapshot costs about 16 bytes per user, against about
+    42 in update frames.
+
+    Chunks are paced to at most `rate` datagrams per second, which bounds the
+    bandwidth (rate x BROADCAST_MAX_DATAGRAM) and spreads the work over the
+    interval. Users are read from accounts.User in keyset-paginated pages of
+    `page_size` on the last_seen_ns index (source 'db', one page in memory), or
+    from this worker's presence index ('index', no queries once it is loaded).
+
+    Only web workers start the emitter thread (gunicorn.conf.py), not the
+    sweeper or other management commands, and only the one holding an flock on
+    `lock_path` emits. It keeps the lock until it exits, then another worker
+    takes over. Replicas of the web service must share the lock file's directory
+    (a volume on the same host; flock isn't reliable over network filesystems).
+    Without a lock path, every worker emits (fine for a single process).
+    """
+
+    def __init__(self):
+        self.interval = 0.0
+        self.window_ns = int(90 * 1e9)
+        self.rate = 200.0
+        self.source = SOURCE_DB
+        self.lock_path = ''
+        self.page_size = 1000
+
+        self._snapshot_id = random.getrandbits(32)
+        self._lock_fd = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+        os.register_at_fork(after_in_child=self._after_fork)
+
+    @property
+    def enabled(self):
+        return self.interval > 0
+
+    def configure(self, interval=None, window=None, rate=None, source=None, lock_path=None, page_size=None):
+        if source is not None and source not in (SOURCE_DB, SOURCE_INDEX):
+            raise ValueError(f"Unknown snapshot source '{source}'")
+        if interval is not None:
+            self.interval = interval
+        if window is not None:
+            self.window_ns = int(window * 1e9)
+        if rate is not None:
+            self.rate = rate
+        if source is not None:
+            self.source = source
+        if lock_path is not None:
+            self.lock_path = lock_path
+        if page_size is not None:
+            self.page_size = max(page_size, 1)
+
+    def ensure_started(self):
+        """
+        Starts this process's emitter thread if snapshots are enabled.
+        """
+        if not self.enabled or self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            threading.Thread(target=self._run, name='presence-snapshot', daemon=True).start()
+
+    def emit(self, now_ns=None):
+        """
+        Broadcasts one snapshot on the calling thread. Returns (users, datagrams).
+        """
+        since_ns = (now_ns or time.time_ns()) - self.window_ns
+        self._snapshot_id = (self._snapshot_id + 1) % (1 << 32)
+        pause = 1.0 / self.rate if self.rate > 0 else 0.0
+
+        users = datagrams = 0
+        next_send = time.monotonic()
+        for count, body in broadcaster.snapshot_chunks(self._records(since_ns), self._snapshot_id, since_ns):
+            if pause:
+                now = time.monotonic()
+                if next_send > now:
+                    time.sleep(next_send - now)
+                next_send = max(next_send, now) + pause
+            if not broadcaster.send_snapshot(count, body):
+                break
+            users += count
+            datagrams += 1
+        return users, datagrams
+
+    def _records(self, since_ns):
+        # (email, last_seen_ns, ip, port) ordered by last_seen_ns
+        if self.source == SOURCE_INDEX:
+            from .presence import presence_index
+            presence_index.refresh()
+            if presence_index.ready:
+                online = presence_index.online(self.window_ns, now_ns=since_ns + self.window_ns)
+                online.reverse()
+                return online
+        return self._records_from_db(since_ns)
+
+    def _records_from_db(self, since_ns):
+        from .models import User
+
+        rows = (
+            User.objects
+            .filter(last_seen_ns__gte=since_ns)
+            .order_by('last_seen_ns', 'pk')
+            .values_list('pk', 'email', 'last_seen_ns', 'ip_address', 'port')
+        )
+        last_seen_ns, pk = since_ns, 0
+        while True:
+            page = list(
+                rows
+                .filter(last_seen_ns__gte=last_seen_ns)
+                .filter(Q(last_seen_ns__gt=last_seen_ns) | Q(pk__gt=pk))
+                [:self.page_size]
+            )
+            for _, email, seen_ns, ip, port in page:
+                yield email, seen_ns, ip, port
+            if len(page) < self.page_size:
+                return
+            pk, last_seen_ns = page[-1][0], page[-1][2]
+
+    def _acquire(self):
+        if not self.lock_path or self._lock_fd is not None:
+            return True
+        os.makedirs(os.path.dirname(self.lock_path) or '.', exist_ok=True)
+        fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            return False
+        self._lock_fd = fd
+        logger.info("Presence snapshots are emitted by pid %d", os.getpid())
+        return True
+
+    def _run(self):
+        from django.db import connection
+
+        # Keep workers (and restarted deployments) from lining up
+        time.sleep(random.uniform(0, self.interval))
+        while True:
+            started = time.monotonic()
+            if self._acquire():
+                try:
+                    users, datagrams = self.emit()
+                    logger.info("Presence snapshot: %d users in %d datagrams in %.0f ms",
+                                users, datagrams, (time.monotonic() - started) * 1000)
+                except Exception as e:
+                    logger.error("Presence snapshot failed: %s", e)
+                finally:
+                    # Django connections are per thread; don't hold this one between snapshots
+                    connection.close()
+            time.sleep(max(self.interval - (time.monotonic() - started), 0.0))
+
+    def _after_fork(self):
+        # The lock belongs to the parent; closing our copy doesn't release it
+        if self._lock_fd is not None:
+            os.close(self._lock_fd)
+        self._lock_fd = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+
+# Global instance, configured from settings in AccountsConfig.ready()
+snapshot_emitter = SnapshotEmitter()
@@ -0,0 +1,106 @@
+import logging
+import time
+
+from django.db import close_old_connections
+from django.db.models import Q
+
+from .broadcaster import broadcaster
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceSweeper:
+    """
+    Marks users offline: anyone whose last_seen_ns is older than `ttl` seconds is
+    broadcast once as a TYPE_OFFLINE record carrying their last known state.
+
+    Each sweep reads only the users that expired since the previous one, with a
+    range query on the last_seen_ns index, in keyset-paginated pages of
+    `batch_size` rows (one batched broadcast per page). At most `max_rows` are
+    emitted per sweep; the rest carry over to the next one, so a mass expiry
+    (e.g. an edge outage) is spread out instead of flooding listeners. Memory is
+    one page, and the cost of a sweep is proportional to the users expiring in it.
+
+    A user who comes back online gets a newer last_seen_ns and is swept again
+    when that one expires. Heartbeats must reach accounts.User within `ttl`
+    (write-behind and the presence reconciler are well inside that), otherwise a
+    late row may already be behind the sweep position.
+
+    The position is kept in memory. On start, users that expired within the last
+    `lookback` seconds are (re)announced. Run one sweeper per deployment
+    (`manage.py sweep_presence`); two would send every event twice.
+    """
+
+    def __init__(self, ttl=90.0, interval=5.0, batch_size=1000, max_rows=100000, lookback=None):
+        self._position = None
+        self.configure(ttl, interval, batch_size, max_rows, lookback)
+
+    def configure(self, ttl=None, interval=None, batch_size=None, max_rows=None, lookback=None):
+        if ttl is not None:
+            self.ttl_ns = int(ttl * 1e9)
+            self.lookback_ns = self.ttl_ns
+        if interval is not None:
+            self.interval = interval
+        if batch_size is not None:
+            self.batch_size = max(batch_size, 1)
+        if max_rows is not None:
+            self.max_rows = max(max_rows, self.batch_size)
+        if lookback is not None:
+            self.lookback_ns = int(lookback * 1e9)
+
+    def sweep(self, now_ns=None):
+        """
+        Broadcasts users that expired since the last sweep. Returns how many.
+        """
+        from .models import User
+
+        cutoff = (now_ns or time.time_ns()) - self.ttl_ns
+        if self._position is None:
+            # (last_seen_ns, pk) of the last swept user; everything before it is done
+            self._position = (max(cutoff - self.lookback_ns, 1), 0)
+
+        expired = (
+            User.objects
+            .filter(last_seen_ns__lt=cutoff)
+            .order_by('last_seen_ns', 'pk')
+            .values_list('pk', 'email', 'last_seen_ns', 'ip_address', 'port')
+        )
+        swept = 0
+        while swept < self.max_rows:
+            last_seen_ns, pk = self._position
+            page = list(
+                expired
+                .filter(last_seen_ns__gte=last_seen_ns)
+                .filter(Q(last_seen_ns__gt=last_seen_ns) | Q(pk__gt=pk))
+                [:min(self.batch_size, self.max_rows - swept)]
+            )
+            if not page:
+                # Nothing older than the cutoff is left to announce
+                self._position = max(self._position, (cutoff, 0))
+                break
+
+            broadcaster.send_offline([(email, seen_ns, ip, port) for _, email, seen_ns, ip, port in page])
+            swept += len(page)
+            self._position = (page[-1][2], page[-1][0])
+
+        return swept
+
+    def run(self):
+        """
+        Sweeps every `interval` seconds until interrupted.
+        """
+        while True:
+            started = time.monotonic()
+            close_old_connections()
+            try:
+                swept = self.sweep()
+                if swept:
+                    logger.info("Presence sweep: %d users offline in %.0f ms",
+                                swept, (time.monotonic() - started) * 1000)
+            except Exception as e:
+                logger.error("Presence sweep failed: %s", e)
+            time.sleep(max(self.interval - (time.monotonic() - started), 0))
+
+
+# Global instance, configured from settings in AccountsConfig.ready()
+presence_sweeper = PresenceSweeper()
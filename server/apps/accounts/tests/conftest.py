@@ -0,0 +1,11 @@
+import pytest
+
+from apps.accounts.identity_cache import identity_cache
+
+
+@pytest.fixture(autouse=True)
+def clear_identity_cache():
+    # Cached users would outlive the test database rows they came from
+    identity_cache.clear()
+    yield
+    identity_cache.clear()
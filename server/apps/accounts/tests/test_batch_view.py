@@ -0,0 +1,42 @@
+from django.test import TestCase, override_settings
+
+from apps.accounts import codec
+from apps.accounts.models import User
+
+
+@override_settings(GATEWAY_CNS=['gateway@qt-test.com'], CLIENT_STATE_WRITE_BEHIND=False)
+class ClientBatchUpdateViewTests(TestCase):
+    def setUp(self):
+        for name in ('good', 'bad', 'empty'):
+            User.objects.create(email=f'{name}@qt-test.com', ip_address='10.0.0.1', port=1)
+
+    def patch(self, body, content_type):
+        return self.client.patch('/api/client/batch', body, content_type=content_type,
+                                 headers={'X-Subject-CN': 'gateway@qt-test.com'})
+
+    def test_json_lines_with_invalid_ip(self):
+        body = '\n'.join((
+            '{"email": "good@qt-test.com", "ip": "192.0.2.7", "port": 4000}',
+            '{"email": "bad@qt-test.com", "ip": "not-an-ip", "port": 4001}',
+            '{"email": "empty@qt-test.com", "ip": "", "port": 4002}',
+        ))
+        response = self.patch(body, 'application/x-ndjson')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], [204, 400, 204])
+        self.assertEqual(User.objects.get(email='good@qt-test.com').ip_address, '192.0.2.7')
+        bad = User.objects.get(email='bad@qt-test.com')
+        self.assertEqual((bad.ip_address, bad.port), ('10.0.0.1', 1))
+        self.assertIsNone(User.objects.get(email='empty@qt-test.com').ip_address)
+
+    def test_binary_records_with_empty_ip(self):
+        body = codec.encode_records([
+            ('good@qt-test.com', 0, '2001:db8::7', 4000),
+            ('empty@qt-test.com', 0, '', 4002),
+        ])
+        response = self.patch(body, 'application/octet-stream')
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['status'], [204, 204])
+        self.assertEqual(User.objects.get(email='good@qt-test.com').ip_address, '2001:db8::7')
+        self.assertIsNone(User.objects.get(email='empty@qt-test.com').ip_address)
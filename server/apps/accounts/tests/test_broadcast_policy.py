@@ -0,0 +1,64 @@
+import pytest
+
+from apps.accounts.broadcast_policy import BroadcastPolicy
+
+SECOND_NS = 1_000_000_000
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    """
+    A settable time.monotonic() for the token bucket.
+    """
+    now = [1000.0]
+    monkeypatch.setattr('apps.accounts.broadcast_policy.time.monotonic', lambda: now[0])
+    return now
+
+
+def allowed(policy, count, now_ns=SECOND_NS):
+    # Distinct users, so only the token bucket can suppress them
+    return sum(policy.allow(f'user{i}@qt-test.com', '192.0.2.1', i, now_ns) for i in range(count))
+
+
+def test_disabled_policy_allows_everything():
+    policy = BroadcastPolicy()
+
+    assert allowed(policy, 1000) == 1000
+    assert policy.stats()['tracked_users'] == 0
+
+
+def test_bucket_allows_a_burst_then_refills_at_max_rate(clock):
+    policy = BroadcastPolicy(max_rate=10, burst=5)
+
+    assert allowed(policy, 8) == 5
+    clock[0] += 0.25  # 2.5 tokens
+    assert allowed(policy, 8) == 2
+    clock[0] += 10  # refills up to the burst, not beyond
+    assert allowed(policy, 20) == 5
+    assert policy.stats()['suppressed_rate'] == 3 + 6 + 15
+
+
+def test_burst_defaults_to_one_second_of_max_rate(clock):
+    policy = BroadcastPolicy(max_rate=20)
+
+    assert allowed(policy, 50) == 20
+
+
+def test_rate_suppressed_change_is_retried(clock):
+    policy = BroadcastPolicy(max_rate=1, burst=1, min_interval=30)
+
+    assert policy.allow('a@qt-test.com', '192.0.2.1', 1, SECOND_NS)
+    assert not policy.allow('a@qt-test.com', '192.0.2.2', 2, 2 * SECOND_NS)
+    clock[0] += 1
+    # The suppressed change wasn't recorded, so it still counts as a change
+    assert policy.allow('a@qt-test.com', '192.0.2.2', 2, 3 * SECOND_NS)
+
+
+def test_unchanged_heartbeats_are_suppressed_for_min_interval():
+    policy = BroadcastPolicy(min_interval=30)
+
+    assert policy.allow('a@qt-test.com', '192.0.2.1', 1, SECOND_NS)
+    assert not policy.allow('a@qt-test.com', '192.0.2.1', 1, 20 * SECOND_NS)
+    assert policy.allow('a@qt-test.com', '192.0.2.9', 1, 21 * SECOND_NS)
+    assert policy.allow('a@qt-test.com', '192.0.2.9', 1, 51 * SECOND_NS)
+    assert policy.stats()['suppressed_unchanged'] == 1
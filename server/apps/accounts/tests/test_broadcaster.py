@@ -0,0 +1,84 @@
+import socket
+
+import pytest
+
+from apps.accounts import codec
+from apps.accounts.broadcaster import broadcaster
+
+
+@pytest.fixture
+def receiver():
+    """
+    A local UDP socket the broadcaster sends to for the duration of a test.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind(('127.0.0.1', 0))
+    sock.settimeout(0.2)
+
+    encoder, use_queue = broadcaster._encoder, broadcaster.use_queue
+    _reset_socket()
+    broadcaster.initialize(bind_port=0, target_port=sock.getsockname()[1], mode='unicast', target_host='127.0.0.1')
+    yield sock
+
+    broadcaster.flush()
+    _reset_socket()
+    broadcaster.configure(use_queue=use_queue, batch=encoder.batch, wire_version=encoder.version)
+    sock.close()
+
+
+def _reset_socket():
+    if broadcaster._sock is not None:
+        broadcaster._sock.close()
+    broadcaster._sock = None
+    broadcaster._initialized = False
+    # Lets ensure_initialized() reopen the configured endpoint afterwards
+    broadcaster._endpoint_pid = None
+
+
+def _receive(sock):
+    records = []
+    try:
+        while True:
+            records += codec.decode(sock.recv(65535)).records
+    except socket.timeout:
+        return records
+
+
+RECORDS = [
+    ('a@qt-test.com', 1, '192.0.2.1', 1),
+    ('b@qt-test.com', 2, '192.0.2.2', 70000),
+    ('c@qt-test.com', 3, '192.0.2.3', 3),
+    ('d@qt-test.com', 4, '192.0.2.4', 4),
+]
+
+
+@pytest.mark.parametrize('use_queue', [False, True])
+@pytest.mark.parametrize('version, batch', [(codec.VERSION_1, False), (codec.VERSION_1, True),
+                                            (codec.VERSION_2, False), (codec.VERSION_2, True)])
+def test_bad_record_does_not_drop_the_rest(receiver, use_queue, version, batch):
+    broadcaster.configure(use_queue=use_queue, batch=batch, wire_version=version)
+    errors, sent = broadcaster.send_errors, broadcaster.sent
+
+    broadcaster.send_many(RECORDS)
+    broadcaster.flush()
+
+    assert [record[0] for record in _receive(receiver)] == ['a@qt-test.com', 'c@qt-test.com', 'd@qt-test.com']
+    assert broadcaster.send_errors - errors == 1
+    assert broadcaster.sent - sent == 3
+
+
+def test_offline_frames_share_the_v2_sequence(receiver):
+    broadcaster.configure(use_queue=False, batch=False, wire_version=codec.VERSION_2)
+
+    broadcaster.send_many(RECORDS[:1])
+    broadcaster.send_offline(RECORDS[2:])
+    broadcaster.send_many(RECORDS[3:])
+
+    frames = []
+    try:
+        while True:
+            frames.append(codec.decode(receiver.recv(65535)))
+    except socket.timeout:
+        pass
+    assert [frame.type for frame in frames] == [codec.TYPE_UPDATE, codec.TYPE_OFFLINE, codec.TYPE_UPDATE]
+    assert [codec.seq_gap(a.seq, b.seq) for a, b in zip(frames, frames[1:])] == [0, 0]
@@ -0,0 +1,43 @@
+import pytest
+
+from apps.accounts.fastpath import handle_heartbeat
+from apps.accounts.models import User
+
+CN = 'device@qt-test.com'
+
+
+@pytest.fixture
+def user(db):
+    return User.objects.create(email=CN)
+
+
+def patch(client, port, cn=CN):
+    headers = {'X-Subject-CN': cn, 'X-Real-IP': '192.0.2.10'}
+    if port is not None:
+        headers['X-Real-Port'] = port
+    return client.patch('/api/client', headers=headers)
+
+
+@pytest.mark.parametrize('port, stored', [('4000', 4000), ('0', 0), ('65535', 65535), (None, 0)])
+def test_valid_port_is_stored(client, user, port, stored):
+    assert patch(client, port).status_code == 204
+    user.refresh_from_db()
+    assert (user.ip_address, user.port) == ('192.0.2.10', stored)
+
+
+@pytest.mark.parametrize('port', ['70000', '-1', 'abc', '4000.5'])
+def test_invalid_port_is_rejected(client, user, port):
+    response = patch(client, port)
+
+    assert response.status_code == 400
+    user.refresh_from_db()
+    assert user.ip_address is None
+
+
+def test_identity_is_checked_before_the_port(client, db):
+    assert patch(client, '70000', cn='nobody@qt-test.com').status_code == 403
+
+
+@pytest.mark.parametrize('port, status', [(4000, 204), (None, 400)])
+def test_fast_path_rejects_invalid_port(user, port, status):
+    assert handle_heartbeat(CN, '192.0.2.10', port)[0] == status
@@ -0,0 +1,98 @@
+import pytest
+
+from apps.accounts import codec
+
+RECORDS = [
+    ('a@qt-test.com', 1_700_000_000_000_000_001, '192.0.2.1', 1),
+    ('b@qt-test.com', 1_700_000_000_000_000_002, '2001:db8::2', 65535),
+    ('c@qt-test.com', 1_700_000_000_000_000_003, '', 0),
+]
+
+
+def decode_all(encoder, records, record_type=codec.TYPE_UPDATE, **kwargs):
+    frames = []
+    for payload, count in encoder.frames(records, record_type, **kwargs):
+        frame = codec.decode(bytes(payload))
+        assert len(frame.records) == count
+        frames.append(frame)
+    return frames
+
+
+@pytest.mark.parametrize('version', [codec.VERSION_1, codec.VERSION_2])
+@pytest.mark.parametrize('batch', [False, True])
+def test_round_trip(version, batch):
+    frames = decode_all(codec.Encoder(version=version, batch=batch), RECORDS)
+
+    assert [record for frame in frames for record in frame.records] == RECORDS
+    assert len(frames) == (1 if batch else len(RECORDS))
+    assert {frame.version for frame in frames} == {version}
+
+
+def test_v2_sequence_and_type():
+    encoder = codec.Encoder(version=codec.VERSION_2)
+    encoder.seq = codec.SEQ_MODULO - 1
+
+    frames = decode_all(encoder, RECORDS[:2], codec.TYPE_OFFLINE)
+
+    assert [frame.seq for frame in frames] == [codec.SEQ_MODULO - 1, 0]
+    assert {frame.type for frame in frames} == {codec.TYPE_OFFLINE}
+
+
+def test_v2_batches_split_at_max_datagram():
+    records = [(f'user{i:04d}@qt-test.com', i, '10.0.0.1', i) for i in range(500)]
+    encoder = codec.Encoder(version=codec.VERSION_2, batch=True, max_datagram=512)
+
+    payloads = [bytes(payload) for payload, _ in encoder.frames(records)]
+
+    assert len(payloads) > 1
+    assert max(len(payload) for payload in payloads) <= 512
+    assert [record for payload in payloads for record in codec.decode(payload).records] == records
+
+
+def test_bare_records_round_trip():
+    assert codec.decode_records(codec.encode_records(RECORDS)) == RECORDS
+
+
+@pytest.mark.parametrize('data', [b'', b'\xff\x02', b'\xff\x09\x01\x00\x00\x00\x00\x01', b'\x05abc'])
+def test_malformed_datagrams_raise_value_error(data):
+    with pytest.raises(ValueError):
+        codec.decode(data)
+
+
+@pytest.mark.parametrize('previous, seq, gap', [
+    (1, 2, 0),
+    (1, 5, 3),
+    (codec.SEQ_MODULO - 1, 0, 0),
+    (codec.SEQ_MODULO - 2, 1, 2),
+    (5, 3, 0),  # reordered or restarted sender, not loss
+    (5, 5, 0),
+])
+def test_seq_gap(previous, seq, gap):
+    assert codec.seq_gap(previous, seq) == gap
+
+
+BAD_RECORDS = [
+    ('a@qt-test.com', 1, '192.0.2.1', 1),
+    ('b@qt-test.com', 2, '192.0.2.2', 70000),
+    ('c' * 300 + '@qt-test.com', 3, '192.0.2.3', 3),
+    ('d@qt-test.com', 4, '192.0.2.4', 4),
+    ('e@qt-test.com', -1, '192.0.2.5', 5),
+    ('f@qt-test.com', 6, '192.0.2.6', 6),
+]
+
+
+@pytest.mark.parametrize('version', [codec.VERSION_1, codec.VERSION_2])
+@pytest.mark.parametrize('batch', [False, True])
+def test_unencodable_records_are_skipped(version, batch):
+    skipped = []
+    frames = decode_all(codec.Encoder(version=version, batch=batch), BAD_RECORDS,
+                        on_error=lambda record, error: skipped.append(record))
+
+    sent = [record for frame in frames for record in frame.records]
+    assert [record[0] for record in sent] == ['a@qt-test.com', 'd@qt-test.com', 'f@qt-test.com']
+    assert skipped == [BAD_RECORDS[1], BAD_RECORDS[2], BAD_RECORDS[4]]
+
+
+def test_unencodable_record_raises_without_on_error():
+    with pytest.raises(codec.ENCODE_ERRORS):
+        list(codec.Encoder(version=codec.VERSION_2).frames(BAD_RECORDS))
@@ -0,0 +1,56 @@
+import pytest
+
+from apps.accounts.identity_cache import NOT_FOUND, IdentityCache
+from apps.accounts.metrics import metrics
+
+
+def counters():
+    """
+    The identity cache samples of the /metrics exposition, by label.
+    """
+    samples = {}
+    for line in metrics.render().splitlines():
+        if line.startswith('qt_identity_cache_'):
+            labels, value = line.split(' ')
+            samples[labels[labels.index('"') + 1:labels.rindex('"')]] = int(value)
+    return samples
+
+
+@pytest.fixture
+def counted(monkeypatch):
+    """
+    Returns the change of each identity cache counter since the fixture was set up.
+    """
+    monkeypatch.setattr(metrics, 'enabled', True)
+    before = counters()
+    return lambda: {label: value - before[label] for label, value in counters().items() if value != before[label]}
+
+
+def test_lookups_and_removals_are_exported(counted, monkeypatch):
+    cache = IdentityCache(maxsize=2, negative_ttl=30.0)
+    clock = [100.0]
+    monkeypatch.setattr('apps.accounts.identity_cache.time.monotonic', lambda: clock[0])
+
+    assert cache.get('a@qt-test.com') is None
+    cache.set('a@qt-test.com', NOT_FOUND)
+    assert cache.get('a@qt-test.com') == (NOT_FOUND, None)
+    cache.set('b@qt-test.com', NOT_FOUND)
+    cache.set('c@qt-test.com', NOT_FOUND)  # evicts a@
+    cache.invalidate('b@qt-test.com')
+    clock[0] += 60
+    assert cache.get('c@qt-test.com') is None  # expired
+
+    assert counted() == {'hit': 1, 'miss': 2, 'evicted': 1, 'invalidated': 1, 'expired': 1}
+    assert {key: cache.stats()[key] for key in ('hits', 'misses', 'evictions', 'invalidations')} == {
+        'hits': 1, 'misses': 2, 'evictions': 1, 'invalidations': 1,
+    }
+
+
+def test_shrinking_counts_evictions(counted):
+    cache = IdentityCache(maxsize=5)
+    for i in range(5):
+        cache.set(f'user{i}@qt-test.com', NOT_FOUND)
+
+    cache.configure(maxsize=2)
+
+    assert counted() == {'evicted': 3}
@@ -0,0 +1,57 @@
+import threading
+
+from apps.accounts.models import User
+from apps.accounts.presence import PresenceIndex
+
+
+def test_online_and_page_are_newest_first():
+    index = PresenceIndex()
+    index.update('a@qt-test.com', 10_000_000_000, '192.0.2.1', 1)
+    index.update('b@qt-test.com', 12_500_000_000, '192.0.2.2', 2)
+    index.update('c@qt-test.com', 12_000_000_000, None, 3)
+    index.update('a@qt-test.com', 9_000_000_000, '192.0.2.9', 9)  # older, ignored
+
+    assert [user[0] for user in index.online(2_000_000_000, now_ns=13_000_000_000)] == \
+        ['b@qt-test.com', 'c@qt-test.com']
+    assert index.page(2, offset=1) == [('c@qt-test.com', 12_000_000_000, None, 3),
+                                       ('a@qt-test.com', 10_000_000_000, '192.0.2.1', 1)]
+    assert index.get('a@qt-test.com') == (10_000_000_000, '192.0.2.1', 1)
+
+
+def test_update_moves_user_between_buckets():
+    index = PresenceIndex()
+    index.update('a@qt-test.com', 1_000_000_000, None, 1)
+    index.update('a@qt-test.com', 5_000_000_000, None, 1)
+
+    assert index.page(10) == [('a@qt-test.com', 5_000_000_000, None, 1)]
+    assert len(index) == 1
+
+
+def test_sync_loads_the_database(db):
+    User.objects.create(email='a@qt-test.com', last_seen_ns=2_000_000_000, ip_address='192.0.2.1', port=1)
+    User.objects.create(email='never@qt-test.com')
+    index = PresenceIndex()
+
+    assert not index.ready
+    index.sync()
+
+    assert index.ready
+    assert index.page(10) == [('a@qt-test.com', 2_000_000_000, '192.0.2.1', 1)]
+
+
+def test_refresh_never_syncs_on_the_calling_thread(db, django_assert_num_queries, monkeypatch):
+    index = PresenceIndex(sync_interval=60)
+    synced = threading.Event()
+    threads = []
+
+    def sync():
+        threads.append(threading.current_thread().name)
+        synced.set()
+    monkeypatch.setattr(index, 'sync', sync)
+
+    with django_assert_num_queries(0):
+        for _ in range(100):
+            index.refresh()
+
+    assert synced.wait(5)
+    assert threads == ['presence-sync']
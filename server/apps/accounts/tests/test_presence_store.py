@@ -0,0 +1,146 @@
+import os
+
+import fakeredis
+import pytest
+
+from apps.accounts.models import User
+from apps.accounts.presence_store import MEMORY, POSTGRES, REDIS, PresenceStore
+
+BASE_NS = 1_700_000_000_000_000_000
+
+
+@pytest.fixture
+def users(db):
+    return [User.objects.create(email=f'user{i}@qt-test.com') for i in range(7)]
+
+
+@pytest.fixture
+def redis_client():
+    client = fakeredis.FakeRedis()
+    yield client
+    client.flushall()
+
+
+@pytest.fixture
+def store(redis_client):
+    """
+    Returns a factory for a PresenceStore on the given backend, with a small batch size so reconcile pages.
+    """
+    def make(backend, batch_size=3):
+        store = PresenceStore()
+        store.configure(backend=backend, batch_size=batch_size, redis_client=redis_client)
+        # Tests reconcile explicitly; keep the background reconciler from starting
+        store._pid = os.getpid()
+        return store
+    return make
+
+
+def records(users, offset=0):
+    return [(user.pk, user.email, BASE_NS + offset + i, f'192.0.2.{i}', 1000 + i) for i, user in enumerate(users)]
+
+
+def presence(user):
+    user.refresh_from_db()
+    return user.last_seen_ns, user.ip_address, user.port
+
+
+@pytest.mark.parametrize('backend', [MEMORY, REDIS])
+def test_write_then_reconcile(store, users, backend):
+    store = store(backend)
+    store.write_many(records(users))
+
+    assert store.backend.get(users[3].pk) == (BASE_NS + 3, '192.0.2.3', 1003)
+    assert presence(users[3]) == (0, None, 0)
+    assert store.reconcile() == len(users)
+    assert [presence(user) for user in users] == [record[2:] for record in records(users)]
+    # Nothing changed since, so the next pass writes nothing
+    assert store.reconcile() == 0
+
+
+def test_memory_newest_state_wins(store, users):
+    store = store(MEMORY)
+    user = users[0]
+    store.write_many([(user.pk, user.email, BASE_NS + 20, '192.0.2.20', 20)])
+    store.write_many([(user.pk, user.email, BASE_NS + 10, '192.0.2.10', 10)])
+
+    assert store.backend.get(user.pk)[0] == BASE_NS + 20
+    store.reconcile()
+    assert presence(user) == (BASE_NS + 20, '192.0.2.20', 20)
+
+
+def test_redis_drain_pages_through_tied_scores(store, users):
+    store = store(REDIS)
+    # Several users per score, so pages end in the middle of a run of equal scores
+    store.write_many([(user.pk, user.email, BASE_NS + i // 3 * 1000, None, i) for i, user in enumerate(users)])
+
+    pages = list(store.backend.drain(2))
+
+    assert [len(page) for page in pages] == [2, 2, 2, 1]
+    assert sorted(row[0] for page in pages for row in page) == sorted(user.pk for user in users)
+
+
+def test_redis_commit_moves_the_high_water_mark(store, users):
+    store = store(REDIS)
+    store.write_many(records(users[:3]))
+    assert store.reconcile() == 3
+    assert int(store.backend.client.get(store.backend.reconciled_key)) == BASE_NS + 2
+
+    # Only the users that moved past the mark (less the overlap) are read again. Scores are
+    # doubles, so the new ones must clear the mark by more than their precision (256ns here).
+    store.backend.overlap_ns = 0
+    store.backend.client.delete(store.backend.lock_key)
+    store.write_many(records(users[3:], offset=10_000))
+    assert [row[0] for page in store.backend.drain(10) for row in page] == [user.pk for user in users[3:]]
+
+
+def test_redis_lock_contention(store, users):
+    first, second = store(REDIS), store(REDIS)
+    first.write_many(records(users))
+    second.backend.client.set(second.backend.lock_key, 'another worker')
+
+    assert first.reconcile() == 0
+    assert presence(users[0]) == (0, None, 0)
+
+    second.backend.client.delete(second.backend.lock_key)
+    assert first.reconcile() == len(users)
+    # The winner holds the lock until it expires, so a second worker skips this interval
+    assert second.reconcile() == 0
+
+
+def test_redis_drain_stops_when_the_lock_is_lost(store, users):
+    store = store(REDIS)
+    store.write_many(records(users))
+    pages = store.backend.drain(3)
+
+    assert len(next(pages)) == 3
+    store.backend.client.set(store.backend.lock_key, 'another worker')
+    assert list(pages) == []
+
+
+def test_memory_requeues_pages_left_by_a_failed_reconcile(store, users):
+    store = store(MEMORY)
+    store.write_many(records(users))
+    with pytest.MonkeyPatch.context() as patch:
+        patch.setattr('apps.accounts.write_behind.write_presence_rows',
+                      lambda rows, batch_size, name: (0, rows))
+        assert store.reconcile() == 0
+
+    assert store.reconcile() == len(users)
+    assert [presence(user) for user in users] == [record[2:] for record in records(users)]
+
+
+def test_postgres_writes_through(store, users):
+    store = store(POSTGRES)
+    user = users[0]
+    user.last_seen_ns, user.ip_address, user.port = BASE_NS + 5, '192.0.2.5', 5
+    store.write(user)
+    assert presence(user) == (BASE_NS + 5, '192.0.2.5', 5)
+
+    # Never moves backwards
+    user.last_seen_ns, user.ip_address, user.port = BASE_NS + 1, '192.0.2.1', 1
+    store.write(user)
+    assert presence(user) == (BASE_NS + 5, '192.0.2.5', 5)
+
+    store.write_many(records(users[1:3]))
+    assert presence(users[2]) == (BASE_NS + 1, '192.0.2.1', 1001)
+    assert store.reconcile() == 0
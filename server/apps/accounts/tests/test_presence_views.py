@@ -0,0 +1,47 @@
+import pytest
+
+from apps.accounts.models import User
+
+READER = 'dashboard@qt-test.com'
+DEVICE = 'device@qt-test.com'
+OTHER = 'other@qt-test.com'
+
+
+@pytest.fixture(autouse=True)
+def users(db, settings):
+    settings.PRESENCE_READER_CNS = [READER]
+    # Answer from the database; the index is covered in test_presence_index.py
+    settings.PRESENCE_INDEX = False
+    User.objects.create(email=READER)
+    User.objects.create(email=DEVICE, last_seen_ns=2_000_000_000, ip_address='192.0.2.1', port=1)
+    User.objects.create(email=OTHER, last_seen_ns=3_000_000_000, ip_address='192.0.2.2', port=2)
+
+
+def get(client, path, cn):
+    headers = {'X-Subject-CN': cn} if cn else {}
+    return client.get(path, headers=headers)
+
+
+@pytest.mark.parametrize('path', ['/api/presence', '/api/presence/online', f'/api/presence/{OTHER}'])
+@pytest.mark.parametrize('cn, status', [(None, 401), ('nobody@qt-test.com', 403), (DEVICE, 403)])
+def test_only_readers_list_or_read_others(client, path, cn, status):
+    response = get(client, path, cn)
+
+    assert response.status_code == status
+    assert b'192.0.2.2' not in response.content
+
+
+def test_client_reads_its_own_record(client):
+    response = get(client, f'/api/presence/{DEVICE}', DEVICE)
+
+    assert response.status_code == 200
+    assert response.json()['ip'] == '192.0.2.1'
+
+
+def test_reader_lists_everyone(client):
+    response = get(client, '/api/presence', READER)
+
+    assert response.status_code == 200
+    assert [user['email'] for user in response.json()['users']] == [OTHER, DEVICE]
+    assert get(client, f'/api/presence/{OTHER}', READER).json()['port'] == 2
+    assert get(client, '/api/presence/online?within=1000000000', READER).status_code == 200
@@ -0,0 +1,99 @@
+import pytest
+from django.db import IntegrityError, OperationalError
+
+from apps.accounts.models import User, UserManager
+from apps.accounts.presence_store import MemoryBackend, PresenceStore
+from apps.accounts.write_behind import WriteBehindBuffer
+
+
+@pytest.fixture
+def users(db):
+    return [User.objects.create(email=f'user{i}@qt-test.com') for i in range(6)]
+
+
+@pytest.fixture
+def reject(monkeypatch):
+    """
+    Makes bulk_update_presence() raise `error` for any batch containing one of `user_ids`.
+    """
+    write = UserManager.bulk_update_presence
+    calls = []
+
+    def install(user_ids, error=IntegrityError("rejected")):
+        def bulk_update_presence(manager, rows):
+            calls.append([row[0] for row in rows])
+            if any(row[0] in user_ids for row in rows):
+                raise error
+            return write(manager, rows)
+        monkeypatch.setattr(UserManager, 'bulk_update_presence', bulk_update_presence)
+        return calls
+    return install
+
+
+def presence(user):
+    user.refresh_from_db()
+    return user.last_seen_ns, user.ip_address, user.port
+
+
+def test_newest_state_wins(users):
+    buffer = WriteBehindBuffer(batch_size=10)
+    user = users[0]
+    buffer._merge(user.pk, (200, '192.0.2.2', 2))
+    buffer._merge(user.pk, (100, '192.0.2.1', 1))  # older, arrived late
+    buffer._merge(user.pk, (300, '192.0.2.3', 3))
+    buffer._merge(user.pk, (250, '192.0.2.4', 4))
+
+    assert buffer.pending() == 1
+    assert buffer.flush() == 1
+    assert presence(user) == (300, '192.0.2.3', 3)
+    assert buffer.pending() == 0
+
+
+def test_flush_never_moves_last_seen_backwards(users):
+    user = users[0]
+    User.objects.filter(pk=user.pk).update(last_seen_ns=500, ip_address='192.0.2.5', port=5)
+    buffer = WriteBehindBuffer()
+    buffer._merge(user.pk, (400, '192.0.2.4', 4))
+
+    assert buffer.flush() == 0
+    assert presence(user) == (500, '192.0.2.5', 5)
+
+
+def test_rejected_row_is_dropped_and_the_rest_written(users, reject):
+    calls = reject({users[2].pk})
+    buffer = WriteBehindBuffer(batch_size=4)
+    for i, user in enumerate(users):
+        buffer._merge(user.pk, (100 + i, f'192.0.2.{i}', i))
+
+    assert buffer.flush() == 5
+    assert buffer.pending() == 0
+    assert presence(users[2]) == (0, None, 0)
+    assert [presence(user)[0] for i, user in enumerate(users) if i != 2] == [100, 101, 103, 104, 105]
+    # The second batch was written even though the first one failed
+    assert [users[4].pk, users[5].pk] in calls
+
+
+def test_unavailable_database_retains_everything_unwritten(users, reject):
+    reject({users[4].pk}, OperationalError("connection lost"))
+    buffer = WriteBehindBuffer(batch_size=4)
+    for i, user in enumerate(users):
+        buffer._merge(user.pk, (100 + i, None, i))
+    buffer._merge(users[5].pk, (50, None, 0))
+
+    assert buffer.flush() == 4
+    assert buffer.pending() == 2
+    assert buffer._pending[users[5].pk] == (105, None, 5)
+
+
+def test_reconcile_drops_rejected_rows(users, reject):
+    reject({users[1].pk})
+    store = PresenceStore()
+    store.backend = MemoryBackend()
+    store.batch_size = 4
+    store.backend.write_many([(user.pk, user.email, 100 + i, None, i) for i, user in enumerate(users)])
+
+    assert store.reconcile() == 5
+    # Nothing left to retry: the rejected row isn't requeued forever
+    assert list(store.backend.drain(10)) == []
+    assert presence(users[1]) == (0, None, 0)
+    assert presence(users[5]) == (105, None, 5)
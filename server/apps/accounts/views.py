@@ -1,9 +1,19 @@
+import ipaddress
+import json
 import time
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
 from django.views import View
-from django.http import HttpResponse
+from django.http import HttpResponse, JsonResponse
 from django.utils.decorators import method_decorator
 from django.views.decorators.csrf import csrf_exempt
+from . import codec
+from .broadcast_policy import broadcast_policy
+from .event_log import event_log
+from .metrics import metrics
 from .models import User
+from .presence_store import presence_store
 
 # Minimal "Service" specific to this assessment
 class ClientService:
@@ -12,14 +22,156 @@ class ClientService:
         """
         Updates the user's state and triggers the broadcast.
         """
+        start = time.perf_counter_ns()
+        ClientService._apply_state(user, ip_address, port)
+        ClientService._index(user)
+
+        write_start = time.perf_counter_ns()
+        # Postgres (optionally write-behind), in-process or Redis, per PRESENCE_BACKEND
+        presence_store.write(user)
+        metrics.observe('db_write', time.perf_counter_ns() - write_start)
+        # Durable history for listeners that missed broadcasts (EVENT_LOG_DIR)
+        event_log.append(((user.email, user.last_seen_ns, user.ip_address, user.port),))
+
+        # Ensure we have data to send, and that it's news (see broadcast_policy.py)
+        if user.ip_address and broadcast_policy.allow(user.email, user.ip_address, user.port, user.last_seen_ns):
+             from .broadcaster import broadcaster
+             broadcaster.send(user.email, user.last_seen_ns, user.ip_address, user.port)
+        metrics.observe('update_client_state', time.perf_counter_ns() - start)
+
+    @staticmethod
+    async def aupdate_client_state(user: User, ip_address: str, port: int) -> None:
+        """
+        Async counterpart of update_client_state() for the ASGI path.
+        """
+        start = time.perf_counter_ns()
+        ClientService._apply_state(user, ip_address, port)
+        ClientService._index(user)
+
+        write_start = time.perf_counter_ns()
+        await presence_store.awrite(user)
+        metrics.observe('db_write', time.perf_counter_ns() - write_start)
+        event_log.append(((user.email, user.last_seen_ns, user.ip_address, user.port),))
+
+        if user.ip_address and broadcast_policy.allow(user.email, user.ip_address, user.port, user.last_seen_ns):
+             from .broadcaster import broadcaster
+             await broadcaster.asend(user.email, user.last_seen_ns, user.ip_address, user.port)
+        metrics.observe('update_client_state', time.perf_counter_ns() - start)
+
+    @staticmethod
+    def update_many(items):
+        """
+        Batch counterpart of update_client_state() for gateways: validates every
+        email, resolves the users with one query (identity cache first), writes
+        them in one bulk statement and broadcasts them as one batch.
+        Returns a status code per item (204 / 400 / 403).
+        """
+        from .identity_cache import NOT_FOUND, VALID, identity_cache
+
+        # 1. Validate
+        emails = {}
+        for item in items:
+            if item is not None and item[0] not in emails:
+                try:
+                    validate_email(item[0])
+                    emails[item[0]] = None
+                except ValidationError:
+                    pass
+
+        # 2. Resolve: identity cache, then one email__in query for the rest
+        missing = []
+        for email in emails:
+            cached = identity_cache.get(email)
+            if cached is None:
+                missing.append(email)
+            elif cached[0] == VALID:
+                emails[email] = cached[1]
+        if missing:
+            found = {user.email: user for user in User.objects.filter(email__in=missing)}
+            for email in missing:
+                user = found.get(email)
+                identity_cache.set(email, VALID if user else NOT_FOUND, user)
+                emails[email] = user
+
+        # 3. Write and broadcast
+        now = time.time_ns()
+        statuses = []
+        latest = {}
+        for item in items:
+            if item is None or item[0] not in emails:
+                statuses.append(400)
+                continue
+            user = emails[item[0]]
+            if user is None:
+                statuses.append(403)
+                continue
+            statuses.append(204)
+            # Same stamp for the whole batch; a repeated email keeps its last item
+            latest[user.pk] = (user.pk, user.email, now, item[1], item[2])
+
+        records = list(latest.values())
+        presence_store.write_many(records)
+        event_log.append([(email, last_seen_ns, ip_address, port)
+                          for _, email, last_seen_ns, ip_address, port in records])
+        if settings.PRESENCE_INDEX:
+            from .presence import presence_index
+            for _, email, last_seen_ns, ip_address, port in records:
+                presence_index.update(email, last_seen_ns, ip_address, port)
+
+        from .broadcaster import broadcaster
+        broadcaster.send_many(broadcast_policy.filter([(email, last_seen_ns, ip_address, port)
+                                                       for _, email, last_seen_ns, ip_address, port in records
+                                                       if ip_address]))
+        return statuses
+
+    @staticmethod
+    def _apply_state(user: User, ip_address: str, port: int) -> None:
         user.last_seen_ns = time.time_ns()
         user.ip_address = ip_address
         user.port = port
-        user.save()
 
-        if user.ip_address: # Ensure we have data to send
-             from .broadcaster import broadcaster
-             broadcaster.send(user.email, user.last_seen_ns, user.ip_address, user.port)
+    @staticmethod
+    def _index(user: User) -> None:
+        if settings.PRESENCE_INDEX:
+            from .presence import presence_index
+            presence_index.update(user.email, user.last_seen_ns, user.ip_address, user.port)
+
+
+def identity_error(cn, mtls_error, authenticated):
+    """
+    (status, message) for a failed mTLS identity, or None if authenticated.
+    Shared by the views and the fast path (fastpath.py).
+    """
+    # Case: No Header (Nginx bypass or config error) -> 401 Unauthorized
+    if not cn:
+        return 401, "Missing Client Certificate Header"
+
+    # Case: Invalid CN Format -> 400 Bad Request
+    if mtls_error == "Invalid CN format":
+        return 400, "CN must be a valid email address"
+
+    # Case: User Not Found -> 403 Forbidden
+    if mtls_error == "User not found" or not authenticated:
+        return 403, "User unknown"
+
+    return None
+
+
+def parse_port(value):
+    """
+    Returns the X-Real-Port value as an int (0 if absent), or None if it isn't
+    a port number (callers respond 400; it would not fit the broadcast records).
+    """
+    if value is None or value == '':
+        return 0
+    try:
+        port = int(value)
+    except (TypeError, ValueError):
+        return None
+    return port if 0 <= port <= 65535 else None
+
+
+INVALID_PORT = "Invalid X-Real-Port"
 
 
 @method_decorator(csrf_exempt, name='dispatch')
@@ -30,25 +182,41 @@ class ClientUpdateView(View):
     """
 
     def patch(self, request, *args, **kwargs):
+        start = time.perf_counter_ns()
         # 1. Validation Logic
+        error_response = self.check_identity(request)
+        if error_response:
+            return error_response
 
-        # Check for middleware errors first (SoC)
-        mtls_error = getattr(request, 'mtls_error', None)
-        cn = request.headers.get('X-Subject-CN')
+        # 2. Extract Network Info (IP/Port)
+        ip_addr, port = self.client_address(request)
+        if port is None:
+            return HttpResponse(status=400, content=INVALID_PORT)
 
-        # Case: No Header (Nginx bypass or config error) -> 401 Unauthorized
-        if not cn:
-             return HttpResponse(status=401, content="Missing Client Certificate Header")
+        # 3. Update User
+        ClientService.update_client_state(request.user, ip_addr, port)
 
-        # Case: Invalid CN Format -> 400 Bad Request
-        if mtls_error == "Invalid CN format":
-             return HttpResponse(status=400, content="CN must be a valid email address")
+        metrics.observe('view', time.perf_counter_ns() - start)
+        return HttpResponse(status=204) # 204 No Content for successful PATCH
 
-        # Case: User Not Found -> 403 Forbidden
-        if mtls_error == "User not found" or not request.user.is_authenticated:
-            return HttpResponse(status=403, content="User unknown")
+    @staticmethod
+    def check_identity(request):
+        """
+        Maps the middleware's authentication outcome to an error response, or None if authenticated.
+        """
+        # Check for middleware errors first (SoC)
+        user = getattr(request, 'user', None)
+        error = identity_error(
+            request.headers.get('X-Subject-CN'),
+            getattr(request, 'mtls_error', None),
+            user is not None and user.is_authenticated,
+        )
+        if error:
+            return HttpResponse(status=error[0], content=error[1])
+        return None
 
-        # 2. Extract Network Info (IP/Port)
+    @staticmethod
+    def client_address(request):
         # In a real proxy setup, we look at X-Real-IP.
         # Port is tricky; usually the source port of the connection to Nginx is lost unless
         # Nginx passes it via a custom header (e.g. X-Real-Port).
@@ -59,12 +227,238 @@ class ClientUpdateView(View):
         # We will assume a hypothetical `X-Real-Port` or defaulted to 0 if missing.
 
         ip_addr = request.headers.get('X-Real-IP', request.META.get('REMOTE_ADDR'))
+        return ip_addr, parse_port(request.headers.get('X-Real-Port', '0'))
+
+
+class AsyncClientUpdateView(ClientUpdateView):
+    """
+    ASGI variant of ClientUpdateView: same status codes, but the DB write and
+    the UDP broadcast are awaited instead of holding a worker thread.
+    """
+
+    async def patch(self, request, *args, **kwargs):
+        start = time.perf_counter_ns()
+        error_response = self.check_identity(request)
+        if error_response:
+            return error_response
+
+        ip_addr, port = self.client_address(request)
+        if port is None:
+            return HttpResponse(status=400, content=INVALID_PORT)
+        await ClientService.aupdate_client_state(request.user, ip_addr, port)
+
+        metrics.observe('view', time.perf_counter_ns() - start)
+        return HttpResponse(status=204)
+
+
+@method_decorator(csrf_exempt, name='dispatch')
+class ClientBatchUpdateView(View):
+    """
+    Handles PATCH api/client/batch from a trusted gateway (X-Subject-CN in GATEWAY_CNS)
+    reporting heartbeats for many devices at once.
+
+    Body is either JSON lines, one {"email": ..., "ip": ..., "port": ...} per line,
+    or (Content-Type: application/octet-stream) a bare run of v2 wire records
+    (see codec.py; last_seen_ns is ignored, the server stamps it).
+
+    Responds 200 with one status per item, in order: 204 updated, 400 invalid
+    item or email, 403 unknown user (the same codes as api/client).
+    """
+
+    def patch(self, request, *args, **kwargs):
+        start = time.perf_counter_ns()
+        cn = request.headers.get('X-Subject-CN')
+        if not cn:
+            return HttpResponse(status=401, content="Missing Client Certificate Header")
+        if cn not in settings.GATEWAY_CNS:
+            return HttpResponse(status=403, content="Not a gateway")
+
         try:
-             port = int(request.headers.get('X-Real-Port', '0'))
+            items = self.parse_items(request)
         except ValueError:
-             port = 0
+            return HttpResponse(status=400, content="Malformed batch body")
+        if len(items) > settings.GATEWAY_BATCH_MAX_ITEMS:
+            return HttpResponse(status=413, content=f"At most {settings.GATEWAY_BATCH_MAX_ITEMS} items per batch")
 
-        # 3. Update User
-        ClientService.update_client_state(request.user, ip_addr, port)
+        statuses = ClientService.update_many(items)
 
-        return HttpResponse(status=204) # 204 No Content for successful PATCH
+        metrics.observe('gateway_batch', time.perf_counter_ns() - start)
+        return JsonResponse({
+            'updated': statuses.count(204),
+            'invalid': statuses.count(400),
+            'unknown': statuses.count(403),
+            'status': statuses,
+        })
+
+    @staticmethod
+    def parse_items(request):
+        """
+        Returns a list of (email, ip, port), with None for items that can't be parsed.
+        Raises ValueError if the body as a whole is unreadable.
+        """
+        if request.content_type == 'application/octet-stream':
+            return [(email, ip or None, port) for email, _, ip, port in codec.decode_records(request.body)]
+
+        items = []
+        for line in request.body.decode('utf-8').splitlines():
+            if not line.strip():
+                continue
+            try:
+                item = json.loads(line)
+                port = int(item.get('port') or 0)
+                if not 0 <= port <= 65535:
+                    raise ValueError(port)
+                ip = item.get('ip') or None
+                # One bad address would fail the whole bulk UPDATE (::inet on Postgres);
+                # inet has no zone index either
+                if ip is not None and getattr(ipaddress.ip_address(ip), 'scope_id', None):
+                    raise ValueError(ip)
+                items.append((str(item['email']), ip, port))
+            except (ValueError, TypeError, KeyError, AttributeError):
+                items.append(None)
+        return items
+
+
+def _presence_json(email, last_seen_ns, ip_address, port):
+    return {'email': email, 'last_seen_ns': last_seen_ns, 'ip': ip_address, 'port': port}
+
+
+def _int_param(request, name, default, minimum=0, maximum=None):
+    value = int(request.GET.get(name, default))
+    if value < minimum or (maximum is not None and value > maximum):
+        raise ValueError(name)
+    return value
+
+
+def _presence_access_error(request, email=None):
+    """
+    Error response unless the caller may read presence: every client may read its
+    own record (`email`), only PRESENCE_READER_CNS may list users or read others'.
+    IPs and ports of other devices are not for every authenticated client.
+    """
+    error_response = ClientUpdateView.check_identity(request)
+    if error_response:
+        return error_response
+    if request.headers.get('X-Subject-CN') in settings.PRESENCE_READER_CNS:
+        return None
+    if email is not None and email == request.user.email:
+        return None
+    return HttpResponse(status=403, content="Not a presence reader")
+
+
+def _presence_index():
+    """
+    Returns the in-memory presence index if it can answer, else None (use the database).
+    """
+    if not settings.PRESENCE_INDEX:
+        return None
+    from .presence import presence_index
+    presence_index.refresh()
+    return presence_index if presence_index.ready else None
+
+
+class PresenceOnlineView(View):
+    """
+    GET api/presence/online?within=<seconds>&limit=<n>
+    Users seen in the last `within` seconds, newest first. PRESENCE_READER_CNS only.
+    """
+
+    def get(self, request, *args, **kwargs):
+        error_response = _presence_access_error(request)
+        if error_response:
+            return error_response
+
+        try:
+            within = _int_param(request, 'within', 60, minimum=1)
+            limit = _int_param(request, 'limit', 1000, minimum=1, maximum=10000)
+        except ValueError:
+            return HttpResponse(status=400, content="Invalid query parameters")
+
+        index = _presence_index()
+        if index is not None:
+            users = index.online(within * 1_000_000_000, limit=limit)
+            source = 'index'
+        else:
+            cutoff = time.time_ns() - within * 1_000_000_000
+            users = (User.objects.filter(last_seen_ns__gte=cutoff).order_by('-last_seen_ns')
+                     .values_list('email', 'last_seen_ns', 'ip_address', 'port')[:limit])
+            source = 'database'
+
+        return JsonResponse({
+            'within': within,
+            'source': source,
+            'users': [_presence_json(*user) for user in users],
+        })
+
+
+class PresenceListView(View):
+    """
+    GET api/presence?limit=<n>&offset=<n>
+    All users that have been seen, ordered by last_seen_ns, newest first.
+    PRESENCE_READER_CNS only.
+    """
+
+    def get(self, request, *args, **kwargs):
+        error_response = _presence_access_error(request)
+        if error_response:
+            return error_response
+
+        try:
+            limit = _int_param(request, 'limit', 100, minimum=1, maximum=1000)
+            offset = _int_param(request, 'offset', 0)
+        except ValueError:
+            return HttpResponse(status=400, content="Invalid query parameters")
+
+        index = _presence_index()
+        if index is not None:
+            users = index.page(limit, offset)
+            total = len(index)
+            source = 'index'
+        else:
+            seen = User.objects.filter(last_seen_ns__gt=0)
+            users = (seen.order_by('-last_seen_ns')
+                     .values_list('email', 'last_seen_ns', 'ip_address', 'port')[offset:offset + limit])
+            total = seen.count()
+            source = 'database'
+
+        return JsonResponse({
+            'limit': limit,
+            'offset': offset,
+            'total': total,
+            'source': source,
+            'users': [_presence_json(*user) for user in users],
+        })
+
+
+class PresenceDetailView(View):
+    """
+    GET api/presence/<email>
+    The caller's own record, or anyone's for PRESENCE_READER_CNS.
+    """
+
+    def get(self, request, email, *args, **kwargs):
+        error_response = _presence_access_error(request, email)
+        if error_response:
+            return error_response
+
+        index = _presence_index()
+        state = index.get(email) if index is not None else None
+        if state is not None:
+            return JsonResponse({**_presence_json(email, *state), 'source': 'index'})
+
+        # Not in the index: never seen, unknown, or the index isn't loaded yet
+        row = (User.objects.filter(email=email)
+               .values_list('email', 'last_seen_ns', 'ip_address', 'port').first())
+        if row is None:
+            return HttpResponse(status=404, content="User not found")
+        return JsonResponse({**_presence_json(*row), 'source': 'database'})
+
+
+def metrics_view(request):
+    """
+    GET metrics
+    Prometheus text exposition, aggregated across all workers (see metrics.py).
+    """
+    if not metrics.enabled:
+        return HttpResponse(status=404)
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
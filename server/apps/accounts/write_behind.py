@@ -0,0 +1,148 @@
+import atexit
+import logging
+import os
+import threading
+import time
+
+from django.db import InterfaceError, OperationalError, close_old_connections
+
+from .metrics import metrics
+
+logger = logging.getLogger(__name__)
+
+
+def write_presence_rows(rows, batch_size, name):
+    """
+    Writes (user_id, last_seen_ns, ip_address, port) rows with one
+    bulk_update_presence() per `batch_size` rows. Returns (updated, unwritten).
+
+    A batch the database rejects (e.g. an address that isn't a valid inet) is
+    bisected until the offending rows are on their own; those are logged and
+    dropped, and every other row and batch is still written. If the database is
+    unavailable instead (OperationalError, InterfaceError), writing stops and
+    `unwritten` holds the rows left, for the caller to retry on its next pass.
+    `name` prefixes the log messages.
+    """
+    from .models import User
+
+    updated = 0
+    # Batches still to write, the next one last
+    stack = [rows[start:start + batch_size] for start in reversed(range(0, len(rows), batch_size))]
+    while stack:
+        batch = stack.pop()
+        try:
+            updated += User.objects.bulk_update_presence(batch)
+        except (OperationalError, InterfaceError) as e:
+            unwritten = batch + [row for rest in reversed(stack) for row in rest]
+            logger.error("%s failed, retaining %d rows: %s", name, len(unwritten), e)
+            return updated, unwritten
+        except Exception as e:
+            if len(batch) == 1:
+                logger.error("%s dropped the state of user %s: %s", name, batch[0][0], e)
+            else:
+                middle = len(batch) // 2
+                stack += [batch[middle:], batch[:middle]]
+    return updated, []
+
+
+class WriteBehindBuffer:
+    """
+    Coalesces heartbeat state per user and flushes it to the database in bulk.
+
+    Only the newest (last_seen_ns, ip_address, port) per user is kept, so a
+    client heartbeating many times between flushes costs a single row in one
+    multi-row UPDATE. A background thread flushes every `flush_interval` seconds,
+    or early once `batch_size` users are pending, and a final flush runs at
+    interpreter exit (gunicorn worker shutdown).
+
+    The flush thread is started lazily in the process that first enqueues, so
+    the buffer is safe to import before gunicorn forks its workers.
+    """
+
+    def __init__(self, flush_interval=1.0, batch_size=500):
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def configure(self, flush_interval=None, batch_size=None):
+        if flush_interval is not None:
+            self.flush_interval = flush_interval
+        if batch_size is not None:
+            self.batch_size = max(batch_size, 1)
+
+    def enqueue(self, user_id, last_seen_ns, ip_address, port):
+        with self._lock:
+            self._merge(user_id, (last_seen_ns, ip_address, port))
+            pending = len(self._pending)
+
+        self._ensure_started()
+        if pending >= self.batch_size:
+            self._wakeup.set()
+
+    def pending(self):
+        with self._lock:
+            return len(self._pending)
+
+    def flush(self):
+        """
+        Writes everything pending. Returns the number of rows updated.
+        Rows the database rejects are dropped (see write_presence_rows()); if the
+        database is unavailable, the unwritten state is merged back for the next attempt.
+        """
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return 0
+
+        rows = [(user_id, *state) for user_id, state in pending.items()]
+        updated, unwritten = write_presence_rows(rows, self.batch_size, "Write-behind flush")
+        if unwritten:
+            with self._lock:
+                for user_id, *state in unwritten:
+                    self._merge(user_id, tuple(state))
+        return updated
+
+    def _merge(self, user_id, state):
+        # Caller holds the lock. Keeps the newest state so last_seen_ns never goes backwards.
+        current = self._pending.get(user_id)
+        if current is None or current[0] < state[0]:
+            self._pending[user_id] = state
+
+    def _ensure_started(self):
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='write-behind-flush', daemon=True)
+            self._thread.start()
+            atexit.register(self._flush_at_exit)
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            close_old_connections()
+            start = time.perf_counter_ns()
+            try:
+                if self.flush():
+                    metrics.observe('write_behind_flush', time.perf_counter_ns() - start)
+            except Exception as e:
+                logger.error("Write-behind flush loop error: %s", e)
+
+    def _flush_at_exit(self):
+        try:
+            updated = self.flush()
+            if updated:
+                logger.info("Write-behind flushed %d rows on shutdown", updated)
+        except Exception as e:
+            logger.error("Write-behind final flush failed: %s", e)
+
+
+# Global instance, configured from settings in AccountsConfig.ready()
+write_behind = WriteBehindBuffer()
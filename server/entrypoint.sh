@@ -12,12 +12,18 @@ then
     echo "PostgreSQL started"
 fi
 
-# Run migrations
-# In a real CD pipieline, migrations are committed.
-# Here we generate them on the fly if missing to ensure "accounts" table exists.
-python manage.py makemigrations accounts
-python manage.py migrate
+# One-shot: apply the committed migrations and exit (the `migrate` compose service)
+if [ "$1" = "migrate" ]
+then
+    exec python manage.py migrate --noinput
+fi
+
+# Any other command (e.g. `python manage.py sweep_presence` for the sweeper service)
+if [ "$#" -gt 0 ]
+then
+    exec "$@"
+fi
 
-# Start Gunicorn
-# Bind to 0.0.0.0:8000
-exec gunicorn qt_assessment.wsgi:application --bind 0.0.0.0:8000 --workers 3
+# Start Gunicorn. Workers, threads, worker class, preload and the WSGI/ASGI
+# entry point (SERVER_INTERFACE) are all configured in gunicorn.conf.py.
+exec gunicorn -c gunicorn.conf.py
@@ -0,0 +1,73 @@
+"""
+Gunicorn configuration (`gunicorn -c gunicorn.conf.py`), driven by environment variables.
+
+The app is preloaded in the master by default, so workers fork with Django,
+settings and all app modules already imported. Per-process resources (the UDP
+socket, DB connections, metrics slots) are created after the fork.
+"""
+import logging
+import os
+import time
+
+# `config` is itself a gunicorn setting, so the decouple helper is imported as `env`
+from decouple import config as env
+
+_started_at = time.monotonic()
+logger = logging.getLogger('gunicorn.error')
+
+# wsgi: sync/gthread workers on qt_assessment.wsgi; asgi: uvicorn workers on qt_assessment.asgi
+SERVER_INTERFACE = env('SERVER_INTERFACE', default='wsgi')
+
+if SERVER_INTERFACE == 'asgi':
+    wsgi_app = 'qt_assessment.asgi:application'
+    worker_class = env('GUNICORN_WORKER_CLASS', default='') or 'uvicorn_worker.UvicornWorker'
+else:
+    wsgi_app = 'qt_assessment.wsgi:application'
+    # 'sync' with GUNICORN_THREADS > 1 runs gthread workers
+    worker_class = env('GUNICORN_WORKER_CLASS', default='') or 'sync'
+
+bind = env('GUNICORN_BIND', default='0.0.0.0:8000')
+workers = env('GUNICORN_WORKERS', default=3, cast=int)
+threads = env('GUNICORN_THREADS', default=1, cast=int)
+preload_app = env('GUNICORN_PRELOAD', default=True, cast=bool)
+timeout = env('GUNICORN_TIMEOUT', default=30, cast=int)
+keepalive = env('GUNICORN_KEEPALIVE', default=5, cast=int)
+max_requests = env('GUNICORN_MAX_REQUESTS', default=0, cast=int)
+max_requests_jitter = env('GUNICORN_MAX_REQUESTS_JITTER', default=0, cast=int)
+
+
+def on_starting(server):
+    metrics_dir = env('METRICS_DIR', default='')
+    if metrics_dir:
+        # Slot files from a previous run would be summed into this one
+        from apps.accounts.metrics import clear_directory
+        os.makedirs(metrics_dir, exist_ok=True)
+        clear_directory(metrics_dir)
+
+
+def when_ready(server):
+    logger.info("Master ready in %.0f ms (preload=%s, workers=%d, threads=%d, worker_class=%s)",
+                (time.monotonic() - _started_at) * 1000, preload_app, workers, threads, worker_class)
+
+
+def post_fork(server, worker):
+    worker.forked_at = time.monotonic()
+    from django.apps import apps
+    if not apps.ready:
+        # Not preloaded: the app loads in the worker and the socket is created on first send
+        return
+    from django.db import connections
+    from apps.accounts.broadcaster import broadcaster
+    # Connections must never be shared with the master or sibling workers
+    connections.close_all()
+    broadcaster.ensure_initialized()
+
+
+def post_worker_init(worker):
+    # The app is loaded in the worker by now, preloaded or not. Snapshots come from
+    # web workers only, never from the sweeper or one-off management commands.
+    from apps.accounts.snapshots import snapshot_emitter
+    snapshot_emitter.ensure_started()
+    logger.info("Worker %s booted in %.0f ms after fork (%.0f ms since master start)",
+                worker.pid, (time.monotonic() - worker.forked_at) * 1000,
+                (time.monotonic() - _started_at) * 1000)
@@ -0,0 +1,15 @@
+import os
+
+from django.conf import settings
+from django.core.asgi import get_asgi_application
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'qt_assessment.settings')
+# Serve /api/client with the async view; the WSGI entry point keeps the sync one.
+os.environ.setdefault('DJANGO_ASYNC_VIEWS', 'True')
+
+application = get_asgi_application()
+
+if settings.FASTPATH:
+    # PATCH /api/client skips the Django request stack; everything else falls through
+    from apps.accounts.fastpath import FastPathASGI
+    application = FastPathASGI(application)
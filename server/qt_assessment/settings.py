@@ -1,5 +1,5 @@
 from pathlib import Path
-from decouple import config
+from decouple import Csv, config
 
 BASE_DIR = Path(__file__).resolve().parent.parent
 
@@ -19,6 +19,7 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'apps.accounts.middleware.MetricsMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.middleware.common.CommonMiddleware',
     'apps.accounts.middleware.MTLSAuthenticationMiddleware',
@@ -27,6 +28,14 @@ MIDDLEWARE = [
 ROOT_URLCONF = 'qt_assessment.urls'
 
 WSGI_APPLICATION = 'qt_assessment.wsgi.application'
+ASGI_APPLICATION = 'qt_assessment.asgi.application'
+
+# Use the async /api/client view (set by qt_assessment/asgi.py)
+ASYNC_VIEWS = config('DJANGO_ASYNC_VIEWS', default=False, cast=bool)
+
+# Answer PATCH /api/client in a minimal WSGI/ASGI app in front of Django
+# (apps/accounts/fastpath.py); same status codes, other paths unaffected.
+FASTPATH = config('FASTPATH', default=False, cast=bool)
 
 # Database
 # Using SQLite for dev convenience/running tests without docker temporarily
@@ -52,6 +61,27 @@ else:
         }
     }
 
+# Connection reuse. SQL_CONN_MAX_AGE keeps per-worker connections open between
+# requests (0 closes them after each request). SQL_POOL enables Django's psycopg
+# connection pool instead (Postgres only; requires CONN_MAX_AGE=0).
+# SQL_PGBOUNCER makes the app safe behind pgbouncer in transaction pooling mode.
+DATABASES['default']['CONN_MAX_AGE'] = config('SQL_CONN_MAX_AGE', default=60, cast=int)
+DATABASES['default']['CONN_HEALTH_CHECKS'] = True
+
+if DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql':
+    options = DATABASES['default'].setdefault('OPTIONS', {})
+    if config('SQL_POOL', default=False, cast=bool):
+        DATABASES['default']['CONN_MAX_AGE'] = 0
+        options['pool'] = {
+            'min_size': config('SQL_POOL_MIN_SIZE', default=2, cast=int),
+            'max_size': config('SQL_POOL_MAX_SIZE', default=10, cast=int),
+            'timeout': config('SQL_POOL_TIMEOUT', default=10.0, cast=float),
+        }
+    if config('SQL_PGBOUNCER', default=False, cast=bool):
+        # No server-side cursors or prepared statements across transactions
+        DATABASES['default']['DISABLE_SERVER_SIDE_CURSORS'] = True
+        options['prepare_threshold'] = None
+
 # User definition
 AUTH_USER_MODEL = 'accounts.User'
 
@@ -64,17 +94,170 @@ USE_TZ = True
 # Static files (CSS, JavaScript, Images)
 STATIC_URL = 'static/'
 
-# Logging (Explicit and simple)
+# mTLS identity cache (per worker): CN -> resolved user, including negative results.
+# Set IDENTITY_CACHE_SIZE=0 to disable.
+IDENTITY_CACHE_SIZE = config('IDENTITY_CACHE_SIZE', default=10000, cast=int)
+IDENTITY_CACHE_TTL = config('IDENTITY_CACHE_TTL', default=300.0, cast=float)
+IDENTITY_CACHE_NEGATIVE_TTL = config('IDENTITY_CACHE_NEGATIVE_TTL', default=30.0, cast=float)
+
+# Per-CN rate limit, enforced in MTLSAuthenticationMiddleware (429 + Retry-After):
+# at most RATE_LIMIT_REQUESTS per RATE_LIMIT_WINDOW seconds (sliding window).
+# RATE_LIMIT_BACKEND: '' (off) | local (per worker) | shm (shared by all workers
+# on the host via RATE_LIMIT_SHM_PATH) | redis (RATE_LIMIT_REDIS_URL).
+RATE_LIMIT_BACKEND = config('RATE_LIMIT_BACKEND', default='')
+RATE_LIMIT_REQUESTS = config('RATE_LIMIT_REQUESTS', default=60, cast=int)
+RATE_LIMIT_WINDOW = config('RATE_LIMIT_WINDOW', default=60.0, cast=float)
+RATE_LIMIT_SHM_PATH = config('RATE_LIMIT_SHM_PATH', default='')
+RATE_LIMIT_SHM_SLOTS = config('RATE_LIMIT_SHM_SLOTS', default=65536, cast=int)
+RATE_LIMIT_REDIS_URL = config('RATE_LIMIT_REDIS_URL', default='redis://localhost:6379/0')
+
+# Write-behind mode for heartbeat state: keep the latest state per user in memory
+# and flush it with one multi-row UPDATE per batch instead of one save() per PATCH.
+CLIENT_STATE_WRITE_BEHIND = config('CLIENT_STATE_WRITE_BEHIND', default=False, cast=bool)
+WRITE_BEHIND_FLUSH_INTERVAL = config('WRITE_BEHIND_FLUSH_INTERVAL', default=1.0, cast=float)
+WRITE_BEHIND_BATCH_SIZE = config('WRITE_BEHIND_BATCH_SIZE', default=500, cast=int)
+
+# Where heartbeat state is written: postgres (UPDATE per heartbeat, or write-behind
+# above), memory (per worker) or redis (shared; PRESENCE_REDIS_URL). The memory and
+# redis backends are copied into accounts.User every PRESENCE_RECONCILE_INTERVAL seconds.
+PRESENCE_BACKEND = config('PRESENCE_BACKEND', default='postgres')
+PRESENCE_RECONCILE_INTERVAL = config('PRESENCE_RECONCILE_INTERVAL', default=5.0, cast=float)
+PRESENCE_REDIS_URL = config('PRESENCE_REDIS_URL', default='redis://localhost:6379/0')
+PRESENCE_REDIS_PREFIX = config('PRESENCE_REDIS_PREFIX', default='qt:presence')
+
+# Gateways allowed to report heartbeats for many devices via api/client/batch
+# (comma-separated certificate CNs), and the maximum items per batch.
+GATEWAY_CNS = config('GATEWAY_CNS', default='', cast=Csv())
+GATEWAY_BATCH_MAX_ITEMS = config('GATEWAY_BATCH_MAX_ITEMS', default=1000, cast=int)
+
+# Presence read API (api/presence...): served from a per-worker in-memory index
+# that is updated on every heartbeat and synced from the DB every
+# PRESENCE_SYNC_INTERVAL seconds (overlapping by PRESENCE_SYNC_OVERLAP seconds).
+PRESENCE_INDEX = config('PRESENCE_INDEX', default=True, cast=bool)
+PRESENCE_SYNC_INTERVAL = config('PRESENCE_SYNC_INTERVAL', default=1.0, cast=float)
+PRESENCE_SYNC_OVERLAP = config('PRESENCE_SYNC_OVERLAP', default=10.0, cast=float)
+# Certificate CNs (comma-separated) allowed to list presence and read other users'
+# records; any other client can only read its own api/presence/<email>.
+PRESENCE_READER_CNS = config('PRESENCE_READER_CNS', default='', cast=Csv())
+
+# Offline events (manage.py sweep_presence): users not seen for PRESENCE_OFFLINE_TTL
+# seconds are broadcast once as v2 TYPE_OFFLINE records. Each sweep (every
+# PRESENCE_SWEEP_INTERVAL seconds) pages through the newly expired users on the
+# last_seen_ns index, PRESENCE_SWEEP_BATCH_SIZE per batch, at most PRESENCE_SWEEP_MAX_ROWS.
+PRESENCE_OFFLINE_TTL = config('PRESENCE_OFFLINE_TTL', default=90.0, cast=float)
+PRESENCE_SWEEP_INTERVAL = config('PRESENCE_SWEEP_INTERVAL', default=5.0, cast=float)
+PRESENCE_SWEEP_BATCH_SIZE = config('PRESENCE_SWEEP_BATCH_SIZE', default=1000, cast=int)
+PRESENCE_SWEEP_MAX_ROWS = config('PRESENCE_SWEEP_MAX_ROWS', default=100000, cast=int)
+
+# Presence snapshots: every BROADCAST_SNAPSHOT_INTERVAL seconds (0 = off), everyone
+# seen within BROADCAST_SNAPSHOT_WINDOW seconds is broadcast as compressed v2
+# TYPE_SNAPSHOT frames, at most BROADCAST_SNAPSHOT_RATE datagrams/second, so late
+# listeners converge. Source: db (accounts.User) or index (the presence index).
+# Only gunicorn workers start the emitter, and of those only the one holding an flock on
+# BROADCAST_SNAPSHOT_LOCK emits ('' = every worker). Web replicas must share its directory.
+BROADCAST_SNAPSHOT_INTERVAL = config('BROADCAST_SNAPSHOT_INTERVAL', default=0.0, cast=float)
+BROADCAST_SNAPSHOT_WINDOW = config('BROADCAST_SNAPSHOT_WINDOW', default=PRESENCE_OFFLINE_TTL, cast=float)
+BROADCAST_SNAPSHOT_RATE = config('BROADCAST_SNAPSHOT_RATE', default=200.0, cast=float)
+BROADCAST_SNAPSHOT_SOURCE = config('BROADCAST_SNAPSHOT_SOURCE', default='db')
+BROADCAST_SNAPSHOT_LOCK = config('BROADCAST_SNAPSHOT_LOCK', default='/var/lib/qt/locks/presence-snapshot.lock')
+
+# Durable append-only log of heartbeats in EVENT_LOG_DIR ('' disables), shared by the
+# workers on the host and replayed with `udp_listener.py --replay`. Appends are group
+# committed every EVENT_LOG_FLUSH_INTERVAL seconds (or at EVENT_LOG_BUFFER_SIZE bytes).
+# EVENT_LOG_FSYNC: always | interval (every EVENT_LOG_FSYNC_INTERVAL seconds) | never.
+# Segments roll over at EVENT_LOG_SEGMENT_SIZE bytes; EVENT_LOG_MAX_SEGMENTS=0 keeps all.
+EVENT_LOG_DIR = config('EVENT_LOG_DIR', default='')
+EVENT_LOG_SEGMENT_SIZE = config('EVENT_LOG_SEGMENT_SIZE', default=64 * 1024 * 1024, cast=int)
+EVENT_LOG_MAX_SEGMENTS = config('EVENT_LOG_MAX_SEGMENTS', default=32, cast=int)
+EVENT_LOG_FLUSH_INTERVAL = config('EVENT_LOG_FLUSH_INTERVAL', default=0.05, cast=float)
+EVENT_LOG_BUFFER_SIZE = config('EVENT_LOG_BUFFER_SIZE', default=1024 * 1024, cast=int)
+EVENT_LOG_FSYNC = config('EVENT_LOG_FSYNC', default='interval')
+EVENT_LOG_FSYNC_INTERVAL = config('EVENT_LOG_FSYNC_INTERVAL', default=1.0, cast=float)
+
+# UDP broadcast destination. BROADCAST_MODE: broadcast | multicast | unicast.
+# For multicast, BROADCAST_TARGET_HOST is the group; for unicast, the listener host.
+# BROADCAST_BIND_PORT=0 gives each worker an ephemeral source port; otherwise
+# BROADCAST_REUSEPORT lets all workers share the fixed port via SO_REUSEPORT.
+# Per-worker ports keep v2 sequence numbers (loss detection) distinct per sender.
+BROADCAST_MODE = config('BROADCAST_MODE', default='broadcast')
+BROADCAST_TARGET_HOST = config('BROADCAST_TARGET_HOST', default='')
+BROADCAST_TARGET_PORT = config('BROADCAST_TARGET_PORT', default=6667, cast=int)
+BROADCAST_BIND_PORT = config('BROADCAST_BIND_PORT', default=6666, cast=int)
+BROADCAST_REUSEPORT = config('BROADCAST_REUSEPORT', default=False, cast=bool)
+BROADCAST_MULTICAST_TTL = config('BROADCAST_MULTICAST_TTL', default=1, cast=int)
+BROADCAST_MULTICAST_LOOP = config('BROADCAST_MULTICAST_LOOP', default=True, cast=bool)
+BROADCAST_MULTICAST_INTERFACE = config('BROADCAST_MULTICAST_INTERFACE', default='')
+
+# UDP broadcast pipeline: updates are queued and sent by a background thread.
+# The queue drops the oldest update when full. BROADCAST_BATCH packs many
+# records into one datagram of at most BROADCAST_MAX_DATAGRAM bytes.
+BROADCAST_QUEUE = config('BROADCAST_QUEUE', default=True, cast=bool)
+BROADCAST_QUEUE_SIZE = config('BROADCAST_QUEUE_SIZE', default=10000, cast=int)
+BROADCAST_BATCH = config('BROADCAST_BATCH', default=False, cast=bool)
+BROADCAST_MAX_DATAGRAM = config('BROADCAST_MAX_DATAGRAM', default=1472, cast=int)
+# Wire format: 1 (legacy text IP) or 2 (versioned header, sequence number, packed IP)
+BROADCAST_WIRE_VERSION = config('BROADCAST_WIRE_VERSION', default=1, cast=int)
+
+# Broadcast policy (per worker): a changed ip/port is broadcast immediately, an
+# unchanged heartbeat at most once per BROADCAST_MIN_INTERVAL seconds per user.
+# BROADCAST_RATE_LIMIT caps broadcasts/second (token bucket, BROADCAST_RATE_BURST).
+# 0 disables each limit; with both at 0 every heartbeat is broadcast.
+BROADCAST_MIN_INTERVAL = config('BROADCAST_MIN_INTERVAL', default=0.0, cast=float)
+BROADCAST_RATE_LIMIT = config('BROADCAST_RATE_LIMIT', default=0.0, cast=float)
+BROADCAST_RATE_BURST = config('BROADCAST_RATE_BURST', default=0, cast=int)
+BROADCAST_POLICY_TABLE_SIZE = config('BROADCAST_POLICY_TABLE_SIZE', default=100000, cast=int)
+
+# Hot-path metrics (per-stage timings, status and broadcast counters) served on /metrics.
+# METRICS_DIR holds one slot file per worker so a scrape sums all gunicorn workers;
+# leave it empty to keep metrics in process memory (single-process dev server).
+METRICS_ENABLED = config('METRICS_ENABLED', default=True, cast=bool)
+METRICS_DIR = config('METRICS_DIR', default='')
+
+# Logging: records go through a bounded queue to a writer thread (LOG_QUEUE), so
+# request threads never block on stdout; a full queue drops and counts records.
+# LOG_FORMAT is json (one compact object per line) or text. Repeated warnings and
+# errors from one call site are limited to LOG_DEDUP_BURST per LOG_DEDUP_WINDOW
+# seconds, with the suppressed count attached to the next one (0 disables).
+LOG_LEVEL = config('LOG_LEVEL', default='INFO')
+LOG_FORMAT = config('LOG_FORMAT', default='json')
+LOG_QUEUE = config('LOG_QUEUE', default=True, cast=bool)
+LOG_QUEUE_SIZE = config('LOG_QUEUE_SIZE', default=10000, cast=int)
+LOG_DEDUP_WINDOW = config('LOG_DEDUP_WINDOW', default=60.0, cast=float)
+LOG_DEDUP_BURST = config('LOG_DEDUP_BURST', default=5, cast=int)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
+    'formatters': {
+        'json': {
+            '()': 'apps.accounts.logs.JSONFormatter',
+        },
+        'text': {
+            '()': 'apps.accounts.logs.TextFormatter',
+            'format': '%(asctime)s %(levelname)s %(name)s %(message)s',
+        },
+    },
+    'filters': {
+        'dedup': {
+            '()': 'apps.accounts.logs.DedupFilter',
+            'window': LOG_DEDUP_WINDOW,
+            'burst': LOG_DEDUP_BURST,
+        },
+    },
     'handlers': {
         'console': {
             'class': 'logging.StreamHandler',
+            'formatter': LOG_FORMAT,
+            'filters': ['dedup'],
+        } if not LOG_QUEUE else {
+            'class': 'apps.accounts.logs.QueueingHandler',
+            'queue_size': LOG_QUEUE_SIZE,
+            'formatter': LOG_FORMAT,
+            'filters': ['dedup'],
         },
     },
     'root': {
         'handlers': ['console'],
-        'level': 'INFO',
+        'level': LOG_LEVEL,
     },
 }
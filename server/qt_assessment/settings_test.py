@@ -0,0 +1,13 @@
+"""
+Settings for the test suite (pytest.ini): the regular settings, with a throwaway
+secret key so the tests run without a .env, and broadcasts sent to a closed
+local port instead of the LAN.
+"""
+import os
+
+os.environ.setdefault('DJANGO_SECRET_KEY', 'insecure-test-key')
+os.environ.setdefault('BROADCAST_MODE', 'unicast')
+os.environ.setdefault('BROADCAST_TARGET_HOST', '127.0.0.1')
+os.environ.setdefault('BROADCAST_BIND_PORT', '0')
+
+from .settings import *  # noqa: E402,F401,F403
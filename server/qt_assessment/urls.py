@@ -1,6 +1,23 @@
+from django.conf import settings
 from django.urls import path
-from apps.accounts.views import ClientUpdateView
+from apps.accounts.views import (
+    AsyncClientUpdateView,
+    ClientBatchUpdateView,
+    ClientUpdateView,
+    PresenceDetailView,
+    PresenceListView,
+    PresenceOnlineView,
+    metrics_view,
+)
+
+# The ASGI entry point enables ASYNC_VIEWS so heartbeats are awaited natively
+client_update_view = AsyncClientUpdateView if settings.ASYNC_VIEWS else ClientUpdateView
 
 urlpatterns = [
-    path('api/client', ClientUpdateView.as_view(), name='client_update'),
+    path('api/client', client_update_view.as_view(), name='client_update'),
+    path('api/client/batch', ClientBatchUpdateView.as_view(), name='client_batch_update'),
+    path('api/presence', PresenceListView.as_view(), name='presence_list'),
+    path('api/presence/online', PresenceOnlineView.as_view(), name='presence_online'),
+    path('api/presence/<str:email>', PresenceDetailView.as_view(), name='presence_detail'),
+    path('metrics', metrics_view, name='metrics'),
 ]
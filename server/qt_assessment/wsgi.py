@@ -1,7 +1,13 @@
 import os
 
+from django.conf import settings
 from django.core.wsgi import get_wsgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'qt_assessment.settings')
 
 application = get_wsgi_application()
+
+if settings.FASTPATH:
+    # PATCH /api/client skips the Django request stack; everything else falls through
+    from apps.accounts.fastpath import FastPathWSGI
+    application = FastPathWSGI(application)
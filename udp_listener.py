@@ -1,89 +1,492 @@
 import socket
-import struct
 import argparse
+import csv
+import json
+import select
+import struct
 import sys
+import time
 import datetime
+import zlib
+from pathlib import Path
+
+# The wire codec is shared with the server (server/apps/accounts/codec.py).
+# Inside the web container this script sits next to the `apps` package instead.
+_here = Path(__file__).resolve().parent
+for _root in (_here / 'server', _here):
+    if (_root / 'apps' / 'accounts' / 'codec.py').exists():
+        sys.path.insert(0, str(_root))
+        break
+
+from apps.accounts import codec, event_log  # noqa: E402
+
+# --- Sinks -------------------------------------------------------------------
+# A sink receives every decoded frame. Sinks only implement what they need.
+
+class Sink:
+    def __init__(self, stream=sys.stdout):
+        self.stream = stream
+
+    def write(self, frame, addr):
+        pass
+
+    def error(self, addr, message):
+        pass
+
+    def lost(self, addr, gap, total):
+        pass
+
+    def summary(self):
+        return ''
+
+    def close(self):
+        pass
+
+
+class PrettySink(Sink):
+    """
+    Human readable output, one block per record (the original listener output).
+    """
+
+    def write(self, frame, addr):
+        out = self.stream
+        offline = frame.type == codec.TYPE_OFFLINE
+        snapshot = frame.type == codec.TYPE_SNAPSHOT
+        for email, last_seen_ns, ip_str, client_port in frame.records:
+            # Pretty Print
+            timestamp = datetime.datetime.fromtimestamp(last_seen_ns / 1e9)
+            print("-" * 40, file=out)
+            print(f"Source Packet: {addr}", file=out)
+            print(f"User Email   : {email}", file=out)
+            if offline:
+                print("Status       : OFFLINE", file=out)
+            elif snapshot:
+                print("Status       : SNAPSHOT", file=out)
+            print(f"Last Seen    : {timestamp} ({last_seen_ns})", file=out)
+            print(f"Client IP    : {ip_str}", file=out)
+            print(f"Client Port  : {client_port}", file=out)
+            print("-" * 40, file=out)
+
+    def error(self, addr, message):
+        print(f"Malformed packet from {addr}: {message}", file=self.stream)
+
+    def lost(self, addr, gap, total):
+        print(f"Lost {gap} datagram(s) from {addr} (total lost: {total})", file=self.stream)
+
+
+class CounterSink(Sink):
+    """
+    Quiet mode: only the periodic statistics line is printed.
+    """
+
+
+class JsonLinesSink(Sink):
+    def write(self, frame, addr):
+        event = codec.TYPE_NAMES.get(frame.type, frame.type)
+        lines = [
+            json.dumps({'email': email, 'last_seen_ns': last_seen_ns, 'ip': ip, 'port': port,
+                        'event': event, 'version': frame.version, 'seq': frame.seq})
+            for email, last_seen_ns, ip, port in frame.records
+        ]
+        self.stream.write('\n'.join(lines) + '\n')
+
+    def close(self):
+        self.stream.flush()
+
+
+class CsvSink(Sink):
+    def __init__(self, stream=sys.stdout):
+        super().__init__(stream)
+        self._writer = csv.writer(stream)
+        self._writer.writerow(['email', 'last_seen_ns', 'ip', 'port', 'event'])
+
+    def write(self, frame, addr):
+        event = codec.TYPE_NAMES.get(frame.type, frame.type)
+        self._writer.writerows(record + (event,) for record in frame.records)
+
+    def close(self):
+        self.stream.flush()
+
+
+class LatestStateSink(Sink):
+    """
+    In-memory table of the newest (last_seen_ns, ip, port) per online email.
+    An offline record removes the user unless a newer heartbeat has arrived.
+    Snapshot records are applied like heartbeats; once every chunk of a snapshot
+    has arrived from a sender, users last seen before the snapshot's window are
+    dropped, so the table converges even if offline records were lost.
+    Printed on close, newest first.
+    """
+
+    def __init__(self, stream=sys.stdout):
+        super().__init__(stream)
+        self.table = {}
+        self.snapshots_complete = 0
+        # addr -> [snapshot id, chunks received, index of the last chunk or None]
+        self._snapshots = {}
+
+    def write(self, frame, addr):
+        table = self.table
+        if frame.type == codec.TYPE_OFFLINE:
+            for email, last_seen_ns, _, _ in frame.records:
+                current = table.get(email)
+                if current is not None and current[0] <= last_seen_ns:
+                    del table[email]
+            return
+        for email, last_seen_ns, ip, port in frame.records:
+            current = table.get(email)
+            if current is None or current[0] < last_seen_ns:
+                table[email] = (last_seen_ns, ip, port)
+        if frame.type == codec.TYPE_SNAPSHOT:
+            self._snapshot_chunk(frame.snapshot, addr)
+
+    def _snapshot_chunk(self, snapshot, addr):
+        state = self._snapshots.get(addr)
+        if state is None or state[0] != snapshot.id:
+            state = self._snapshots[addr] = [snapshot.id, set(), None]
+        state[1].add(snapshot.chunk)
+        if snapshot.last:
+            state[2] = snapshot.chunk
+        if state[2] is None or len(state[1]) <= state[2]:
+            return
+        # Complete: anyone older than the window would have been in it
+        del self._snapshots[addr]
+        self.snapshots_complete += 1
+        for email in [email for email, (seen_ns, _, _) in self.table.items() if seen_ns < snapshot.since_ns]:
+            del self.table[email]
+
+    def summary(self):
+        return f"online={len(self.table)} snapshots={self.snapshots_complete}"
+
+    def close(self):
+        rows = sorted(self.table.items(), key=lambda item: item[1][0], reverse=True)
+        for email, (last_seen_ns, ip, port) in rows:
+            timestamp = datetime.datetime.fromtimestamp(last_seen_ns / 1e9)
+            print(f"{email:<40} {str(timestamp):<28} {ip:<40} {port}", file=self.stream)
+        self.stream.flush()
+
+
+SINKS = {
+    'pretty': PrettySink,
+    'quiet': CounterSink,
+    'jsonl': JsonLinesSink,
+    'csv': CsvSink,
+    'state': LatestStateSink,
+}
+
+
+# --- Receive engine -----------------------------------------------------------
+
+class Listener:
+    """
+    Receives datagrams in batches and hands decoded frames to a sink.
+
+    A ring of preallocated buffers is filled with recvfrom_into: once select()
+    reports the socket readable, non-blocking receives run until the socket is
+    drained or the ring is full, so bursts are pulled out of the kernel queue
+    without per-packet allocations. Python has no recvmmsg; this is the closest
+    portable batching.
+    """
+
+    def __init__(self, sock, sink, batch=64, buffer_size=65535, stats_interval=0.0, stats_stream=sys.stderr,
+                 shard=None, name=''):
+        self.sock = sock
+        self.sink = sink
+        self.name = name
+        # (index, count): only decode datagrams whose sender hashes to this index
+        self.shard = shard if shard and shard[1] > 1 else None
+        self._owned = {}
+        self.batch = max(batch, 1)
+        self.stats_interval = stats_interval
+        self.stats_stream = stats_stream
+        self._buffers = [bytearray(buffer_size) for _ in range(self.batch)]
+        self._views = [memoryview(buf) for buf in self._buffers]
+        self._last_seq = {}
+
+        self.packets = 0
+        self.records = 0
+        self.bytes = 0
+        self.malformed = 0
+        self.lost = 0
+        self.skipped = 0
+        self.offline = 0
+        self.snapshot = 0
+
+    def run(self):
+        sock = self.sock
+        views = self._views
+        batch = self.batch
+        received = [None] * batch
+
+        next_report = time.monotonic() + self.stats_interval if self.stats_interval else None
+        last_report = (time.monotonic(), 0, 0)
+        sock.setblocking(False)
+
+        while True:
+            timeout = max(next_report - time.monotonic(), 0) if next_report is not None else None
+            readable, _, _ = select.select([sock], [], [], timeout)
+
+            count = 0
+            if readable:
+                try:
+                    while count < batch:
+                        nbytes, addr = sock.recvfrom_into(views[count])
+                        received[count] = (nbytes, addr)
+                        count += 1
+                except BlockingIOError:
+                    pass
+
+            for i in range(count):
+                nbytes, addr = received[i]
+                self._handle(views[i][:nbytes], addr)
+
+            if next_report is not None and time.monotonic() >= next_report:
+                last_report = self.report(last_report)
+                next_report = time.monotonic() + self.stats_interval
+
+    def _handle(self, data, addr):
+        if self.shard is not None and not self._owns(addr):
+            self.skipped += 1
+            return
+
+        self.packets += 1
+        self.bytes += len(data)
+
+        # Minimal size check: 1(len) + 1(email) + 8(time) + 1(len) + 1(ip) + 2(port) = 14 bytes min
+        if len(data) < codec.MIN_PACKET_SIZE:
+            self.malformed += 1
+            self.sink.error(addr, "too short")
+            return
+
+        try:
+            frame = codec.decode(data)
+        except (ValueError, IndexError, UnicodeDecodeError) as e:
+            self.malformed += 1
+            self.sink.error(addr, str(e))
+            return
+
+        if frame.seq is not None:
+            previous = self._last_seq.get(addr)
+            if previous is not None:
+                gap = codec.seq_gap(previous, frame.seq)
+                if gap:
+                    self.lost += gap
+                    self.sink.lost(addr, gap, self.lost)
+            self._last_seq[addr] = frame.seq
+
+        self.records += len(frame.records)
+        if frame.type == codec.TYPE_OFFLINE:
+            self.offline += len(frame.records)
+        elif frame.type == codec.TYPE_SNAPSHOT:
+            self.snapshot += len(frame.records)
+        self.sink.write(frame, addr)
+
+    def _owns(self, addr):
+        owned = self._owned.get(addr)
+        if owned is None:
+            index, count = self.shard
+            # crc32 rather than hash(): it must agree across processes
+            owned = zlib.crc32(f"{addr[0]}:{addr[1]}".encode()) % count == index
+            self._owned[addr] = owned
+        return owned
+
+    def report(self, last):
+        now = time.monotonic()
+        last_time, last_packets, last_records = last
+        elapsed = max(now - last_time, 1e-9)
+        pps = (self.packets - last_packets) / elapsed
+        rps = (self.records - last_records) / elapsed
+
+        drops = kernel_drops(self.sock)
+        parts = [self.name] if self.name else []
+        parts += [
+            f"pkts/s={pps:.0f}",
+            f"records/s={rps:.0f}",
+            f"packets={self.packets}",
+            f"records={self.records}",
+            f"offline={self.offline}",
+            f"snapshot={self.snapshot}",
+            f"malformed={self.malformed}",
+            f"lost(seq)={self.lost}",
+            f"kernel_drops={'n/a' if drops is None else drops}",
+        ]
+        if self.shard is not None:
+            parts.append(f"skipped(other shards)={self.skipped}")
+        summary = self.sink.summary()
+        if summary:
+            parts.append(summary)
+        print(' '.join(parts), file=self.stats_stream, flush=True)
+        return now, self.packets, self.records
+
+
+def kernel_drops(sock):
+    """
+    Datagrams the kernel dropped for this socket (receive buffer overflow), from
+    /proc/net/udp. Returns None where that isn't available (non-Linux).
+    """
+    try:
+        port = sock.getsockname()[1]
+        with open('/proc/net/udp') as f:
+            next(f)
+            total = None
+            for line in f:
+                fields = line.split()
+                if int(fields[1].rsplit(':', 1)[1], 16) == port:
+                    total = (total or 0) + int(fields[-1])
+            return total
+    except (OSError, ValueError, IndexError, StopIteration):
+        return None
 
-def run_listener(port):
+
+def open_socket(port, rcvbuf=0, group=None, interface=None, reuse_port=False):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        # Lets several listener processes bind the same port
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    if rcvbuf:
+        # The kernel may cap this (net.core.rmem_max); the effective size is reported.
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, rcvbuf)
+    # Binding to 0.0.0.0 allows receiving broadcasts
+    sock.bind(('0.0.0.0', port))
+    if group:
+        membership = struct.pack('4s4s', socket.inet_aton(group), socket.inet_aton(interface or '0.0.0.0'))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    return sock
+
+
+def run_listener(port, sink=None, batch=64, rcvbuf=0, stats_interval=0.0,
+                 group=None, interface=None, reuse_port=False, shard=None, name=''):
     """
     Listens for UDP broadcast packets and decodes them.
-    Payload Format (Big Endian):
+    v1 Payload Format (Big Endian):
     - Email Length (1 byte, B)
     - Email (N bytes, s)
     - Last Seen (8 bytes, Q)
     - IP Length (1 byte, B)
     - IP (M bytes, s)
     - Port (2 bytes, H)
+    v1 batches and v2 frames are detected automatically (see codec.py).
+    v2 sequence numbers are tracked per sender to report lost datagrams.
+    v2 TYPE_OFFLINE frames (from the presence sweeper) mark users offline.
+    v2 TYPE_SNAPSHOT frames carry zlib-compressed chunks of the whole online table.
     """
-
-    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sink = sink or PrettySink()
 
     try:
-        # Binding to 0.0.0.0 allows receiving broadcasts
-        sock.bind(('0.0.0.0', port))
-        print(f"Listening for UDP Broadcasts on port {port}...")
+        sock = open_socket(port, rcvbuf, group, interface, reuse_port)
+        effective = sock.getsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF)
+        joined = f", group {group}" if group else ""
+        print(f"{name}Listening for UDP Broadcasts on port {port}{joined} (SO_RCVBUF={effective})...", file=sys.stderr)
     except Exception as e:
-        print(f"Error binding to port {port}: {e}")
+        print(f"Error binding to port {port}: {e}", file=sys.stderr)
         sys.exit(1)
 
-    while True:
-        try:
-            data, addr = sock.recvfrom(1024)
-            # Minimal size check: 1(len) + 1(email) + 8(time) + 1(len) + 1(ip) + 2(port) = 14 bytes min
-            if len(data) < 14:
-                print(f"Received malformed packet (too short) from {addr}")
-                continue
-
-            offset = 0
-
-            # 1. Email Length
-            email_len = struct.unpack_from('>B', data, offset)[0]
-            offset += 1
+    listener = Listener(sock, sink, batch=batch, stats_interval=stats_interval, shard=shard, name=name.strip())
+    try:
+        listener.run()
+    except KeyboardInterrupt:
+        print("\nStopping listener.", file=sys.stderr)
+    finally:
+        listener.report((time.monotonic(), listener.packets, listener.records))
+        sink.close()
 
-            if len(data) < offset + email_len:
-                print("Malformed packet: Email length mismatch")
-                continue
 
-            # 2. Email
-            email_bytes = struct.unpack_from(f'>{email_len}s', data, offset)[0]
-            email = email_bytes.decode('utf-8')
-            offset += email_len
+def replay(directory, sink=None, offset=0, since_ns=None, stats_stream=sys.stderr):
+    """
+    Feeds the server's event log (EVENT_LOG_DIR) to a sink, from a global byte
+    offset and/or a last_seen_ns timestamp, reading segments through mmap.
+    Prints the offset to resume from (--offset) when done.
+    """
+    sink = sink or PrettySink()
+    started = time.monotonic()
+    blocks = records = 0
+    next_offset = offset
+    try:
+        for block_offset, next_offset, block in event_log.read(directory, offset, since_ns):
+            sink.write(codec.Frame(codec.VERSION_2, codec.TYPE_UPDATE, None, block), ('replay', block_offset))
+            blocks += 1
+            records += len(block)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        sink.close()
+    elapsed = max(time.monotonic() - started, 1e-9)
+    print(f"Replayed {records} records in {blocks} blocks ({records / elapsed:.0f} records/s); "
+          f"resume with --offset {next_offset}", file=stats_stream)
+    return next_offset
 
-            # 3. Last Seen
-            last_seen_ns = struct.unpack_from('>Q', data, offset)[0]
-            offset += 8
 
-            # 4. IP Length
-            ip_len = struct.unpack_from('>B', data, offset)[0]
-            offset += 1
+def parse_since(value):
+    """
+    Nanoseconds since the epoch, given as an integer or an ISO 8601 datetime.
+    """
+    if value.isdigit():
+        return int(value)
+    return int(datetime.datetime.fromisoformat(value).timestamp() * 1e9)
 
-            # 5. IP
-            ip_bytes = struct.unpack_from(f'>{ip_len}s', data, offset)[0]
-            ip_str = ip_bytes.decode('utf-8')
-            offset += ip_len
 
-            # 6. Port
-            client_port = struct.unpack_from('>H', data, offset)[0]
+def _worker(index, args, stats_interval):
+    """
+    Entry point of one listener process when --processes > 1.
+    """
+    count = args.processes
+    output = f"{args.output}.{index}" if args.output and count > 1 else args.output
+    stream = open(output, 'w', newline='') if output else sys.stdout
+    shard = (index, count) if args.fanout == 'source' else None
+    name = f"[{index}] " if count > 1 else ''
 
-            # Pretty Print
-            timestamp = datetime.datetime.fromtimestamp(last_seen_ns / 1e9)
-            print("-" * 40)
-            print(f"Source Packet: {addr}")
-            print(f"User Email   : {email}")
-            print(f"Last Seen    : {timestamp} ({last_seen_ns})")
-            print(f"Client IP    : {ip_str}")
-            print(f"Client Port  : {client_port}")
-            print("-" * 40)
+    run_listener(args.port, sink=SINKS[args.sink](stream), batch=args.batch, rcvbuf=args.rcvbuf,
+                 stats_interval=stats_interval, group=args.group, interface=args.interface,
+                 reuse_port=args.reuseport or count > 1, shard=shard, name=name)
 
-        except KeyboardInterrupt:
-            print("\nStopping listener.")
-            break
-        except Exception as e:
-            print(f"Error processing packet: {e}")
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="UDP Broadcast Listener")
     parser.add_argument("--port", type=int, default=6667, help="Port to listen on (default: 6667)")
+    parser.add_argument("--sink", choices=sorted(SINKS), default="pretty",
+                        help="Output: pretty (default), quiet (stats only), jsonl, csv, state (latest table on exit)")
+    parser.add_argument("--output", help="Write sink output to this file instead of stdout (suffixed .N per process)")
+    parser.add_argument("--batch", type=int, default=64, help="Datagrams received per batch (default: 64)")
+    parser.add_argument("--rcvbuf", type=int, default=0, help="SO_RCVBUF in bytes (default: OS default)")
+    parser.add_argument("--stats-interval", type=float, default=None,
+                        help="Seconds between stats lines on stderr (default: 5, or off for the pretty sink)")
+    parser.add_argument("--group", help="Join this multicast group (e.g. 239.255.66.67)")
+    parser.add_argument("--interface", help="Local interface IP for the multicast membership")
+    parser.add_argument("--reuseport", action="store_true", help="Set SO_REUSEPORT on the socket")
+    parser.add_argument("--processes", type=int, default=1,
+                        help="Listener processes sharing the port via SO_REUSEPORT (default: 1)")
+    parser.add_argument("--fanout", choices=["source", "kernel"], default="source",
+                        help="How processes split traffic: 'source' decodes only senders hashed to the process "
+                             "(broadcast/multicast, where every socket gets a copy); 'kernel' trusts SO_REUSEPORT "
+                             "load balancing (unicast traffic)")
+    parser.add_argument("--replay", metavar="DIR",
+                        help="Replay the server's event log (EVENT_LOG_DIR) into the sink instead of listening")
+    parser.add_argument("--offset", type=int, default=0, help="With --replay: global byte offset to start from")
+    parser.add_argument("--since", type=parse_since,
+                        help="With --replay: only records seen at or after this time (ns since epoch or ISO 8601)")
     args = parser.parse_args()
 
-    run_listener(args.port)
+    if args.replay:
+        stream = open(args.output, 'w', newline='') if args.output else sys.stdout
+        replay(args.replay, SINKS[args.sink](stream), offset=args.offset, since_ns=args.since)
+        sys.exit(0)
+
+    stats_interval = args.stats_interval
+    if stats_interval is None:
+        stats_interval = 0.0 if args.sink == 'pretty' else 5.0
+
+    if args.processes <= 1:
+        _worker(0, args, stats_interval)
+    else:
+        import multiprocessing
+        workers = [multiprocessing.Process(target=_worker, args=(i, args, stats_interval), daemon=True)
+                   for i in range(args.processes)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            for worker in workers:
+                worker.join()